@@ -16,8 +16,13 @@ class FileTooBigError(ValueError):
 
 
 # temp_files_dir = os.path.join(os.path.split(__file__)[0], "temp_files")
+# created by the code that writes to it, not on import
 temp_files_dir = Path(__file__).parent / "temp_files"
-temp_files_dir.mkdir(parents=True, exist_ok=True)
+
+# persistent caches (catalog snapshot, etc.) -- created when first written to
+cache_dir = Path(
+    os.environ.get("LIBGOODS_CACHE_DIR", Path.home() / ".cache" / "libgoods")
+)
 
 # currents_dir = os.path.join(os.path.split(__file__)[0], "current_sources")
 
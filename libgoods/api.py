@@ -7,26 +7,44 @@ Functions return JSON-compatible dicts
 """
 
 from pathlib import Path
+import dataclasses
 import warnings
-from shapely.geometry import Polygon, MultiPoint
+from shapely.geometry import Polygon, MultiPoint, box
 import pandas as pd
 import os
 import numpy as np
+import xarray as xr
 
 from . import FileTooBigError, NonIntersectingSubsetError, file_processing, utilities, model_fetch
-from .model import ENVIRONMENTAL_PARAMETERS, Metadata
+from . import availability, subset_cache, writers
+from .spatial_index import as_polygon, normalize_longitude
+from .model import (
+    ENVIRONMENTAL_PARAMETERS,
+    env_params_mask,
+    match_env_params_mask,
+)
 
 from libgoods import model
 
 try:
     import model_catalogs as mc
-
-    env_models = mc.setup()
-    all_metas = {m: Metadata().init_from_model(env_models[m]) for m in env_models}
+    from . import catalog
 except ImportError:
     warnings.warn("model_catalogs not found: libgoods API will not work")
 
 
+def __getattr__(name):
+    """
+    ``all_metas`` and ``env_models`` (the main catalog) are built on first use
+    by the catalog registry
+    """
+    if name == "all_metas":
+        return catalog.registry.all_metas
+    if name == "env_models":
+        return catalog.registry.main_cat
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 ##################
 # utility functions -- implementation, not API
 ##################
@@ -38,14 +56,8 @@ def _filter_by_env_params(mdl_meta, ev_p):
     :param ev_p: list of environmental parameter (string) or singular string
     """
     # filter models out if they do not have required env_params
-    if not (isinstance(ev_p, list) or isinstance(ev_p, tuple)):
-        # assume singular string
-        if ev_p not in ENVIRONMENTAL_PARAMETERS.keys():
-            raise KeyError("{} is not a valid environmental parameter".format(ev_p))
-        return ev_p in mdl_meta.env_params
-    else:
-        # assume multiple filter parameters eg ['surface currents', 'surface winds']
-        return all([param in mdl_meta.env_params for param in ev_p])
+    query_mask = env_params_mask(ev_p)
+    return (mdl_meta.env_mask & query_mask) == query_mask
 
 
 def _filter_by_bb_intersection(mdl_meta, poly_bounds):
@@ -62,6 +74,44 @@ def _filter_by_bb_intersection(mdl_meta, poly_bounds):
     return bb_poly.intersects(poly_bounds)
 
 
+# the catalog descriptions of source availability are approximate
+# ("7 days before present time"), so the windows are padded by this much
+TIME_WINDOW_SLACK = pd.Timedelta("1 day")
+
+
+def _as_utc_naive(time):
+    """time as a naive pandas Timestamp in UTC"""
+    time = pd.Timestamp(time)
+    if time.tzinfo is not None:
+        time = time.tz_convert("UTC").tz_localize(None)
+    return time
+
+
+def _filter_by_time_range(mdl_meta, time_range, model_source=None, now=None):
+    """
+    :param mdl_meta: model Metadata object
+    :param time_range: pair of start, end times
+    :param model_source: name of the source to check -- if None, the
+           model overlaps if any of its sources do
+    :param now: the present time, for resolving relative availability windows
+    """
+    sources = [s for s in mdl_meta.sources if model_source in (None, s.name)]
+    if not sources:
+        # nothing to check against
+        return True
+    start, end = (_as_utc_naive(t) for t in time_range)
+    # use the queried availability if it is cached, without querying now
+    windows = [
+        availability.cache.peek(mdl_meta.identifier, s.name) or s.resolve_window(now)
+        for s in sources
+    ]
+    starts = pd.DatetimeIndex([w[0] for w in windows]) - TIME_WINDOW_SLACK
+    ends = pd.DatetimeIndex([w[1] for w in windows]) + TIME_WINDOW_SLACK
+    # unknown (NaT) ends compare False, so are treated as unbounded
+    overlap = ~((starts > end) | (ends < start))
+    return bool(np.any(overlap))
+
+
 def _filter_by_poly_bounds(mdl_meta, poly_bounds):
     """
     :param mdl_meta: model Metadata object
@@ -80,7 +130,14 @@ def _filter_by_poly_bounds(mdl_meta, poly_bounds):
 ###########
 
 
-def filter_models(models_metadatas, map_bounds=None, name_list=None, env_params=None):
+def filter_models(
+    models_metadatas,
+    map_bounds=None,
+    name_list=None,
+    env_params=None,
+    index=None,
+    exact=False,
+):
     """
     Filters a provided list of model metadata via three criteria:
     1. Intersects with provided polygon boundary
@@ -92,24 +149,38 @@ def filter_models(models_metadatas, map_bounds=None, name_list=None, env_params=
     :param name_list: list of string names of models
     :param env_params: string eg 'surface_currents' or list of string eg ['surface_currents', '3D_temperature']
         see libgoods.model.ENVIRONMENTAL_PARAMETERS for valid query strings
+    :param index: optional libgoods.spatial_index.ModelSpatialIndex covering
+        models_metadatas, used to answer the map_bounds query
+    :param exact=False: If True, match map_bounds against the model bounding
+        polygons rather than the bounding boxes
     """
     retlist = models_metadatas
     if name_list is not None:
         retlist = [m for m in retlist if m.identifier in name_list]
 
     if map_bounds is not None:
-        map_bounds = (
-            Polygon(map_bounds) if not isinstance(map_bounds, Polygon) else map_bounds
-        )
-        retlist = [m for m in retlist if _filter_by_bb_intersection(m, map_bounds)]
+        if index is not None:
+            hits = set(index.query(map_bounds, exact=exact))
+            retlist = [m for m in retlist if m.identifier in hits]
+        else:
+            map_bounds = (
+                Polygon(map_bounds) if not isinstance(map_bounds, Polygon) else map_bounds
+            )
+            _filter = _filter_by_poly_bounds if exact else _filter_by_bb_intersection
+            retlist = [m for m in retlist if _filter(m, map_bounds)]
 
     if env_params is not None:
-        retlist = [m for m in retlist if _filter_by_env_params(m, env_params)]
+        retlist = list(retlist)
+        masks = np.fromiter((m.env_mask for m in retlist), np.int64, len(retlist))
+        keep = match_env_params_mask(masks, env_params_mask(env_params))
+        retlist = [m for m, k in zip(retlist, keep) if k]
 
     return retlist
 
 
-def list_models(name_list=None, map_bounds=None, env_params=None, as_pyson=False):
+def list_models(
+    name_list=None, map_bounds=None, env_params=None, as_pyson=False, exact=False
+):
     """
     Return metadata for all available models
 
@@ -124,20 +195,77 @@ def list_models(name_list=None, map_bounds=None, env_params=None, as_pyson=False
     :param as_pyson=False: If True, result is JSON-compatible dict.
                            If false, Metadata objects.
 
+    :param exact=False: If True, map_bounds are checked against the model
+                        bounding polygons, rather than the bounding boxes.
+
     :returns: list of metadata for models that satisfy the criteria
 
     """
+    registry = catalog.registry
+    metas = registry.all_metas.values()
+    if env_params is not None:
+        # use the precomputed masks of all the models
+        keep = match_env_params_mask(registry.env_masks, env_params_mask(env_params))
+        metas = [m for m, k in zip(metas, keep) if k]
     retval = filter_models(
-        all_metas.values(),
+        metas,
         name_list=name_list,
         map_bounds=map_bounds,
-        env_params=env_params,
+        index=registry.spatial_index if map_bounds is not None else None,
+        exact=exact,
     )
     if as_pyson:
-        retval = [m.as_pyson() for m in retval]
+        # the cached dicts are shared -- callers must not modify them
+        payloads = registry.payloads
+        retval = [payloads[m.identifier].pyson for m in retval]
     return retval
 
 
+def list_models_json(
+    name_list=None, map_bounds=None, env_params=None, exact=False, if_none_match=None
+):
+    """
+    Return the list_models result as serialized JSON, with an ETag
+
+    The response is assembled from the cached JSON of each model.
+
+    :param if_none_match=None: ETag the client already has. If it matches,
+                               the payload is not assembled and None is
+                               returned in its place.
+
+    Other parameters as for list_models.
+
+    :returns: (payload, etag) -- payload is bytes of a JSON list, or None
+    """
+    metas = list_models(
+        name_list=name_list, map_bounds=map_bounds, env_params=env_params, exact=exact
+    )
+    payloads = catalog.registry.payloads
+    parts = [payloads[m.identifier] for m in metas]
+    etag = catalog.make_etag(b",".join(p.etag.encode("ascii") for p in parts))
+    if etag == if_none_match:
+        return None, etag
+    return b"[" + b",".join(p.json for p in parts) + b"]", etag
+
+
+def warm():
+    """
+    Load the model catalog state now, rather than on first use
+
+    Pre-fork servers can call this before starting their workers.
+    """
+    catalog.registry.warm(main_catalog=True)
+
+
+def refresh_catalog():
+    """
+    Re-read the model catalog and rebuild the stored snapshot
+
+    Use this when the catalogs have been updated while the process is running.
+    """
+    catalog.registry.refresh()
+
+
 def get_model_info(model_name):
     """
     Return metadata about a particular model
@@ -149,32 +277,72 @@ def get_model_info(model_name):
     TODO?? -- return only meta for specific source?
 
     """
-    if model_name not in env_models:
+    payloads = catalog.registry.payloads
+    if model_name not in payloads:
         raise KeyError(f"{model_name} is not a valid model name")
     else:
-        return all_metas[model_name].as_pyson()
+        # the cached dict is shared -- callers must not modify it
+        return payloads[model_name].pyson
+
 
+def get_model_info_json(model_name, if_none_match=None):
+    """
+    Return the metadata of a model as serialized JSON, with an ETag
+
+    :param model_name: the name (unique ID) of the model.
+    :param if_none_match=None: ETag the client already has. If it matches,
+                               None is returned in place of the payload.
 
-def check_subset_overlap(cat, time_range=None, xy_bounds=None):
+    :returns: (payload, etag) -- payload is bytes of a JSON object, or None
+    """
+    payloads = catalog.registry.payloads
+    if model_name not in payloads:
+        raise KeyError(f"{model_name} is not a valid model name")
+    payload = payloads[model_name]
+    if payload.etag == if_none_match:
+        return None, payload.etag
+    return payload.json, payload.etag
+
+
+def _bbox_geometry(bbox):
+    """
+    The area of a (w, s, e, n) bbox as a shapely geometry in (-180, 180)
+
+    A bbox with w > e crosses the dateline: it is split in two there.
+    """
+    west, south, east, north = bbox
+    if west > east:
+        east += 360
+    return normalize_longitude(box(west, south, east, north))
+
+
+def check_subset_overlap(cat, time_range=None, xy_bounds=None, model_source=None):
     """
-    TODO FINISH TIME RANGE CHECKING
     This function checks if a given time range and xy_bounds overlap with
     the model dimensions. If a param is None it is not checked. If both are None
     True is returned
 
-    :param cat: model_catalog entry
-    :param time_range: iterable pair of python datetime.datetime objects or None
-    :param xy_bounds: iterable pairs of [lon, lat], or None
+    Only the cached catalog metadata is used, so this can be called before
+    any remote data are requested.
+
+    :param cat: model identifier, or model_catalog entry
+    :param time_range: iterable pair of start, end times (python datetime.datetime
+                       objects, or anything pandas.Timestamp accepts), or None
+    :param xy_bounds: iterable pairs of [lon, lat], shapely geometry, or None
+    :param model_source: name of the model source to check the time range
+                         against -- if None, any source will do.
     """
-    overlap = True
-    metadata = Metadata().init_from_model(cat)
+    identifier = cat if isinstance(cat, str) else cat.name
+    registry = catalog.registry
+    metadata = registry.all_metas[identifier]
 
     if time_range is not None:
-        pass
+        if not _filter_by_time_range(metadata, time_range, model_source):
+            return False
     if xy_bounds is not None:
-        subset_xy_bounds = Polygon(xy_bounds)
-        overlap = overlap and _filter_by_poly_bounds(metadata, subset_xy_bounds)
-    return overlap
+        if not registry.spatial_index.intersects(identifier, as_polygon(xy_bounds)):
+            return False
+    return True
 
 
 def get_model_file(
@@ -185,9 +353,13 @@ def get_model_file(
     bounds,
     surface_only=True,
     environmental_parameters="surface currents",
-    # cross_dateline=False,
-    # max_filesize=None,
+    max_filesize=None,
     target_pth=None,
+    use_cache=False,
+    output_encoding=None,
+    output_format="netcdf",
+    decimation=None,
+    cross_dateline=False,
 ):
     """
     Get the actual model data as a netcdf file.
@@ -196,43 +368,204 @@ def get_model_file(
     :param model_source (forecast/nowcast etc) -- !!!naming conventions are changing soon
     :params start: start time of to subset to (date string)
     :params end: end time to subset to (date string)
-    :param bounds: bounds to subset to -- if the implementation doesn't
-                   support polygons, the bounding box of the bounds will be used.
+    :param bounds: bounds to subset to -- a (lower-left, upper-right) pair of
+                   (lon, lat) points, or the (lon, lat) points of a polygon.
+                   A polygon subset is cut to the smallest window of the grid
+                   around the polygon, and the cells outside it are written
+                   as fill values. A pair with west > east crosses the
+                   dateline, e.g. ((170, -10), (-170, 10)).
 
 
     :param environmental_parameters: which environmental parameters to extract
+                                     -- one of the keys of
+                                     ENVIRONMENTAL_PARAMETERS, e.g.
+                                     "surface winds".
 
-    :param cross_dateline=False: whether the subset crosses the dateline
+    :param cross_dateline=False: whether the subset crosses the dateline --
+                                 if True, a (lower-left, upper-right) pair
+                                 with west < east is read as going east from
+                                 its east edge to its west edge. Subsets
+                                 across the dateline are fetched as two
+                                 slices, stitched into one longitude axis.
 
     :param max_filesize = None: maximum filesize to generate -- if the file will
-                          be larger than this, raise a FileTooBigError
+                          be larger than this, raise a FileTooBigError. This is
+                          checked before any data are downloaded.
 
     :param target_dir: full path of file to write the output too -- if None, it will be put in a temp dir or local dir.
 
+    :param use_cache=False: serve the file from the local subset cache if the
+                            same subset has been requested before, or slice it
+                            locally from a cached subset that contains it.
+                            The file is also added to the cache.
+
+    :param output_encoding=None: compression and chunking of the file -- a
+                                 writers.OutputEncoding or a dict of its fields.
+                                 None for xarray's defaults.
+
+    :param output_format="netcdf": "netcdf", or "zarr" for a Zarr store with
+                                   consolidated metadata.
+
+    :param decimation=None: lower resolution for quick looks -- a
+                            model_fetch.Decimation or a dict of its fields,
+                            e.g. {"xy_stride": 4, "time_resolution": "3h"}.
 
     :returns: filepath
     """
 
-    if target_pth is None:
-        target_pth = os.path.abspath("output.nc")
+    if environmental_parameters not in ENVIRONMENTAL_PARAMETERS:
+        raise ValueError(f"{environmental_parameters!r} is not one of: "
+                         f"{', '.join(ENVIRONMENTAL_PARAMETERS)}")
 
-    cat = env_models[model_id]
+    if target_pth is None:
+        target_pth = os.path.abspath(
+            "output.zarr" if output_format == writers.ZARR else "output.nc"
+        )
 
-    polybounds = utilities.bbox2polygon(bounds)
-    if not check_subset_overlap(cat, [start, end], polybounds):
+    # None if the bounds are a bounding box
+    polygon = utilities.polygon_points(bounds)
+    if polygon is None and len(bounds) == 2:
+        # keeps west > east for subsets across the dateline
+        flat_bounds = utilities.flatten_bbox(bounds)
+    else:
+        flat_bounds = utilities.flatten_bbox(utilities.polygon2bbox(bounds))
+    if cross_dateline and flat_bounds[0] < flat_bounds[2]:
+        flat_bounds = (flat_bounds[2], flat_bounds[1], flat_bounds[0], flat_bounds[3])
+    polybounds = polygon if polygon is not None else _bbox_geometry(flat_bounds)
+    if not check_subset_overlap(model_id, [start, end], polybounds, model_source):
         # no overlap in at least one dimension
         raise NonIntersectingSubsetError()
 
-    source = mc.select_date_range(cat[model_source], start_date=start, end_date=end)
-    ds = source.to_dask()
-    meta = get_model_info(model_id)
+    # what fetch_model extracts
+    which_data = environmental_parameters
+    encoding = writers.OutputEncoding.create(output_encoding)
+    decimation = model_fetch.Decimation.create(decimation)
+
+    def produce(pth, output_format=output_format):
+        cat = catalog.registry.main_cat[model_id]
+
+        source = mc.select_date_range(cat[model_source], start_date=start, end_date=end)
+        ds = source.to_dask()
+        meta = get_model_info(model_id)
+
+        pth = model.fetch_model(
+            ds,
+            meta,
+            flat_bounds,
+            pth,
+            which_data=which_data,
+            max_filesize=max_filesize,
+            encoding=encoding,
+            output_format=output_format,
+            decimation=decimation,
+            polygon=polygon,
+        )
+
+        #Example of how to use old code. Leave for now, but can delete eventually.
+        #pth = model.fetch_model_oldcode(source.urlpath,meta,utilities.flatten_bbox(bounds),start,end,pth)
+        return pth
+
+    if not use_cache:
+        return produce(target_pth)
+
+    key = subset_request_key(model_id,
+                             model_source,
+                             start,
+                             end,
+                             flat_bounds,
+                             surface_only,
+                             environmental_parameters,
+                             encoding,
+                             decimation,
+                             polygon)
+    extent = subset_cache.SubsetExtent(
+        source=f"{model_id}/{model_source}",
+        bbox=tuple(float(b) for b in flat_bounds),
+        start=_as_utc_naive(start),
+        end=_as_utc_naive(end),
+        variables=frozenset(ENVIRONMENTAL_PARAMETERS[which_data]),
+        depth="surface",
+        precision=encoding.precision if encoding is not None else "",
+        decimation=decimation.label if decimation is not None else "",
+        polygon=Polygon(polygon).wkt if polygon is not None else "",
+    )
+
+    def produce_from_cache(pth):
+        # slice the request from a cached file that contains it, if there is one
+        superset = subset_cache.cache.find_superset(extent)
+        if superset is None:
+            # the cache holds netCDF files
+            return produce(pth, writers.NETCDF)
+        with xr.open_dataset(subset_cache.cache.path(superset), chunks={}) as ds:
+            ds_ss = model.slice_subset(ds, flat_bounds, extent.start, extent.end, which_data)
+            cached = subset_cache.cache.extents.get(superset)
+            if decimation is not None and (cached is None or not cached.decimation):
+                # sliced from a full resolution superset
+                ds_ss = decimation.apply(ds_ss)
+            if polygon is not None and (cached is None or not cached.polygon):
+                ds_ss = model_fetch.subset_polygon(ds_ss, Polygon(polygon))
+            model_fetch.check_subset_size(model_fetch.subset_info(ds_ss), max_filesize)
+            writers.write_checkpointed(ds_ss, pth, report=None, encoding=encoding)
+        return pth
+
+    return subset_cache.cache.fetch_to(
+        key,
+        produce_from_cache,
+        target_pth,
+        extent,
+        export=writers.export_cached(output_format, encoding),
+    )
+
+
+def subset_request_key(identifier,
+                       model_source,
+                       start,
+                       end,
+                       bounds,
+                       surface_only,
+                       request_type,
+                       output_encoding=None,
+                       decimation=None,
+                       polygon=None):
+    """
+    Return the subset cache key of a request
 
-    target_pth = model.fetch_model(ds, meta, utilities.flatten_bbox(bounds), target_pth)
-    
-    #Example of how to use old code. Leave for now, but can delete eventually.
-    #target_pth = model.fetch_model_oldcode(source.urlpath,meta,utilities.flatten_bbox(bounds),start,end,target_pth)
-    
-    return target_pth
+    Parameters are as for generate_subset_xds -- equivalent requests (e.g. the
+    same times in another timezone, or request types in another order) get
+    the same key.
+
+    :param output_encoding=None: as for request_subset
+
+    :param decimation=None: as for get_model_file
+
+    :param polygon=None: (lon, lat) points of a polygon within the bounds
+    """
+    if isinstance(request_type, str):
+        request_type = [request_type]
+    encoding = writers.OutputEncoding.create(output_encoding)
+    decimation = model_fetch.Decimation.create(decimation)
+    return subset_cache.request_key(identifier=identifier,
+                                    model_source=model_source,
+                                    start=_as_utc_naive(start),
+                                    end=_as_utc_naive(end),
+                                    bounds=tuple(bounds),
+                                    surface_only=surface_only,
+                                    request_type=set(request_type),
+                                    encoding=None if encoding is None else dataclasses.asdict(encoding),
+                                    decimation=None if decimation is None else dataclasses.asdict(decimation),
+                                    polygon=polygon)
+
+
+def subset_cache_stats():
+    """
+    Return the hit/miss statistics of the local subset cache
+
+    :returns: JSON compatible dict
+    """
+    stats = subset_cache.cache.stats.as_pyson()
+    stats["nbytes"] = subset_cache.cache.total_bytes()
+    stats["max_bytes"] = subset_cache.cache.max_bytes
+    return stats
 
 def generate_subset_xds(identifier,
                         model_source,
@@ -246,15 +579,19 @@ def generate_subset_xds(identifier,
     '''
     Generates a subset xarray dataset. Does NOT actually get the data
 
-    bounds: expects (w, s, e, n)
+    bounds: expects (w, s, e, n) -- w > e crosses the dateline, as does
+            w < e with cross_dateline (going east from e to w)
     '''
 
-    cat = env_models[identifier]
-
-    polybounds = utilities.bbox2polygon(bounds)
-    if not check_subset_overlap(cat, [start, end], polybounds):
+    if cross_dateline and bounds[0] < bounds[2]:
+        # (min_lon, ..., max_lon) of a subset that goes east from max_lon to min_lon
+        bounds = (bounds[2], bounds[1], bounds[0], bounds[3])
+    polybounds = _bbox_geometry(bounds)
+    if not check_subset_overlap(identifier, [start, end], polybounds, model_source):
         # no overlap in at least one dimension
         raise NonIntersectingSubsetError()
+
+    cat = catalog.registry.main_cat[identifier]
     source = mc.select_date_range(cat[model_source], start_date=start, end_date=end)
     ds = source.to_dask()
     meta = get_model_info(identifier)
@@ -276,15 +613,83 @@ def generate_subset_xds(identifier,
     if 'ice' in request_type:
         env_params += ep['ice']
 
-    ds = model_fetch.select_surface(ds)  # eventually check env params
+    ds = model_fetch.select_surface(ds, identifier)  # eventually check env params
     ds_ss = ds.em.filter(env_params)
-    bounds = model_fetch.rotate_bbox(meta["identifier"], bounds)
-    ds_ss = ds_ss.em.sub_grid(bbox=bounds)
-    if meta["bounding_box"][2] > 180:
-        ds_ss = model_fetch.rotate_longitude(ds_ss)
+    wrapped = model_fetch.dateline_bbox(meta["identifier"], bounds)
+    if wrapped is not None:
+        # two slices, on either side of the dateline, stitched together
+        ds_ss = model_fetch.sub_grid_dateline(ds_ss, wrapped)
+    else:
+        bounds = model_fetch.rotate_bbox(meta["identifier"], bounds)
+        ds_ss = ds_ss.em.sub_grid(bbox=bounds)
+        ds_ss = model_fetch.rotate_longitude(ds_ss, meta["identifier"])
 
     return ds_ss
 
-def request_subset(xds, output_pth):
-    xds.to_netcdf(output_pth)
+def get_subset_info(identifier,
+                    model_source,
+                    start,
+                    end,
+                    bounds,
+                    surface_only,
+                    cross_dateline,
+                    request_type):
+    """
+    Return the size and shape of a subset, without getting the data
+
+    Parameters are as for generate_subset_xds.
+
+    :returns: JSON compatible dict with the dims, dtype and size of each
+              variable, the number of time steps, and the total uncompressed
+              and estimated compressed size in bytes.
+    """
+    xds = generate_subset_xds(identifier,
+                              model_source,
+                              start,
+                              end,
+                              bounds,
+                              surface_only,
+                              cross_dateline,
+                              request_type)
+    return model_fetch.subset_info(xds).as_pyson()
+
+
+def request_subset(xds,
+                   output_pth,
+                   max_filesize=None,
+                   cache_key=None,
+                   output_encoding=None,
+                   output_format="netcdf"):
+    """
+    Write a subset generated by generate_subset_xds to output_pth
+
+    :param max_filesize=None: maximum (uncompressed) size in bytes -- if the
+                              subset is larger, a FileTooBigError is raised
+                              before any data are read.
+
+    :param cache_key=None: key of the request, from subset_request_key -- if
+                           given, the subset is served from (and added to)
+                           the local subset cache.
+
+    :param output_encoding=None: compression and chunking of the file -- a
+                                 writers.OutputEncoding or a dict of its fields.
+                                 None for xarray's defaults.
+
+    :param output_format="netcdf": "netcdf", or "zarr" for a Zarr store with
+                                   consolidated metadata.
+    """
+    encoding = writers.OutputEncoding.create(output_encoding)
+
+    def produce(pth, output_format=output_format):
+        model_fetch.check_subset_size(model_fetch.subset_info(xds), max_filesize)
+        writers.write_output(xds, pth, output_format, report=None, encoding=encoding)
+
+    if cache_key is None:
+        produce(output_pth)
+    else:
+        # the cache holds netCDF files
+        subset_cache.cache.fetch_to(cache_key,
+                                    lambda pth: produce(pth, writers.NETCDF),
+                                    output_pth,
+                                    export=writers.export_cached(output_format, encoding))
     return output_pth
\ No newline at end of file
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""A persistent, TTL-based cache of when model sources have data.
+
+Finding the start and end datetimes of a source means querying remote
+servers (``mc.find_availability``). The answers only change when a new
+model cycle is published, so they are cached, in memory and on disk, with
+a time-to-live per source based on its output period and the forecast
+cycle cadence. Sources that end on a fixed date (old hindcasts) are kept
+much longer.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, Mapping, Optional, Tuple
+
+import pandas as pd
+
+from libgoods import cache_dir
+
+# Most of the models publish a new forecast cycle every 6 hours.
+FORECAST_CYCLE_HOURS = 6
+# Sources with a fixed end date are rechecked weekly.
+STATIC_TTL = pd.Timedelta(days=7)
+
+TimeRange = Tuple[pd.Timestamp, pd.Timestamp]
+# Returns the availability of every source of a model.
+ModelLookup = Callable[[str], Mapping[str, TimeRange]]
+
+
+def find_model_availability(model_name: str) -> Mapping[str, TimeRange]:
+    """Query the remote servers for the start/end datetimes of each source."""
+    # imported here as libgoods.catalog imports this module (through libgoods.model_fetch)
+    import model_catalogs as mc
+    from libgoods.catalog import registry
+
+    cat = mc.find_availability(registry.main_cat[model_name])
+    return {
+        timing: (
+            pd.Timestamp(cat[timing].metadata["start_datetime"]),
+            pd.Timestamp(cat[timing].metadata["end_datetime"]),
+        )
+        for timing in cat
+    }
+
+
+def source_ttl(source_meta, cycle_hours: float = FORECAST_CYCLE_HOURS) -> pd.Timedelta:
+    """Return how long the availability of a source can be cached.
+
+    Parameters
+    ----------
+    source_meta : SourceMetadata or None
+        Metadata of the source. If None, the forecast cycle cadence is used.
+    cycle_hours : float
+        Hours between forecast cycles.
+    """
+    if source_meta is None:
+        return pd.Timedelta(hours=cycle_hours)
+    if source_meta.has_fixed_end():
+        return STATIC_TTL
+    try:
+        period = float(source_meta.period)
+    except (TypeError, ValueError):
+        period = 0.0
+    return pd.Timedelta(hours=max(period, cycle_hours))
+
+
+def _to_json_time(value: pd.Timestamp) -> Optional[str]:
+    """Timestamp as a JSON value."""
+    return None if pd.isna(value) else pd.Timestamp(value).isoformat()
+
+
+def _from_json_time(value: Optional[str]) -> pd.Timestamp:
+    """Timestamp from a JSON value."""
+    return pd.NaT if value is None else pd.Timestamp(value)
+
+
+class AvailabilityCache:
+    """Cache of source (start, end) datetimes, with a per-source TTL.
+
+    Reads are served from memory. Expired or missing entries are looked up
+    with ``lookup``, which queries all the sources of a model at once, and
+    the cache is then written to ``path`` so it survives restarts.
+
+    Parameters
+    ----------
+    path : Path, optional
+        JSON file to persist the cache to. Defaults to ``availability.json`` in
+        the libgoods cache directory. Use False to keep it in memory only.
+    lookup : callable, optional
+        ``lookup(model_name)`` returns a mapping of timing to (start, end).
+        Defaults to `find_model_availability`.
+    ttl : callable, optional
+        ``ttl(model_name, timing)`` returns a Timedelta. Defaults to
+        `source_ttl` of the source's catalog metadata.
+    clock : callable, optional
+        Returns the current time in seconds.
+    """
+
+    def __init__(
+        self,
+        path=None,
+        lookup: Optional[ModelLookup] = None,
+        ttl: Optional[Callable[[str, str], pd.Timedelta]] = None,
+        clock: Optional[Callable[[], float]] = None,
+    ):
+        """Initializes the cache -- nothing is read until first use."""
+        self.path = cache_dir / "availability.json" if path is None else path
+        self.lookup = lookup or find_model_availability
+        self.ttl = ttl or self._catalog_ttl
+        self.clock = clock or time.time
+        self._entries: Optional[Dict[str, dict]] = None
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._refresher: Optional[threading.Thread] = None
+
+    @staticmethod
+    def _key(model_name: str, timing: str) -> str:
+        """The key of a source in the cache."""
+        return f"{model_name}/{timing}"
+
+    @staticmethod
+    def _catalog_ttl(model_name: str, timing: str) -> pd.Timedelta:
+        """TTL from the source metadata in the catalog registry."""
+        from libgoods.catalog import registry
+
+        meta = registry.all_metas.get(model_name)
+        sources = [] if meta is None else [s for s in meta.sources if s.name == timing]
+        return source_ttl(sources[0] if sources else None)
+
+    @property
+    def entries(self) -> Dict[str, dict]:
+        """The cache entries, read from disk on first use."""
+        if self._entries is None:
+            with self._lock:
+                if self._entries is None:
+                    self._entries = self._load()
+        return self._entries
+
+    def _load(self) -> Dict[str, dict]:
+        """Read the persisted entries."""
+        if not self.path:
+            return {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as infile:
+                return json.load(infile)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self):
+        """Write the entries to disk, atomically."""
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as outfile:
+                json.dump(self._entries, outfile)
+            os.replace(tmp_name, self.path)
+        except OSError:
+            if os.path.exists(tmp_name):
+                os.unlink(tmp_name)
+
+    def _is_fresh(self, entry: Optional[dict]) -> bool:
+        """Return True if the entry has not expired."""
+        return entry is not None and self.clock() < entry["expires"]
+
+    def update(self, model_name: str) -> Mapping[str, TimeRange]:
+        """Look up the availability of a model's sources and store it."""
+        times = self.lookup(model_name)
+        now = self.clock()
+        with self._lock:
+            for timing, (start, end) in times.items():
+                self.entries[self._key(model_name, timing)] = {
+                    "start": _to_json_time(start),
+                    "end": _to_json_time(end),
+                    "expires": now + self.ttl(model_name, timing).total_seconds(),
+                }
+            self._save()
+        return times
+
+    def peek(self, model_name: str, timing: str) -> Optional[TimeRange]:
+        """Return the cached (start, end) if it is fresh, without any lookup."""
+        entry = self.entries.get(self._key(model_name, timing))
+        if not self._is_fresh(entry):
+            return None
+        return _from_json_time(entry["start"]), _from_json_time(entry["end"])
+
+    def get(self, model_name: str, timing: str) -> TimeRange:
+        """Return the (start, end) of a source, looking it up if not cached."""
+        times = self.peek(model_name, timing)
+        if times is None:
+            self.update(model_name)
+            entry = self.entries[self._key(model_name, timing)]
+            times = _from_json_time(entry["start"]), _from_json_time(entry["end"])
+        return times
+
+    def get_times(self, model_name: str) -> Mapping[str, TimeRange]:
+        """Return a mapping of each source of a model to its (start, end)."""
+        prefix = self._key(model_name, "")
+        timings = [key[len(prefix) :] for key in self.entries if key.startswith(prefix)]
+        times = {timing: self.peek(model_name, timing) for timing in timings}
+        if not times or any(t is None for t in times.values()):
+            times = self.update(model_name)
+        return times
+
+    def refresh_expiring(self, within: float = 0.0):
+        """Look up again every model with an entry that expires within `within` seconds."""
+        deadline = self.clock() + within
+        with self._lock:
+            models = {
+                key.split("/", 1)[0]
+                for key, entry in self.entries.items()
+                if entry["expires"] <= deadline
+            }
+        for model_name in sorted(models):
+            try:
+                self.update(model_name)
+            except Exception:
+                # leave the old entry: it will be retried next time
+                pass
+
+    def start_refresher(self, interval: float = 300.0):
+        """Refresh entries in a background thread before they expire."""
+        if self._refresher is not None and self._refresher.is_alive():
+            return
+        self._stop.clear()
+
+        def run():
+            while not self._stop.wait(interval):
+                self.refresh_expiring(within=interval)
+
+        self._refresher = threading.Thread(
+            target=run, name="availability-refresher", daemon=True
+        )
+        self._refresher.start()
+
+    def stop_refresher(self):
+        """Stop the background refresher."""
+        self._stop.set()
+        if self._refresher is not None:
+            self._refresher.join()
+            self._refresher = None
+
+
+cache = AvailabilityCache()
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Running many fetches in one go.
+
+A manifest (JSON or CSV) lists the fetches, one `FetchConfig` per entry.
+The catalog is set up once, the entries are grouped by model and timing so
+that each remote dataset is opened only once (for the union of the time
+windows of its entries), and the subsets are then cut and written
+concurrently on a thread pool. The HDF5 library behind netCDF4 is not
+thread safe, so `libgoods.writers` serializes the netCDF writes themselves,
+but the blocks of data are downloaded in parallel.
+"""
+import csv
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, fields, replace
+from pathlib import Path
+from typing import Callable, Dict, List, Mapping, Optional, Tuple
+
+import pandas as pd
+import xarray as xr
+
+from libgoods import model_fetch
+from libgoods.model_fetch import Decimation, FetchConfig, SubsetInfo
+from libgoods.performance import Timer
+from libgoods.writers import OutputEncoding
+
+# Opens the dataset of (model_name, timing) for a time window.
+SourceOpener = Callable[[str, str, pd.Timestamp, pd.Timestamp], xr.Dataset]
+
+_BOOL_FIELDS = {
+    "surface_only", "dry_run", "use_cache", "append", "replace_overlap", "consolidated"
+}
+_INT_FIELDS = {"max_filesize", "memory_budget"}
+
+
+@dataclass
+class JobResult:
+    """The outcome of one fetch of a batch."""
+
+    config: FetchConfig
+    info: Optional[SubsetInfo] = None
+    error: Optional[str] = None
+    elapsed_ms: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        """True if the fetch succeeded."""
+        return self.error is None
+
+
+def _parse_bool(value) -> bool:
+    """Parse a boolean from a manifest value."""
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "y")
+    return bool(value)
+
+
+def config_from_dict(entry: Mapping) -> FetchConfig:
+    """Create a FetchConfig from a manifest entry.
+
+    The keys are the names of the FetchConfig fields. Empty values are
+    ignored, so CSV manifests can leave optional columns blank. The bbox and
+    standard names can be given as lists or as comma (or semicolon) separated
+    strings, and the polygon as a list of (lon, lat) pairs or a
+    "lon,lat;lon,lat;..." string. The encoding and decimation can be given as dicts (or, in a CSV,
+    JSON objects) of `OutputEncoding` and `Decimation` fields.
+    """
+    names = {f.name for f in fields(FetchConfig)}
+    unknown = set(entry) - names
+    if unknown:
+        raise ValueError(f"Unknown manifest fields: {', '.join(sorted(unknown))}")
+    kwargs = {}
+    for name, value in entry.items():
+        if value is None or value == "":
+            continue
+        if name in ("start", "end"):
+            value = pd.Timestamp(value)
+        elif name == "output_pth":
+            value = Path(value)
+        elif name == "bbox":
+            if isinstance(value, str):
+                value = value.replace(";", ",").split(",")
+            value = tuple(float(v) for v in value)
+            if len(value) != 4:
+                raise ValueError("bbox should include four numbers: lon_min,lat_min,lon_max,lat_max")
+        elif name == "standard_names":
+            if isinstance(value, str):
+                value = [v.strip() for v in value.replace(";", ",").split(",") if v.strip()]
+            value = list(value)
+        elif name in _BOOL_FIELDS:
+            value = _parse_bool(value)
+        elif name in _INT_FIELDS:
+            value = int(float(value))
+        elif name == "encoding":
+            if isinstance(value, str):
+                value = json.loads(value)
+            value = OutputEncoding.create(value)
+        elif name == "decimation":
+            if isinstance(value, str):
+                value = json.loads(value)
+            value = Decimation.create(value)
+        elif name == "depth":
+            value = model_fetch.parse_depth(value)
+        elif name == "polygon":
+            value = model_fetch.parse_polygon(value)
+        kwargs[name] = value
+    kwargs.setdefault("bbox", None)
+    kwargs.setdefault("timing", "hindcast")
+    return FetchConfig(**kwargs)
+
+
+def load_manifest(path) -> List[FetchConfig]:
+    """Read the FetchConfigs of a JSON or CSV manifest.
+
+    A JSON manifest is a list of entries (or an object with a "jobs" list);
+    a CSV manifest has a header row of field names and one entry per row.
+    """
+    path = Path(path)
+    with open(path, "r", encoding="utf-8", newline="") as infile:
+        if path.suffix.lower() == ".csv":
+            entries = list(csv.DictReader(infile))
+        else:
+            entries = json.load(infile)
+            if isinstance(entries, dict):
+                entries = entries["jobs"]
+    return [config_from_dict(entry) for entry in entries]
+
+
+def group_configs(configs: List[FetchConfig]) -> Dict[Tuple[str, str], List[int]]:
+    """Group the indices of the configs by (model_name, timing)."""
+    groups: Dict[Tuple[str, str], List[int]] = {}
+    for i, config in enumerate(configs):
+        groups.setdefault((config.model_name, config.timing), []).append(i)
+    return groups
+
+
+def _default_opener(report: Optional[Callable[[str], None]] = None) -> SourceOpener:
+    """Opens sources with the catalog registry's main catalog, set up once."""
+    # imported here as libgoods.catalog imports libgoods.model_fetch
+    from libgoods.catalog import registry
+
+    main_cat = registry.main_cat
+
+    def opener(model_name, timing, start, end):
+        return model_fetch.open_source(
+            model_name, timing, start, end, main_cat=main_cat, report=report
+        )
+
+    return opener
+
+
+def _run_job(
+    config: FetchConfig, ds: xr.Dataset, report: Optional[Callable[[str], None]] = None
+) -> SubsetInfo:
+    """Cut and write one subset from the opened dataset of its group.
+
+    Appending and the subset cache work as for `model_fetch.fetch`, with ds
+    as the source.
+    """
+    if config.bbox is not None:
+        config = replace(config, bbox=model_fetch.rotate_bbox(config.model_name, config.bbox))
+    return model_fetch.fetch(config, ds, report)
+
+
+def run_batch(
+    configs: List[FetchConfig],
+    max_workers: int = 4,
+    opener: Optional[SourceOpener] = None,
+    report: Optional[Callable[[str], None]] = None,
+) -> List[JobResult]:
+    """Run many fetches, opening each remote dataset once.
+
+    Parameters
+    ----------
+    configs : list of FetchConfig
+        The fetches to run.
+    max_workers : int
+        Maximum number of datasets opened, or subsets written, at once.
+    opener : callable, optional
+        ``opener(model_name, timing, start, end)`` returns the lazily loaded
+        dataset of a source. Defaults to `model_fetch.open_source` with the
+        catalog registry's main catalog.
+    report : callable, optional
+        Called with the progress of each fetch and a line of text as each
+        completes, e.g. ``print``. None (the default) for silence.
+
+    Returns
+    -------
+    list of JobResult
+        One per config, in the same order.
+    """
+    groups = group_configs(configs)
+    results = [JobResult(config) for config in configs]
+    if not configs:
+        return results
+    if opener is None:
+        opener = _default_opener(report)
+
+    def open_group(key):
+        indices = groups[key]
+        start = min(pd.Timestamp(configs[i].start) for i in indices)
+        end = max(pd.Timestamp(configs[i].end) for i in indices)
+        return opener(key[0], key[1], start, end)
+
+    def run(i, ds):
+        timer = Timer()
+        try:
+            results[i].info = _run_job(configs[i], ds, report)
+        except Exception as err:
+            results[i].error = str(err) or type(err).__name__
+        results[i].elapsed_ms = timer.tock()
+        return results[i]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        opened = {executor.submit(open_group, key): key for key in groups}
+        jobs = []
+        for future in as_completed(opened):
+            key = opened[future]
+            try:
+                ds = future.result()
+            except Exception as err:
+                for i in groups[key]:
+                    results[i].error = f"Opening {key[0]} {key[1]} failed: {err}"
+                    if report is not None:
+                        report(_format_result(results[i]))
+                continue
+            jobs += [executor.submit(run, i, ds) for i in groups[key]]
+        for future in as_completed(jobs):
+            if report is not None:
+                report(_format_result(future.result()))
+    return results
+
+
+def _format_result(result: JobResult) -> str:
+    """One line describing the outcome of a job."""
+    config = result.config
+    status = "ok" if result.ok else f"FAILED: {result.error}"
+    return (
+        f"{config.model_name} {config.timing} -> {config.output_pth}: {status} "
+        f"({result.elapsed_ms / 1000:.1f} s)"
+    )
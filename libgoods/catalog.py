@@ -0,0 +1,306 @@
+"""
+Persistent snapshot of the model catalog
+
+Building the ``Metadata`` object for every model requires running
+``model_catalogs.setup()``, which takes seconds. The parsed results are
+stored on disk in a versioned snapshot so that later imports can load
+them directly. The snapshot is rebuilt when the catalog files or the
+``model_catalogs`` version change, or when ``CatalogRegistry.refresh`` is
+called.
+
+Nothing is loaded on import: the module-level ``registry`` reads (or
+builds) the snapshot on first use, and only runs ``mc.setup()`` when model
+data are actually requested.
+"""
+
+import dataclasses
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import threading
+import warnings
+from importlib.metadata import PackageNotFoundError, version
+from pathlib import Path
+
+import model_catalogs as mc
+import numpy as np
+
+from . import cache_dir, model_fetch
+from .model import Metadata
+from .spatial_index import ModelSpatialIndex
+
+
+# Bump this whenever the layout of the snapshot or of the pickled
+# Metadata / SourceMetadata objects changes.
+SNAPSHOT_VERSION = 2
+
+snapshot_path = cache_dir / "catalog_snapshot.pickle"
+
+# packages whose installed version is part of the snapshot signature
+CATALOG_PACKAGES = ("model_catalogs", "mc-goods")
+
+def _catalog_files():
+    """the catalog files the snapshot depends on"""
+    files = []
+    for folder in (Path(mc.CAT_PATH), Path(mc.CACHE_PATH_COMPILED)):
+        if folder.is_dir():
+            files.extend(sorted(folder.glob("**/*.yaml")))
+    return files
+
+
+def catalog_signature():
+    """
+    Return a description of the installed catalogs
+
+    This is used to decide whether a stored snapshot is still valid: it
+    holds the snapshot format version, the versions of the catalog packages
+    and the size / modification time of each catalog file.
+    """
+    versions = {}
+    for pkg in CATALOG_PACKAGES:
+        try:
+            versions[pkg] = version(pkg)
+        except PackageNotFoundError:
+            versions[pkg] = None
+
+    files = []
+    for pth in _catalog_files():
+        try:
+            stat = pth.stat()
+        except OSError:
+            continue
+        files.append((str(pth), stat.st_size, stat.st_mtime_ns))
+
+    return {
+        "snapshot_version": SNAPSHOT_VERSION,
+        "packages": versions,
+        "files": files,
+    }
+
+
+def build_snapshot(main_cat=None):
+    """
+    Parse the catalog into a snapshot dict
+
+    :param main_cat: the main catalog, as returned by ``mc.setup()``
+
+    :returns: dict with the signature, the catalog-level metadata of each
+              model and the ``Metadata`` object of each model.
+    """
+    all_metas = {m: Metadata().init_from_model(main_cat[m]) for m in main_cat}
+    model_metadata = {m: dict(main_cat[m].metadata) for m in main_cat}
+    # computed after setup(), as that may re-write the compiled catalog files
+    return {
+        "signature": catalog_signature(),
+        "model_metadata": model_metadata,
+        "all_metas": all_metas,
+    }
+
+
+def save_snapshot(snapshot, path=None):
+    """
+    Write a snapshot to disk
+
+    The file is written to a temporary file first and then moved into
+    place, so concurrent readers never see a partial snapshot.
+    """
+    path = Path(snapshot_path if path is None else path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as outfile:
+            pickle.dump(snapshot, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_name, path)
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+        raise
+    return path
+
+
+def load_snapshot(path=None, signature=None):
+    """
+    Load a snapshot from disk
+
+    :param path: the snapshot file -- defaults to ``snapshot_path``
+    :param signature: the expected signature -- defaults to ``catalog_signature()``
+
+    :returns: the snapshot dict, or None if there is no snapshot, or it
+              can't be read, or it is out of date.
+    """
+    path = Path(snapshot_path if path is None else path)
+    if signature is None:
+        signature = catalog_signature()
+    try:
+        with open(path, "rb") as infile:
+            snapshot = pickle.load(infile)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get("signature") != signature:
+        return None
+    return snapshot
+
+
+def make_etag(payload):
+    """ETag (quoted digest) for a bytes payload"""
+    return '"{}"'.format(hashlib.sha1(payload).hexdigest())
+
+
+@dataclasses.dataclass(frozen=True)
+class ModelPayload:
+    """
+    Precomputed responses for one model
+
+    ``pyson`` is shared between callers, so it must not be modified.
+    """
+
+    pyson: dict
+    json: bytes
+    etag: str
+
+    @classmethod
+    def from_metadata(cls, meta):
+        """build the payload of a Metadata object"""
+        pyson = meta.as_pyson()
+        payload = json.dumps(pyson, separators=(",", ":")).encode("utf-8")
+        return cls(pyson=pyson, json=payload, etag=make_etag(payload))
+
+
+class CatalogRegistry:
+    """
+    Lazily built, thread-safe holder of the catalog state
+
+    The snapshot (``all_metas`` etc.) is loaded on first access, and the
+    main catalog is only set up when it is first asked for. Servers that
+    fork workers can call ``warm()`` before forking so the work is shared.
+    """
+
+    def __init__(self, snapshot_path=None):
+        self.snapshot_path = snapshot_path
+        self._lock = threading.RLock()
+        self._main_cat = None
+        self._snapshot = None
+        # structures derived from the snapshot, dropped when it changes
+        self._derived = {}
+
+    @property
+    def main_cat(self):
+        """the main ``model_catalogs`` catalog"""
+        if self._main_cat is None:
+            with self._lock:
+                if self._main_cat is None:
+                    self._main_cat = mc.setup()
+        return self._main_cat
+
+    @property
+    def snapshot(self):
+        """the catalog snapshot dict"""
+        if self._snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self._snapshot = self._load_snapshot()
+        return self._snapshot
+
+    @property
+    def all_metas(self):
+        """dict of model name: ``Metadata`` for every model in the catalog"""
+        return self.snapshot["all_metas"]
+
+    @property
+    def model_metadata(self):
+        """dict of model name: catalog-level metadata dict"""
+        return self.snapshot["model_metadata"]
+
+    def _get_derived(self, name, builder):
+        """return derived state, building it from the snapshot on first use"""
+        try:
+            return self._derived[name]
+        except KeyError:
+            pass
+        with self._lock:
+            if name not in self._derived:
+                self._derived[name] = builder(self.snapshot)
+            return self._derived[name]
+
+    @property
+    def spatial_index(self):
+        """``ModelSpatialIndex`` of all the models in the catalog"""
+        return self._get_derived(
+            "spatial_index",
+            lambda snapshot: ModelSpatialIndex(snapshot["all_metas"].values()),
+        )
+
+    @property
+    def env_masks(self):
+        """
+        array of the environmental parameter bitmask of each model
+
+        In the same order as ``all_metas``.
+        """
+        return self._get_derived(
+            "env_masks",
+            lambda snapshot: np.array(
+                [m.env_mask for m in snapshot["all_metas"].values()], dtype=np.int64
+            ),
+        )
+
+    def _load_snapshot(self, refresh=False):
+        """load the stored snapshot, or build and store a new one"""
+        snapshot = None if refresh else load_snapshot(self.snapshot_path)
+        if snapshot is None:
+            if refresh:
+                self._main_cat = mc.setup()
+            snapshot = build_snapshot(self.main_cat)
+            try:
+                save_snapshot(snapshot, self.snapshot_path)
+            except OSError as err:
+                # a read-only cache just means a slow start next time
+                warnings.warn(f"Could not save catalog snapshot: {err}")
+        return snapshot
+
+    @property
+    def payloads(self):
+        """dict of model name: ``ModelPayload``"""
+        return self._get_derived(
+            "payloads",
+            lambda snapshot: {
+                name: ModelPayload.from_metadata(meta)
+                for name, meta in snapshot["all_metas"].items()
+            },
+        )
+
+    def warm(self, main_catalog=False):
+        """
+        Load the catalog state now, rather than on first use
+
+        :param main_catalog=False: If True, also set up the main catalog,
+                                   which is needed to fetch model data.
+        """
+        self.snapshot
+        self.spatial_index
+        self.env_masks
+        self.payloads
+        if main_catalog:
+            self.main_cat
+        return self
+
+    def refresh(self):
+        """Re-read the catalog and rebuild the stored snapshot"""
+        with self._lock:
+            self._snapshot = self._load_snapshot(refresh=True)
+            self._derived = {}
+            model_fetch.clear_bounds_cache()
+        return self
+
+    def clear(self):
+        """Drop the in-memory state -- it will be reloaded on next use"""
+        with self._lock:
+            self._main_cat = None
+            self._snapshot = None
+            self._derived = {}
+            model_fetch.clear_bounds_cache()
+
+
+registry = CatalogRegistry()
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 """Module for fetching model data from the CLI."""
+import shutil
 import sys
 import warnings
 from typing import List, Tuple, Optional
@@ -8,18 +9,25 @@ from pathlib import Path
 from argparse import ArgumentParser
 
 import pandas as pd
+import shapely
 import xarray as xr
-import requests
 import model_catalogs as mc
 
 from libgoods.model_fetch import (
+    Decimation,
     fetch,
     get_times,
     FetchConfig,
     DEFAULT_STANDARD_NAMES,
     get_bounds,
+    parse_depth,
+    parse_polygon,
     rotate_bbox,
 )
+from libgoods import availability
+from libgoods.batch import load_manifest, run_batch
+from libgoods.status import StatusProber, StatusTarget
+from libgoods.writers import DEFAULT_MEMORY_BUDGET, OutputEncoding, manifest_path, partial_path
 
 # These are just arbitrary boxes selected within the model's domain that demonstrates and offers a
 # simple way to subset model output.
@@ -100,8 +108,7 @@ def print_models():
 
 def show_bounds(model_name: str):
     """Print the model bounds."""
-    main_cat = mc.setup()
-    bbox = ", ".join(f"{i:.2f}" for i in main_cat[model_name].metadata["bounding_box"])
+    bbox = ", ".join(f"{i:.2f}" for i in get_bounds(model_name))
     print(bbox)
 
 
@@ -123,47 +130,40 @@ def show_times(model_name: str):
 
 def show_status_all():
     """Status for all models"""
-    print(f'{"model_name":<20} {"timing":<32} {"status":<6} {"start":<20} end')
     with warnings.catch_warnings():
         warnings.filterwarnings("ignore", category=xr.SerializationWarning)
         main_cat = mc.setup()
-        for model_name in sorted(main_cat):
-            _show_status(main_cat, model_name)
+        _show_status(main_cat, sorted(main_cat))
 
 
 def show_status(model_name: str):
     """Status for model"""
-    print(f'{"model_name":<20} {"timing":<32} {"status":<6} {"start":<20} end')
     with warnings.catch_warnings():
         warnings.filterwarnings("ignore", category=xr.SerializationWarning)
         main_cat = mc.setup()
-        _show_status(main_cat, model_name)
+        _show_status(main_cat, [model_name])
 
 
-def _show_status(main_cat, model_name):
-    """Status for model"""
-    for timing in main_cat[model_name]:
-        urlpath = mc.astype(main_cat[model_name][timing].urlpath, list)[0]
-        resp = requests.get(urlpath + ".das")
-        if resp.status_code != 200:
-            status = False
-        else:
-            status = True
-
-        if status:
-            try:
-                cat = mc.find_availability(main_cat[model_name], timing=timing)
-                start = pd.Timestamp(cat[timing].metadata["start_datetime"])
-                end = pd.Timestamp(cat[timing].metadata["end_datetime"])
-            except Exception:
-                status = False
-                start = ""
-                end = ""
+def _show_status(main_cat, model_names: List[str]):
+    """Status for models, printed as each source's probe completes"""
 
-        else:
-            start = ""
-            end = ""
-        print(f"{model_name:<20} {timing:<32} {str(status):<6} {str(start):<20} {end}")
+    targets = [
+        StatusTarget(
+            model_name, timing, mc.astype(main_cat[model_name][timing].urlpath, list)[0]
+        )
+        for model_name in model_names
+        for timing in main_cat[model_name]
+    ]
+    print(f'{"model_name":<20} {"timing":<32} {"status":<6} {"start":<20} end')
+    prober = StatusProber(availability=availability.cache.get)
+    for result in prober.probe_all(targets):
+        start = "" if result.start is None else result.start
+        end = "" if result.end is None else result.end
+        print(
+            f"{result.model_name:<20} {result.timing:<32} {str(result.online):<6} "
+            f"{str(start):<20} {end}",
+            flush=True,
+        )
 
 
 def parse_config() -> FetchConfig:
@@ -226,6 +226,24 @@ def parse_config() -> FetchConfig:
     parser.add_argument(
         "--surface", action="store_true", default=False, help="Fetch only surface data."
     )
+    parser.add_argument(
+        "--polygon",
+        type=parse_polygon,
+        default=None,
+        help=(
+            "Subset to a polygon, given as lon,lat;lon,lat;... in [-180, 180]. Cells outside it "
+            "are written as fill values. The bbox defaults to the bounds of the polygon."
+        ),
+    )
+    parser.add_argument(
+        "--depth",
+        type=parse_depth,
+        default=None,
+        help=(
+            "Without --surface, the depth (m) of the level to fetch, or a min,max depth range. "
+            "Only for models with z-level vertical coordinates."
+        ),
+    )
     parser.add_argument(
         "-n",
         "--standard-names",
@@ -262,11 +280,133 @@ def parse_config() -> FetchConfig:
         action="store_true",
         help="Show which sources are online for the given model and exit.",
     )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Report the size and shape of the subset without downloading it.",
+    )
+    parser.add_argument(
+        "--max-filesize",
+        type=float,
+        default=None,
+        help="Refuse to download subsets larger than this many MiB (uncompressed).",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=float,
+        default=None,
+        help="Write the output in blocks of time steps, using at most this many MiB of "
+        "memory for data. Completed blocks are checkpointed, so rerunning an "
+        "interrupted fetch resumes it.",
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="Serve repeated requests from the local subset cache.",
+    )
+    parser.add_argument(
+        "--append",
+        action="store_true",
+        help="If the output file exists, fetch only the time steps after its last one "
+        "and append them to it.",
+    )
+    parser.add_argument(
+        "--replace-overlap",
+        action="store_true",
+        help="With --append, also replace the time steps already in the output file "
+        "with the newer forecast cycle.",
+    )
+    parser.add_argument(
+        "--compression",
+        choices=["zlib", "zstd", "none"],
+        default="none",
+        help="Compression of the output variables. The encoding options are "
+        "opt-in: without any of them the output is written with xarray's defaults.",
+    )
+    parser.add_argument(
+        "--complevel", type=int, default=4, help="Compression level."
+    )
+    parser.add_argument(
+        "--no-shuffle",
+        action="store_true",
+        help="Don't apply the HDF5 shuffle filter before compressing.",
+    )
+    parser.add_argument(
+        "--significant-digits",
+        type=int,
+        default=None,
+        help="Keep only this many significant digits of the data (lossy).",
+    )
+    parser.add_argument(
+        "--float32",
+        action="store_true",
+        help="Write double precision data variables as single precision (lossy).",
+    )
+    parser.add_argument(
+        "--time-chunk",
+        type=int,
+        default=None,
+        help="Number of time steps per chunk of the output variables "
+        "(1 if an encoding option is given).",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["netcdf", "zarr"],
+        default="netcdf",
+        help="Output format.",
+    )
+    parser.add_argument(
+        "--no-consolidate",
+        action="store_true",
+        help="Don't write consolidated metadata for Zarr output.",
+    )
+    parser.add_argument(
+        "--xy-stride",
+        type=int,
+        default=1,
+        help="Keep every n-th grid point in each horizontal direction.",
+    )
+    parser.add_argument(
+        "--time-stride",
+        type=int,
+        default=1,
+        help="Keep every n-th time step.",
+    )
+    parser.add_argument(
+        "--xy-resolution",
+        type=float,
+        default=None,
+        help="Target horizontal resolution, in degrees (overrides --xy-stride).",
+    )
+    parser.add_argument(
+        "--time-resolution",
+        type=pd.Timedelta,
+        default=None,
+        help="Target time step, e.g. 3h (overrides --time-stride).",
+    )
+    parser.add_argument(
+        "--batch",
+        type=Path,
+        default=None,
+        help="Run all the fetches listed in a JSON or CSV manifest and exit.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="With --batch, the number of datasets opened or written at once.",
+    )
     args = parser.parse_args()
     if args.list_models:
         print_models()
         sys.exit(0)
 
+    if args.batch is not None:
+        results = run_batch(load_manifest(args.batch), max_workers=args.workers, report=print)
+        n_failed = sum(not result.ok for result in results)
+        print(f"{len(results) - n_failed} of {len(results)} fetches succeeded")
+        sys.exit(1 if n_failed else 0)
+
     if args.show_status:
         if args.model_name:
             show_status(args.model_name)
@@ -297,30 +437,65 @@ def parse_config() -> FetchConfig:
     if start >= end:
         raise ValueError("end time must be greater than start time")
 
-    if args.output.is_dir():
+    suffix = ".zarr" if args.format == "zarr" else ".nc"
+    if args.output.is_dir() and args.output.suffix != ".zarr":
         output_filename = (
-            f"{args.model_name}_{args.timing}_{start:%Y%m%d}-{end:%Y%m%d}.nc"
+            f"{args.model_name}_{args.timing}_{start:%Y%m%d}-{end:%Y%m%d}{suffix}"
         )
         output_pth = args.output / output_filename
     elif args.output.suffix == "":
         args.output.mkdir(parents=True)
         output_filename = (
-            f"{args.model_name}_{args.timing}_{start:%Y%m%d}-{end:%Y%m%d}.nc"
+            f"{args.model_name}_{args.timing}_{start:%Y%m%d}-{end:%Y%m%d}{suffix}"
         )
         output_pth = args.output / output_filename
     else:
         output_pth = args.output
 
-    if output_pth.exists():
-        if args.force:
+    if output_pth.exists() and not args.dry_run and not args.append:
+        if args.force and output_pth.is_dir():
+            shutil.rmtree(output_pth)
+        elif args.force:
             output_pth.unlink()
         else:
             raise FileExistsError(f"{output_pth} already exists")
+    if args.force and not args.dry_run:
+        # start over rather than resume an interrupted fetch
+        for pth in (partial_path(output_pth), manifest_path(output_pth)):
+            if pth.is_dir():
+                shutil.rmtree(pth)
+            elif pth.exists():
+                pth.unlink()
 
     bbox = parse_bbox(args.model_name, args.bbox)
+    if bbox is None and args.polygon is not None:
+        bbox = shapely.Polygon(args.polygon).bounds
     if bbox is not None:
         bbox = rotate_bbox(args.model_name, bbox)
 
+    decimation = Decimation(
+        xy_stride=args.xy_stride,
+        time_stride=args.time_stride,
+        xy_resolution=args.xy_resolution,
+        time_resolution=args.time_resolution,
+    )
+
+    encoding = None
+    if (
+        args.compression != "none"
+        or args.significant_digits is not None
+        or args.float32
+        or args.time_chunk is not None
+    ):
+        encoding = OutputEncoding(
+            compression=None if args.compression == "none" else args.compression,
+            complevel=args.complevel,
+            shuffle=not args.no_shuffle,
+            significant_digits=args.significant_digits,
+            float32=args.float32,
+            time_chunk=1 if args.time_chunk is None else args.time_chunk,
+        )
+
     return FetchConfig(
         model_name=args.model_name,
         output_pth=output_pth,
@@ -330,6 +505,24 @@ def parse_config() -> FetchConfig:
         timing=args.timing,
         standard_names=args.standard_names,
         surface_only=args.surface,
+        max_filesize=(
+            None if args.max_filesize is None else int(args.max_filesize * 1024 * 1024)
+        ),
+        dry_run=args.dry_run,
+        memory_budget=(
+            DEFAULT_MEMORY_BUDGET
+            if args.memory_budget is None
+            else int(args.memory_budget * 1024 * 1024)
+        ),
+        use_cache=args.cache,
+        append=args.append,
+        replace_overlap=args.replace_overlap,
+        encoding=encoding,
+        output_format=args.format,
+        consolidated=not args.no_consolidate,
+        decimation=decimation if decimation.active else None,
+        depth=args.depth,
+        polygon=args.polygon,
     )
 
 
@@ -4,9 +4,9 @@ Base model class
 #!/usr/bin/env python
 from __future__ import print_function
 import numpy as np
-from netCDF4 import Dataset, MFDataset, num2date
+from netCDF4 import Dataset, MFDataset, date2num, num2date
 from libgoods import temp_files_dir
-from ..utilities import polygon2bbox, flatten_bbox
+from ..utilities import polygon2bbox, polygon_points, flatten_bbox
 import datetime
 import os
 
@@ -47,17 +47,19 @@ class nc:
 
         :param: bounds Sequence of (lon,lat) pairs e.g., [(lon,lat),(lon,lat)...]
         """
-        try:
-            bounding_box = flatten_bbox(polygon2bbox(bounds))
-        except ValueError:
-            raise NotImplementedError("Only rectangular bounds are supported")
+        bounding_box = flatten_bbox(polygon2bbox(bounds))
+        # None if the bounds are a rectangle
+        polygon = polygon_points(bounds)
 
         # bounds = [south_lat,west_lon,north_lat,east_lon]
         url = self.url
         var_map = self.var_map
 
         self.get_dimensions(var_map)
-        self.subset(bounding_box)
+        if polygon is None:
+            self.subset(bounding_box)
+        else:
+            self.subset_polygon(polygon)
 
         # until I add time selection this will get a reasonal time slice for latest TBOFS/HYCOM
         tlen = len(self.time)
@@ -69,11 +71,22 @@ class nc:
         fn = self.default_filename
         if target_dir is None:
             target_dir = temp_files_dir
+            temp_files_dir.mkdir(parents=True, exist_ok=True)
         fp = os.path.join(target_dir, fn)
         self.write_nc(var_map, fp, t_index=t_index)
 
         return fp
 
+    def subset_polygon(self, polygon, stride=1):
+        """
+        Subset to the smallest window of the grid around a polygon
+
+        :param polygon: Sequence of (lon,lat) points
+
+        On rectilinear grids that is the window of its bounding box.
+        """
+        self.subset(flatten_bbox(polygon2bbox(polygon)), stride=stride)
+
     def update(self, FileName):
         """
         Change nc Dataset to point to a new nc file or url without reinitializing everything (retain grid info)
@@ -98,17 +111,63 @@ class nc:
         print("Time step: ", dt, "in units of", self.time_units)
         print("Length:", len(self.time))
 
-    def get_timeslice_indices(self, start, end, fmt="%Y-%m-%dT%H:%M:%S"):
+    def get_timeslice_indices(self, start, end, fmt="%Y-%m-%dT%H:%M:%S", nearest=False):
         """
         Start/end are strings in format %Y-%m-%dT%H:%M:%S
         or datetimes
+
+        Returns the indices (t1, t2) of the time steps in [start, end], as a
+        python slice t1:t2. start and end are converted to the numeric time
+        units and searched for in the raw time array, which is assumed to be
+        increasing, so the time axis is never converted to datetimes.
+
+        If nearest is True, the slice goes from the time step nearest to start
+        to the time step nearest to end instead.
         """
-        dts = num2date(self.time, self.time_units)
-        if not isinstance(start, datetime.datetime):
-            start = datetime.datetime.strptime(start, fmt)
-        if not isinstance(end, datetime.datetime):
-            end = datetime.datetime.strptime(end, fmt)
-        t1 = [i for i, dt in enumerate(dts) if dt >= start][0]
-        t2 = [i for i, dt in enumerate(dts) if dt <= end][-1] + 1
+        times = np.asarray(self.time, dtype=np.float64)
+        t_start, t_end = (
+            date2num(_as_datetime(time, fmt), self.time_units) for time in (start, end)
+        )
+        if nearest:
+            t1, t2 = (_nearest_index(times, t) for t in (t_start, t_end))
+            t2 += 1
+        else:
+            t1 = int(np.searchsorted(times, t_start, side="left"))
+            t2 = int(np.searchsorted(times, t_end, side="right"))
+        if t1 >= t2:
+            raise ValueError(f"There are no time steps between {start} and {end}")
 
         return t1, t2
+
+    def get_time_index(self, start, end, stride=1, nearest=False, fmt="%Y-%m-%dT%H:%M:%S"):
+        """
+        The t_index of write_nc ([t1, t2, stride]) for the time steps between
+        start and end, keeping every stride-th one.
+
+        See get_timeslice_indices for start, end, nearest and fmt.
+        """
+        if stride < 1:
+            raise ValueError("stride must be at least 1")
+        t1, t2 = self.get_timeslice_indices(start, end, fmt=fmt, nearest=nearest)
+        return [t1, t2, stride]
+
+
+def _as_datetime(time, fmt):
+    """
+    A datetime from a datetime or a string in format fmt
+    """
+    if isinstance(time, datetime.datetime):
+        return time
+    return datetime.datetime.strptime(time, fmt)
+
+
+def _nearest_index(times, t):
+    """
+    The index of the value of the increasing array times nearest to t
+    """
+    i = int(np.searchsorted(times, t))
+    if i == 0:
+        return 0
+    if i == len(times):
+        return len(times) - 1
+    return i if times[i] - t < t - times[i - 1] else i - 1
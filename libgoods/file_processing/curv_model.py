@@ -5,8 +5,10 @@ variable names can be customized for different models or datasets
 """
 #!/usr/bin/env python
 import numpy as np
+import shapely
 from netCDF4 import Dataset, MFDataset
-from . import base
+from . import base, grid_cache
+from ..utilities import polygon2bbox, flatten_bbox
 
 
 class curv(base.nc):
@@ -29,21 +31,29 @@ class curv(base.nc):
             self.time_dimension = self.Dataset.variables[var_map["time"]].dimensions
 
         if get_xy:
-            if self.GridDataset is not None:
-                self.lon = self.GridDataset.variables[var_map["lon"]][:]
-                self.lat = self.GridDataset.variables[var_map["lat"]][:]
-            else:
-                self.lon = self.Dataset.variables[var_map["lon"]][:]
-                self.lat = self.Dataset.variables[var_map["lat"]][:]
-
-            self.x = [0, self.lon.shape[1]]
-            self.y = [0, self.lat.shape[0]]
-            self.lon = (self.lon > 180).choose(self.lon, self.lon - 360)
+            self.load_grid(var_map["lon"], var_map["lat"], wrap_longitude=True)
 
         if get_z:
             self.depth = self.Dataset.variables[var_map["z"]]
             self.z = [0, self.depth.shape[0]]
 
+    def load_grid(self, lon_name, lat_name, wrap_longitude=False):
+        """
+        Get the lon/lat arrays and the spatial index of the grid
+
+        They come from the local grid cache, so the grid is only read from
+        the (remote) file the first time it is used.
+        """
+        ds = self.GridDataset if self.GridDataset is not None else self.Dataset
+        self.grid_index = grid_cache.cache.get(
+            ds.variables[lon_name], ds.variables[lat_name], wrap_longitude
+        )
+        self.lon = self.grid_index.lon
+        self.lat = self.grid_index.lat
+
+        self.x = [0, self.lon.shape[1]]
+        self.y = [0, self.lat.shape[0]]
+
     def subset(self, bbox, stride=1, dl=False):
         """
 
@@ -52,35 +62,35 @@ class curv(base.nc):
         """
         glat = self.lat
         glon = self.lon
+        index = getattr(self, "grid_index", None)
+        if index is None or index.lon is not glon:
+            # lon/lat were not loaded with load_grid
+            index = self.grid_index = grid_cache.GridIndex.build(
+                np.ma.filled(np.asarray(glon, dtype=float), np.nan),
+                np.ma.filled(np.asarray(glat, dtype=float), np.nan),
+            )
 
         wl = bbox[0]
         el = bbox[2]
         sl = bbox[1]
         nl = bbox[3]
 
-        if (abs(np.nanmax(glat) - nl) < 1e-3) and (
-            abs(np.nanmin(glon) - wl) < 1e-3
-        ):  # original values
+        min_lon, min_lat, max_lon, max_lat = index.extent
+        if (abs(max_lat - nl) < 1e-3) and (abs(min_lon - wl) < 1e-3):  # original values
             self.y = [0, np.size(glat, 0), 1]
             self.x = [0, np.size(glat, 1), 1]
         else:  # do subset
 
             if not dl:
-                # print not dl
-                [yvec, xvec] = np.where(
-                    np.logical_and(
-                        np.logical_and(glat >= sl, glat <= nl),
-                        np.logical_and(glon >= wl, glon <= el),
-                    )
-                )
+                flat = index.query_bbox((wl, sl, el, nl))
             else:
-                [yvec, xvec] = np.where(
-                    np.logical_and(
-                        np.logical_and(glat >= sl, glat <= nl),
-                        np.logical_or(glon >= wl, glon <= el),
-                    )
+                # the bbox crosses the dateline: lon >= wl or lon <= el
+                flat = np.union1d(
+                    index.query_bbox((wl, sl, max(max_lon, wl), nl)),
+                    index.query_bbox((min(min_lon, el), sl, el, nl)),
                 )
                 # self.dlx = 1 #Could do this to make the writing not need the dl flag passed in explicity
+            [yvec, xvec] = np.unravel_index(flat, np.shape(glat))
 
             if len(yvec) > 2 and len(xvec) > 2:
                 y1 = min(yvec)
@@ -93,6 +103,19 @@ class curv(base.nc):
                 self.y = [0, np.size(glat, 0), 1]
                 self.x = [0, np.size(glat, 1), 1]
 
+    def subset_polygon(self, polygon, stride=1):
+        """
+        Subset to the smallest window of the grid around the points in a polygon
+
+        :param polygon: Sequence of (lon,lat) points
+        """
+        self.subset(flatten_bbox(polygon2bbox(polygon)), stride=stride)
+        flat = self.grid_index.query_polygon(shapely.Polygon(polygon))
+        if len(flat) > 2:
+            [yvec, xvec] = np.unravel_index(flat, np.shape(self.lat))
+            self.y = [min(yvec), max(yvec) + 1, stride]
+            self.x = [min(xvec), max(xvec) + 1, stride]
+
     def write_nc(
         self,
         var_map,
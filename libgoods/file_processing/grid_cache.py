@@ -0,0 +1,249 @@
+"""
+A local cache of curvilinear grid geometry, with a spatial index
+
+Reading the lon/lat arrays of a curvilinear grid from OPeNDAP takes a while,
+and finding the cells in a bounding box means scanning the whole grid. The
+arrays are saved once per grid as .npy files, which are memory-mapped when
+used again, along with a cell-bin index: the grid points sorted by the
+regular lon/lat cell (bin) they fall in. A bounding box or polygon query
+then only looks at the points of the bins it overlaps.
+
+A grid is identified by its variable names, shape and a sample of its
+coordinates, so it is shared by all the files (or forecast cycles) that use
+it, and a new grid version gets a new entry.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import shapely
+
+from libgoods import cache_dir
+
+# Bump to invalidate the cached grids when the format changes.
+GRID_CACHE_VERSION = 2
+# Average number of grid points per bin of the index.
+POINTS_PER_BIN = 16
+# About the number of points of each axis read to fingerprint a grid.
+FINGERPRINT_POINTS = 5
+
+
+def _fingerprint(var):
+    """
+    A sample of the values of a 2D netCDF variable, without reading all of it
+
+    The sample is a single uniform-stride slice, so it is one request over
+    OPeNDAP (an index list would be fetched point by point).
+    """
+    ny, nx = var.shape
+    step_y = max(1, (ny - 1) // (FINGERPRINT_POINTS - 1))
+    step_x = max(1, (nx - 1) // (FINGERPRINT_POINTS - 1))
+    sample = np.ma.filled(var[::step_y, ::step_x].astype(float), np.nan)
+    return sample.round(6).tolist()
+
+
+def _attributes(var):
+    """
+    The attributes of a netCDF variable that change its values, as text
+    """
+    names = ("units", "scale_factor", "add_offset", "_FillValue")
+    return {name: repr(var.getncattr(name)) for name in names if name in var.ncattrs()}
+
+
+def grid_key(lon_var, lat_var, wrap_longitude=False):
+    """
+    The cache key of the grid of the netCDF variables lon_var and lat_var
+    """
+    payload = {
+        "version": GRID_CACHE_VERSION,
+        "names": [getattr(lon_var, "name", None), getattr(lat_var, "name", None)],
+        "shape": list(lon_var.shape),
+        "attributes": [_attributes(lon_var), _attributes(lat_var)],
+        "lon": _fingerprint(lon_var),
+        "lat": _fingerprint(lat_var),
+        "wrap_longitude": wrap_longitude,
+    }
+    text = json.dumps(payload, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class GridIndex:
+    """
+    Cell-bin index of the points of a 2D grid
+
+    The points are binned in a regular lon/lat grid of bins. ``order`` holds
+    the flat indices of the points sorted by bin, and the points of bin b are
+    ``order[starts[b]:starts[b + 1]]``. Points with NaN coordinates are left
+    out.
+    """
+
+    def __init__(self, lon, lat, order, starts, extent, nbins):
+        self.lon = lon
+        self.lat = lat
+        self.order = order
+        self.starts = starts
+        # (min_lon, min_lat, max_lon, max_lat) of the valid points
+        self.extent = tuple(extent)
+        # (number of bins in lon, number of bins in lat)
+        self.nbins = tuple(nbins)
+
+    @classmethod
+    def build(cls, lon, lat):
+        """
+        Index the points of the 2D lon and lat arrays
+        """
+        flat_lon = lon.ravel()
+        flat_lat = lat.ravel()
+        valid = np.isfinite(flat_lon) & np.isfinite(flat_lat)
+        if valid.any():
+            extent = (
+                float(flat_lon[valid].min()),
+                float(flat_lat[valid].min()),
+                float(flat_lon[valid].max()),
+                float(flat_lat[valid].max()),
+            )
+        else:
+            extent = (np.nan, np.nan, np.nan, np.nan)
+        nb = max(1, int(np.sqrt(valid.sum() / POINTS_PER_BIN)))
+        nbins = (nb, nb)
+        index = cls(lon, lat, None, None, extent, nbins)
+
+        bins = np.full(flat_lon.shape, -1, dtype=np.int64)
+        bx = index._bin(flat_lon[valid], 0)
+        by = index._bin(flat_lat[valid], 1)
+        bins[valid] = by * nbins[0] + bx
+        order = np.argsort(bins, kind="stable")
+        # the invalid points (bin -1) sort first: skip them
+        order = order[(~valid).sum() :]
+        counts = np.bincount(bins[valid], minlength=nbins[0] * nbins[1])
+        starts = np.concatenate([[0], np.cumsum(counts)])
+        index.order = order
+        index.starts = starts
+        return index
+
+    def _bin(self, values, axis):
+        """
+        The bin numbers of lon (axis 0) or lat (axis 1) values, clipped to the grid
+        """
+        low, high = self.extent[axis], self.extent[axis + 2]
+        n = self.nbins[axis]
+        width = (high - low) / n if high > low else 1.0
+        return np.clip(((np.asarray(values) - low) / width).astype(np.int64), 0, n - 1)
+
+    def candidates(self, bbox):
+        """
+        Flat indices of the points in the bins overlapping bbox
+
+        :param bbox: (min_lon, min_lat, max_lon, max_lat)
+        """
+        wl, sl, el, nl = bbox
+        min_lon, min_lat, max_lon, max_lat = self.extent
+        if not (wl <= max_lon and el >= min_lon and sl <= max_lat and nl >= min_lat):
+            return np.empty(0, dtype=np.int64)
+        bx0, bx1 = self._bin([wl, el], 0)
+        by0, by1 = self._bin([sl, nl], 1)
+        nbx = self.nbins[0]
+        # the bins of a row of bins are contiguous in order
+        chunks = [
+            self.order[self.starts[by * nbx + bx0] : self.starts[by * nbx + bx1 + 1]]
+            for by in range(by0, by1 + 1)
+        ]
+        return np.concatenate(chunks) if chunks else np.empty(0, dtype=np.int64)
+
+    def query_bbox(self, bbox):
+        """
+        Flat indices of the points in bbox, edges included
+
+        :param bbox: (min_lon, min_lat, max_lon, max_lat)
+        """
+        wl, sl, el, nl = bbox
+        cand = self.candidates(bbox)
+        lon = self.lon.ravel()[cand]
+        lat = self.lat.ravel()[cand]
+        return np.sort(cand[(lon >= wl) & (lon <= el) & (lat >= sl) & (lat <= nl)])
+
+    def query_polygon(self, polygon):
+        """
+        Flat indices of the points in a shapely polygon, boundary included
+        """
+        cand = self.candidates(polygon.bounds)
+        lon = self.lon.ravel()[cand]
+        lat = self.lat.ravel()[cand]
+        return np.sort(cand[shapely.intersects_xy(polygon, lon, lat)])
+
+
+class GridCache:
+    """
+    On disk cache of grid geometry and indices
+
+    :param root=None: directory of the cache -- defaults to ``grids`` in the
+                      libgoods cache directory.
+    """
+
+    FILES = ("lon", "lat", "order", "starts")
+
+    def __init__(self, root=None):
+        self.root = Path(root) if root is not None else cache_dir / "grids"
+
+    def path(self, key):
+        """
+        The directory a grid is stored in
+        """
+        return self.root / key
+
+    def load(self, key):
+        """
+        The memory-mapped GridIndex of key, or None if it is not cached
+        """
+        pth = self.path(key)
+        try:
+            with open(pth / "meta.json", "r", encoding="utf-8") as infile:
+                meta = json.load(infile)
+            arrays = {name: np.load(pth / f"{name}.npy", mmap_mode="r") for name in self.FILES}
+        except (OSError, ValueError, KeyError):
+            return None
+        return GridIndex(extent=meta["extent"], nbins=meta["nbins"], **arrays)
+
+    def save(self, key, index):
+        """
+        Write a GridIndex to the cache -- the directory appears complete or not at all
+        """
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=self.root, suffix=".tmp")
+        try:
+            for name in self.FILES:
+                np.save(os.path.join(tmp_dir, f"{name}.npy"), np.asarray(getattr(index, name)))
+            with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as outfile:
+                json.dump({"extent": index.extent, "nbins": index.nbins}, outfile)
+            os.replace(tmp_dir, self.path(key))
+        except OSError:
+            # e.g. saved at the same time by another process
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def get(self, lon_var, lat_var, wrap_longitude=False):
+        """
+        The GridIndex of the grid of the netCDF variables lon_var and lat_var
+
+        The arrays are only read from lon_var and lat_var if the grid is not
+        cached yet.
+
+        :param wrap_longitude=False: bring longitudes > 180 to [-180, 180]
+        """
+        key = grid_key(lon_var, lat_var, wrap_longitude)
+        index = self.load(key)
+        if index is not None:
+            return index
+        lon = np.ma.filled(lon_var[:].astype(float), np.nan)
+        lat = np.ma.filled(lat_var[:].astype(float), np.nan)
+        if wrap_longitude:
+            lon = np.where(lon > 180, lon - 360, lon)
+        index = GridIndex.build(lon, lat)
+        self.save(key, index)
+        return self.load(key) or index
+
+
+cache = GridCache()
@@ -30,15 +30,7 @@ class roms(curv_model.curv):
             self.time_dimension = self.Dataset.variables[tvar].dimensions
 
         if get_xy:
-            if self.GridDataset is not None:
-                self.lon = self.GridDataset.variables["lon_rho"][:]
-                self.lat = self.GridDataset.variables["lat_rho"][:]
-            else:
-                self.lon = self.Dataset.variables["lon_rho"][:]
-                self.lat = self.Dataset.variables["lat_rho"][:]
-
-            self.x = [0, self.lon.shape[1]]
-            self.y = [0, self.lat.shape[0]]
+            self.load_grid("lon_rho", "lat_rho")
 
     def write_nc(
         self,
@@ -32,9 +32,14 @@ Model.subset_info(query_params) => info about subset
 """
 
 import dataclasses
+import re
+import numpy as np
+import pandas as pd
 import shapely.wkt as wkt
+from shapely.geometry import Polygon
 import model_catalogs as mc
 from . import model_fetch  # we could move the utilities used from here into utilities?
+from . import writers
 
 
 # The following is a mapping of 'environmental conditions concepts' to the 'CF concepts' required
@@ -62,6 +67,99 @@ ENVIRONMENTAL_PARAMETERS = {
     ],
 }
 
+# Each environmental parameter is assigned one bit, so the set of parameters a
+# model provides can be stored, and filtered on, as a single integer.
+ENV_PARAM_BITS = {name: 1 << i for i, name in enumerate(ENVIRONMENTAL_PARAMETERS)}
+
+_REQUIRED_STANDARD_NAMES = {
+    name: frozenset(std_names) for name, std_names in ENVIRONMENTAL_PARAMETERS.items()
+}
+
+# mask with every environmental parameter set
+ALL_ENV_PARAMS_MASK = sum(ENV_PARAM_BITS.values())
+
+
+def env_params_mask(env_params):
+    """
+    Compile environmental parameter(s) into a bitmask
+
+    :param env_params: environmental parameter (string) or list / tuple / set of them
+
+    :returns: int with the bit of each parameter set
+    """
+    if isinstance(env_params, str):
+        env_params = [env_params]
+    mask = 0
+    for ev_p in env_params:
+        try:
+            mask |= ENV_PARAM_BITS[ev_p]
+        except KeyError:
+            raise KeyError("{} is not a valid environmental parameter".format(ev_p))
+    return mask
+
+
+def env_params_from_mask(mask):
+    """return the set of environmental parameters in a bitmask"""
+    return {name for name, bit in ENV_PARAM_BITS.items() if mask & bit}
+
+
+def match_env_params_mask(masks, query_mask):
+    """
+    Check which masks provide all the parameters in query_mask
+
+    :param masks: array of environmental parameter bitmasks
+    :param query_mask: bitmask of the required parameters
+
+    :returns: boolean array
+    """
+    masks = np.asarray(masks, dtype=np.int64)
+    return (masks & query_mask) == query_mask
+
+
+_ISO_DATE = re.compile(r"\d{4}-\d{2}-\d{2}(T\d{2}:\d{2}(:\d{2})?)?")
+_RELATIVE_TIME = re.compile(
+    r"(\d+|one|two|three|four|five|six|seven) (hour|day|week|month)s? (before|after|ago)"
+)
+_NUMBER_WORDS = {"one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7}
+_TIME_UNITS = {
+    "hour": pd.Timedelta(hours=1),
+    "day": pd.Timedelta(days=1),
+    "week": pd.Timedelta(days=7),
+    "month": pd.Timedelta(days=31),
+}
+
+
+def parse_time_phrase(text, now=None):
+    """
+    Resolve a catalog start / end description to a time
+
+    The catalogs describe the availability of a source in words, e.g.
+    "7 days before present time", "48 hours after present time",
+    "starting 2015-08-01" or "to 2019-11-27".
+
+    :param text: the description
+    :param now=None: the present time -- defaults to now (UTC, naive)
+
+    :returns: pandas Timestamp, or None if the text can't be interpreted
+    """
+    if now is None:
+        now = pd.Timestamp.now("UTC").tz_localize(None)
+    text = str(text).strip().lower()
+    match = _ISO_DATE.search(text)
+    if match:
+        return pd.Timestamp(match.group(0))
+    match = _RELATIVE_TIME.search(text)
+    if match:
+        count, unit, direction = match.groups()
+        count = _NUMBER_WORDS.get(count) or int(count)
+        offset = count * _TIME_UNITS[unit]
+        return now + offset if direction == "after" else now - offset
+    if "yesterday" in text:
+        return now - pd.Timedelta(days=1)
+    if "present" in text:
+        return now
+    return None
+
 
 @dataclasses.dataclass
 class SourceMetadata:
@@ -77,6 +175,7 @@ class SourceMetadata:
     # dict associating CF name to variable name in data
     # standard_names: dict = dataclasses.field(default_factory=dict)
     env_params: set = dataclasses.field(default_factory=set)
+    env_mask: int = 0  # env_params as a bitmask -- see ENV_PARAM_BITS
 
     def init_from_model_source(self, src):
         # uses a '.(fore/now/hind)cast.metadata dict to populate self
@@ -86,26 +185,46 @@ class SourceMetadata:
         self.start = src.metadata["overall_start_datetime"]
         self.end = src.metadata["overall_end_datetime"]
         # self.standard_names = metadata['standard_names']
-        self.env_params = SourceMetadata.get_env_params(src.metadata)
+        self.env_mask = SourceMetadata.get_env_mask(src.metadata)
+        self.env_params = env_params_from_mask(self.env_mask)
         return self
 
+    def resolve_window(self, now=None):
+        """
+        Return the (start, end) times the source is available
+
+        Either may be None if the catalog description can't be interpreted.
+        """
+        return parse_time_phrase(self.start, now), parse_time_phrase(self.end, now)
+
+    def has_fixed_end(self):
+        """True if the source ends on a given date, rather than relative to now"""
+        return bool(_ISO_DATE.search(str(self.end)))
+
+    @staticmethod
+    def get_env_mask(metadata):
+        """return env parameters as a bitmask"""
+        # param metadata: dict of fore/now/hindcast metadata from catalog
+        standard_names = metadata["standard_names"]
+        mask = 0
+        for name, required in _REQUIRED_STANDARD_NAMES.items():
+            if required.issubset(standard_names):
+                mask |= ENV_PARAM_BITS[name]
+        return mask
+
     @staticmethod
     def get_env_params(metadata):
         """return env parameters"""
         # param metadata: dict of fore/now/hindcast metadata from catalog
-
-        return {
-            k
-            for k, v in ENVIRONMENTAL_PARAMETERS.items()
-            if all([subv in metadata["standard_names"] for subv in v])
-        }
+        return env_params_from_mask(SourceMetadata.get_env_mask(metadata))
 
     def as_pyson(self):
         """
         returns a JSON compatible dict of the data
         """
         dict_ = dataclasses.asdict(self)
-        dict_["env_params"] = list(self.env_params)
+        dict_["env_params"] = sorted(self.env_params)
+        del dict_["env_mask"]
         return dict_
 
 
@@ -125,7 +244,8 @@ class Metadata:
     # timestep_interval: float = "" #'1', '0.5', etc
     # either forecast or hindcast info -- not both
     sources : list = dataclasses.field(default_factory=list)
-    #env_params: set = dataclasses.field(default_factory=set)
+    # parameters provided by all the sources, as a bitmask -- see ENV_PARAM_BITS
+    env_mask: int = 0
     """
     class to hold the core meta data for a data source
 
@@ -156,7 +276,7 @@ class Metadata:
         self.dimensions = m.metadata[grid_dim_keyname]
         # self.timestep_interval = self.get_output_interval(m)
         self.init_source_metadata(m)
-        #self.compute_env_params()
+        self.compute_env_params()
         return self
 
     def init_source_metadata(self, model):
@@ -171,14 +291,18 @@ class Metadata:
 
     def compute_env_params(self):
         """compute env params"""
-        # Computes and sets the list of satisfied environmental parameters
-        # An env param is considered satisfied if ALL of fore/now/hindcast can
+        # Computes and sets the mask of satisfied environmental parameters
+        # An env param is considered satisfied if ALL of the sources can
         # provide that env param.
-        self.env_params = (
-            self.forecast_metadata.env_params
-            & self.nowcast_metadata.env_params
-            & self.hindcast_metadata.env_params
-        )
+        mask = ALL_ENV_PARAMS_MASK if self.sources else 0
+        for src in self.sources:
+            mask &= src.env_mask
+        self.env_mask = mask
+
+    @property
+    def env_params(self):
+        """set of environmental parameters provided by the model"""
+        return env_params_from_mask(self.env_mask)
 
     @staticmethod
     def regional_test(model):
@@ -194,29 +318,115 @@ class Metadata:
         returns a JSON compatible dict of the data
         """
         dict_ = dataclasses.asdict(self)
-        #dict_["env_params"] = list(self.env_params)
+        dict_["env_params"] = sorted(self.env_params)
+        del dict_["env_mask"]
         dict_["sources"] = []
         for s in self.sources:
             dict_["sources"].append(s.as_pyson())
         return dict_
 
 
+def subset_model(
+    ds,  # xarray dataset
+    meta,  # the meta data for this particular model
+    bounds,  # at this pt expects (west, south, east, north) -- west > east crosses the dateline
+    which_data="surface currents",
+    decimation=None,
+    polygon=None,
+):
+    """
+    Subset a model dataset -- this does not read the data
+
+    :param decimation=None: model_fetch.Decimation to lower the resolution of
+                            the subset with -- the strides are part of the
+                            lazy selection, so only the kept points are read.
+
+    :param polygon=None: (lon, lat) points of a polygon within the bounds --
+                         the subset is cut to the smallest window around it,
+                         and the cells outside it are masked.
+
+    :returns: the (lazily loaded) subset xarray dataset
+    """
+    ds = model_fetch.select_surface(ds, meta["identifier"])  # eventually check env params
+    ds_ss = ds.em.filter(ENVIRONMENTAL_PARAMETERS[which_data])
+    wrapped = model_fetch.dateline_bbox(meta["identifier"], bounds)
+    if wrapped is not None:
+        # two slices, on either side of the dateline, stitched together
+        ds_ss = model_fetch.sub_grid_dateline(ds_ss, wrapped)
+    else:
+        bounds = model_fetch.rotate_bbox(meta["identifier"], bounds)
+        ds_ss = ds_ss.em.sub_grid(bbox=bounds)
+    if decimation is not None:
+        ds_ss = decimation.apply(ds_ss)
+    if wrapped is None:
+        # the stitched longitudes are already contiguous
+        ds_ss = model_fetch.rotate_longitude(ds_ss, meta["identifier"])
+    if polygon is not None:
+        polygon = Polygon(polygon)
+        if wrapped is not None:
+            polygon = model_fetch.dateline_polygon(polygon, wrapped)
+        ds_ss = model_fetch.subset_polygon(ds_ss, polygon)
+    return ds_ss
+
+
+def slice_subset(
+    ds,  # xarray dataset of a previously fetched subset
+    bounds,  # at this pt expects (min_lon, min_lat, max_lon, max_lat)
+    start,
+    end,
+    which_data="surface currents",
+):
+    """
+    Slice a smaller subset out of a subset made by subset_model
+
+    The longitudes of the subset have already been rotated to [-180, 180], so
+    the bounds are used as they are.
+
+    :returns: the (lazily loaded) subset xarray dataset
+    """
+    time_dim = writers.get_time_dim(ds)
+    if time_dim is not None:
+        ds = ds.sel({time_dim: slice(pd.Timestamp(start), pd.Timestamp(end))})
+    ds_ss = ds.em.filter(ENVIRONMENTAL_PARAMETERS[which_data])
+    return ds_ss.em.sub_grid(bbox=bounds)
+
+
 def fetch_model(
     ds,  # xarray dataset
     meta,  # the meta data for this particular model
     bounds,  # at this pt expects (min_lon, min_lat, max_lon, max_lat)
     target_pth,
     which_data="surface currents",
+    max_filesize=None,
+    encoding=None,
+    output_format="netcdf",
+    decimation=None,
+    polygon=None,
 ):
+    """
+    Subset a model dataset and write it to target_pth
 
-    ds = model_fetch.select_surface(ds)  # eventually check env params
-    ds_ss = ds.em.filter(ENVIRONMENTAL_PARAMETERS[which_data])
-    bounds = model_fetch.rotate_bbox(meta["identifier"], bounds)
-    ds_ss = ds_ss.em.sub_grid(bbox=bounds)
-    if meta["bounding_box"][2] > 180:
-        ds_ss = model_fetch.rotate_longitude(ds_ss)
+    netCDF data are written in blocks of time steps, which are checkpointed,
+    so if an earlier call for the same subset was interrupted it is resumed.
+
+    :param max_filesize=None: maximum (uncompressed) size of the subset, in
+                              bytes -- if it is larger, a FileTooBigError is
+                              raised before any data are read.
+
+    :param encoding=None: writers.OutputEncoding of the output file -- None
+                          for xarray's defaults.
+
+    :param output_format="netcdf": "netcdf" or "zarr"
+
+    :param decimation=None: model_fetch.Decimation of the subset
+
+    :param polygon=None: (lon, lat) points of a polygon to cut the subset to
+    """
+    ds_ss = subset_model(ds, meta, bounds, which_data, decimation, polygon)
+    model_fetch.check_subset_size(model_fetch.subset_info(ds_ss), max_filesize)
 
-    ds_ss.to_netcdf(target_pth)
+    # netCDF output resumes an interrupted download of the same subset to target_pth
+    writers.write_output(ds_ss, target_pth, output_format, report=None, encoding=encoding)
 
     return target_pth
 
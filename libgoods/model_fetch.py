@@ -1,20 +1,35 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 """A module containing code for fetching content from models."""
+import hashlib
 import time
+import threading
 import warnings
-from typing import List, Tuple, Mapping, Optional
+from typing import Callable, Dict, List, Tuple, Mapping, Optional, Sequence, Union
 from pathlib import Path
-from dataclasses import field, dataclass
+from dataclasses import asdict, field, dataclass, replace
 
 import numpy as np
 import pandas as pd
 import xarray as xr
-import requests
 import model_catalogs as mc
+import shapely
 from extract_model import utils as em_utils
 
+from libgoods import FileTooBigError, availability, subset_cache
 from libgoods.performance import Timer
+from libgoods.status import StatusProber, StatusTarget
+from libgoods.writers import (
+    DEFAULT_MEMORY_BUDGET,
+    NETCDF,
+    ZARR,
+    OutputEncoding,
+    append_dataset,
+    export_cached,
+    get_time_dim,
+    read_times,
+    write_output,
+)
 
 DEFAULT_STANDARD_NAMES = [
     "eastward_sea_water_velocity",
@@ -26,6 +41,114 @@ DEFAULT_STANDARD_NAMES = [
     "sea_floor_depth",
 ]
 
+# Process-wide cache of model bounding boxes, filled from the catalog registry.
+_BOUNDS_CACHE: Dict[str, Tuple[float, float, float, float]] = {}
+_BOUNDS_LOCK = threading.Lock()
+# Whether the longitudes of each model must be rotated to [-180, 180].
+_ROTATION_CACHE: Dict[str, bool] = {}
+# The decoded vertical layout of each (model, grid signature).
+_LAYOUT_CACHE: Dict[Tuple[Optional[str], Tuple], "VerticalLayout"] = {}
+# The polygon masks of the most recently used (grid, polygon) pairs.
+_MASK_CACHE: Dict[Tuple[str, ...], np.ndarray] = {}
+MASK_CACHE_SIZE = 32
+
+# Rough size of zlib-compressed model output relative to the uncompressed size,
+# used to estimate the size of compressed files before they are written.
+ESTIMATED_COMPRESSION_RATIO = 0.4
+
+
+@dataclass(frozen=True)
+class Decimation:
+    """Reduction of the resolution of a subset, for quick looks.
+
+    The strides are applied with ``isel`` on the lazily loaded dataset, before
+    any data are read. Dask fuses them into the slices read from the source,
+    so an OPeNDAP server is sent strided requests and only the kept points
+    cross the network.
+    """
+
+    # keep every n-th point along each horizontal dimension
+    xy_stride: int = 1
+    # keep every n-th time step
+    time_stride: int = 1
+    # target horizontal resolution, in degrees -- overrides xy_stride
+    xy_resolution: Optional[float] = None
+    # target time step -- overrides time_stride
+    time_resolution: Optional[pd.Timedelta] = None
+
+    def __post_init__(self):
+        """Check the options."""
+        if self.xy_stride < 1 or self.time_stride < 1:
+            raise ValueError("strides must be at least 1")
+        if self.time_resolution is not None:
+            object.__setattr__(self, "time_resolution", pd.Timedelta(self.time_resolution))
+
+    @classmethod
+    def create(cls, value) -> Optional["Decimation"]:
+        """Return a Decimation from a Decimation, a dict of its fields, or None."""
+        if value is None or isinstance(value, cls):
+            return value
+        return cls(**value)
+
+    @property
+    def active(self) -> bool:
+        """True if the decimation drops any data."""
+        return (
+            self.xy_stride > 1
+            or self.time_stride > 1
+            or self.xy_resolution is not None
+            or self.time_resolution is not None
+        )
+
+    @property
+    def label(self) -> str:
+        """A short description of the decimation, empty if it is not active."""
+        parts = []
+        if self.xy_resolution is not None:
+            parts.append(f"xy={self.xy_resolution:g}deg")
+        elif self.xy_stride > 1:
+            parts.append(f"xy/{self.xy_stride}")
+        if self.time_resolution is not None:
+            parts.append(f"t={self.time_resolution.isoformat()}")
+        elif self.time_stride > 1:
+            parts.append(f"t/{self.time_stride}")
+        return ",".join(parts)
+
+    def strides(self, ds: xr.Dataset) -> Dict[str, int]:
+        """Return the stride of each dimension of ds to decimate.
+
+        Only the coordinates are used to find the strides for target
+        resolutions, so no bulk data are read.
+        """
+        strides = {}
+        xy_dims = horizontal_dims(ds)
+        if self.xy_resolution is not None or self.xy_stride > 1:
+            if em_utils.guess_model_type(ds) in ("FVCOM", "SELFE"):
+                raise ValueError("Spatial decimation is not supported for unstructured grids")
+            for dim in xy_dims:
+                if self.xy_resolution is None:
+                    strides[dim] = self.xy_stride
+                else:
+                    spacing = grid_spacing(ds, dim)
+                    strides[dim] = max(1, int(round(self.xy_resolution / spacing)))
+        time_dim = get_time_dim(ds)
+        if time_dim is not None:
+            if self.time_resolution is not None:
+                times = pd.DatetimeIndex(ds[time_dim].values)
+                step = pd.Series(times).diff().median() if len(times) > 1 else pd.NaT
+                if pd.notna(step) and step > pd.Timedelta(0):
+                    strides[time_dim] = max(1, int(round(self.time_resolution / step)))
+            elif self.time_stride > 1:
+                strides[time_dim] = self.time_stride
+        return {dim: stride for dim, stride in strides.items() if stride > 1}
+
+    def apply(self, ds: xr.Dataset) -> xr.Dataset:
+        """Return the decimated (lazily loaded) dataset."""
+        if not self.active:
+            return ds
+        strides = self.strides(ds)
+        return ds.isel({dim: slice(None, None, stride) for dim, stride in strides.items()})
+
 
 @dataclass
 class FetchConfig:
@@ -39,63 +162,425 @@ class FetchConfig:
     timing: str
     standard_names: List[str] = field(default_factory=lambda: DEFAULT_STANDARD_NAMES)
     surface_only: bool = False
+    # Refuse to download subsets larger than this (uncompressed bytes).
+    max_filesize: Optional[int] = None
+    # Only report the size and shape of the subset.
+    dry_run: bool = False
+    # The output is written one block of time steps at a time, holding at most
+    # this many bytes of data in memory. Completed blocks are checkpointed, so
+    # rerunning an interrupted fetch resumes it.
+    memory_budget: int = DEFAULT_MEMORY_BUDGET
+    # Serve repeated requests from the local subset cache.
+    use_cache: bool = False
+    # If output_pth exists, only fetch the time steps after its last one and
+    # append them to it.
+    append: bool = False
+    # When appending, also replace the time steps of output_pth that the newer
+    # data have (e.g. from a newer forecast cycle).
+    replace_overlap: bool = False
+    # Compression and chunking of the output; None for xarray's defaults.
+    # When appending, the settings of the existing file are used.
+    encoding: Optional[OutputEncoding] = None
+    # "netcdf" or "zarr"
+    output_format: str = NETCDF
+    # Write consolidated metadata for Zarr output.
+    consolidated: bool = True
+    # Lower the resolution, for quick looks.
+    decimation: Optional[Decimation] = None
+    # For 3D requests, a depth (m, positive down) or (min, max) depth range to
+    # keep, on models with z-level vertical coordinates.
+    depth: Optional[Union[float, Tuple[float, float]]] = None
+    # (lon, lat) vertices of a polygon to subset to, in [-180, 180]: the grid
+    # is cut to the polygon and the cells outside it are written as fill
+    # values. The bbox defaults to the bounds of the polygon.
+    polygon: Optional[List[Tuple[float, float]]] = None
 
+    def __post_init__(self):
+        """Default the bbox to the bounds of the polygon."""
+        if self.polygon is not None and self.bbox is None:
+            self.bbox = shapely.Polygon(self.polygon).bounds
 
-def select_surface(ds: xr.Dataset) -> xr.Dataset:
-    """Return a dataset that is reduced to only the surface layer."""
+
+@dataclass
+class VariableInfo:
+    """Size and shape of a variable in a subset."""
+
+    name: str
+    dims: Tuple[str, ...]
+    shape: Tuple[int, ...]
+    dtype: str
+    nbytes: int
+
+
+@dataclass
+class SubsetInfo:
+    """Size and shape of a subset, found before any bulk data are read."""
+
+    variables: List[VariableInfo]
+    n_times: int
+    nbytes: int
+    estimated_compressed_nbytes: int
+
+    def as_pyson(self) -> dict:
+        """Return a JSON compatible dict of the info."""
+        return {
+            "variables": [
+                {
+                    "name": v.name,
+                    "dims": list(v.dims),
+                    "shape": list(v.shape),
+                    "dtype": v.dtype,
+                    "nbytes": v.nbytes,
+                }
+                for v in self.variables
+            ],
+            "n_times": self.n_times,
+            "nbytes": self.nbytes,
+            "estimated_compressed_nbytes": self.estimated_compressed_nbytes,
+        }
+
+    def summary(self) -> str:
+        """Return a human readable description of the subset."""
+        lines = [
+            f"{v.name:<32} {str(v.dims):<48} {v.dtype:<8} {v.nbytes / 1024 / 1024:10.2f} MiB"
+            for v in self.variables
+        ]
+        lines.append(f"Time steps: {self.n_times}")
+        lines.append(
+            f"Estimated size of uncompressed dataset: {self.nbytes / 1024 / 1024:.2f} MiB"
+        )
+        lines.append(
+            "Estimated size of compressed dataset: "
+            f"{self.estimated_compressed_nbytes / 1024 / 1024:.2f} MiB"
+        )
+        return "\n".join(lines)
+
+
+@dataclass(frozen=True)
+class VerticalLayout:
+    """The decoded vertical coordinates of a model grid."""
+
+    # "SELFE", "FVCOM", or None for the models decoded with cf_xarray
+    family: Optional[str]
+    # index of the surface along each vertical dimension
+    surface: Dict[str, int]
+    # number of levels along each vertical dimension
+    sizes: Dict[str, int]
+    # depth of each level (m, positive down) of the z-level dimensions --
+    # sigma dimensions have no fixed depths
+    levels: Dict[str, Tuple[float, ...]] = field(default_factory=dict)
+
+    @property
+    def upward(self) -> Dict[str, bool]:
+        """Whether the index of each vertical dimension increases towards the surface."""
+        return {
+            dim: size > 1 and self.surface[dim] == size - 1 for dim, size in self.sizes.items()
+        }
+
+    def surface_isel(self) -> Dict[str, int]:
+        """The isel arguments selecting the surface layer."""
+        return dict(self.surface)
+
+    def depth_isel(self, depth: Union[float, Tuple[float, float]]) -> Dict[str, Union[int, slice]]:
+        """The isel arguments selecting a depth level or a depth range.
+
+        Parameters
+        ----------
+        depth : float or (float, float)
+            Depth in m, positive down: the nearest level is selected. For a
+            (min, max) range, all the levels within it are.
+        """
+        if not self.levels:
+            raise ValueError("Depth selection needs z-level vertical coordinates.")
+        isel = {}
+        for dim, levels in self.levels.items():
+            levels = np.asarray(levels)
+            if np.ndim(depth) == 0:
+                isel[dim] = int(np.argmin(np.abs(levels - depth)))
+                continue
+            low, high = sorted(depth)
+            inside = np.flatnonzero((levels >= low) & (levels <= high))
+            if len(inside) == 0:
+                raise ValueError(f"There are no levels between {low} and {high} m.")
+            isel[dim] = slice(int(inside[0]), int(inside[-1]) + 1)
+        return isel
+
+
+def parse_depth(value) -> Union[float, Tuple[float, float]]:
+    """Return a depth, or a (min, max) depth range, from a string like "10" or "0,50"."""
+    if isinstance(value, str):
+        value = [v for v in value.replace(";", ",").split(",") if v.strip()]
+    if np.ndim(value) == 0:
+        return float(value)
+    if len(value) == 1:
+        return float(value[0])
+    if len(value) != 2:
+        raise ValueError("depth should be a depth, or a min,max depth range")
+    return (float(value[0]), float(value[1]))
+
+
+def parse_polygon(value) -> List[Tuple[float, float]]:
+    """Return the (lon, lat) vertices of a polygon from a string like "lon,lat;lon,lat;...".
+
+    A sequence of (lon, lat) pairs is also accepted.
+    """
+    if isinstance(value, str):
+        value = [point.split(",") for point in value.split(";") if point.strip()]
+    points = [(float(lon), float(lat)) for lon, lat in value]
+    if len(points) < 3:
+        raise ValueError("polygon should have at least three lon,lat points")
+    return points
+
+
+def grid_signature(ds: xr.Dataset) -> Tuple[Tuple[str, int], ...]:
+    """Return the sizes of the dimensions of ds, except the time dimensions."""
+    return tuple(
+        sorted((str(dim), size) for dim, size in ds.sizes.items() if "time" not in str(dim).lower())
+    )
+
+
+def _is_sigma(var: xr.DataArray) -> bool:
+    """Return True if var is a sigma (terrain following) vertical coordinate."""
+    standard_name = var.attrs.get("standard_name", "")
+    return "formula_terms" in var.attrs or "ocean_s" in standard_name or "sigma" in standard_name
+
+
+def decode_vertical_layout(ds: xr.Dataset) -> VerticalLayout:
+    """Decode the vertical coordinates of ds."""
     model_guess = em_utils.guess_model_type(ds)
     # SELFE uses a hybrid sigma coordinate system for the vertical coordinates,
     # but cf_xarray misinterprets it as being the z variable. So, we check SELFE
     # first, before trying to use cf_xarray
     if model_guess == "SELFE":
-        return ds.isel(nv=-1)
-    elif model_guess == "FVCOM":
-        vertical_dims = set()
-        for varname in ds.cf.axes["Z"]:
-            vertical_dim = ds[varname].dims[0]
-            vertical_dims.add(vertical_dim)
-        sel_kwargs = {vdim: 0 for vdim in vertical_dims}
-        return ds.isel(**sel_kwargs)
-    elif all([ds[zaxis].ndim < 2 for zaxis in ds.cf.axes["Z"]]):
-        return ds.cf.sel(Z=0, method="nearest")
+        return VerticalLayout("SELFE", {"nv": ds.sizes["nv"] - 1}, {"nv": ds.sizes["nv"]})
+    zaxes = [ds[varname] for varname in ds.cf.axes.get("Z", [])]
+    if model_guess == "FVCOM":
+        vertical_dims = {zaxis.dims[0] for zaxis in zaxes}
+        return VerticalLayout(
+            "FVCOM",
+            {vdim: 0 for vdim in vertical_dims},
+            {vdim: ds.sizes[vdim] for vdim in vertical_dims},
+        )
+    if all([zaxis.ndim < 2 for zaxis in zaxes]):
+        surface, sizes, levels = {}, {}, {}
+        for zaxis in zaxes:
+            if zaxis.ndim == 0:
+                continue
+            dim = zaxis.dims[0]
+            values = zaxis.to_numpy().astype(float)
+            # the level nearest 0
+            surface[dim] = int(np.nanargmin(np.abs(values)))
+            sizes[dim] = zaxis.size
+            if not _is_sigma(zaxis):
+                depths = -values if zaxis.attrs.get("positive", "down") == "up" else values
+                levels[dim] = tuple(depths.tolist())
+        return VerticalLayout(None, surface, sizes, levels)
     raise ValueError("Can't decode vertical coordinates.")
 
 
+def vertical_layout(ds: xr.Dataset, model_name: Optional[str] = None) -> VerticalLayout:
+    """Return the vertical layout of ds, decoded once per model and grid signature."""
+    key = (model_name, grid_signature(ds))
+    try:
+        return _LAYOUT_CACHE[key]
+    except KeyError:
+        pass
+    layout = _LAYOUT_CACHE[key] = decode_vertical_layout(ds)
+    return layout
+
+
+def select_surface(ds: xr.Dataset, model_name: Optional[str] = None) -> xr.Dataset:
+    """Return a dataset that is reduced to only the surface layer."""
+    return ds.isel(vertical_layout(ds, model_name).surface_isel())
+
+
+def select_depth(
+    ds: xr.Dataset, depth: Union[float, Tuple[float, float]], model_name: Optional[str] = None
+) -> xr.Dataset:
+    """Return a dataset reduced to a depth level, or a (min, max) depth range, in m."""
+    return ds.isel(vertical_layout(ds, model_name).depth_isel(depth))
+
+
 def get_times(model_name: str) -> Mapping[str, pd.Timestamp]:
-    """Return a mapping of a source to the start and end datetimes."""
-    main_cat = mc.setup()
-    cat = mc.find_availability(main_cat[model_name])
-    timing_date_map = {}
-    for timing in cat:
-        timing_date_map[timing] = (
-            pd.Timestamp(cat[timing].metadata["start_datetime"]),
-            pd.Timestamp(cat[timing].metadata["end_datetime"]),
-        )
-    return timing_date_map
+    """Return a mapping of a source to the start and end datetimes.
+
+    The times are served from the availability cache, and only looked up
+    remotely when the cached entry for the model has expired.
+    """
+    return availability.cache.get_times(model_name)
 
 
 def get_source_online_status(model_name: str) -> Mapping[str, bool]:
     """Return a mapping of source to a boolean indicating if the source is available."""
     yesterday = pd.Timestamp.today() - pd.Timedelta("1 day")
     main_cat = mc.setup()
-    statuses = {}
+    targets = []
     for timing in main_cat[model_name]:
         main_cat[model_name][timing]._pick()
         urlpath = main_cat[model_name][timing]._source(yesterday=yesterday).urlpath
         if isinstance(urlpath, list):
             urlpath = urlpath[0]
-        resp = requests.get(urlpath + ".das")
-        if resp.status_code != 200:
-            statuses[timing] = False
-        else:
-            statuses[timing] = True
-    return statuses
+        targets.append(StatusTarget(model_name, timing, urlpath))
+    return {
+        result.timing: result.online for result in StatusProber().probe_all(targets)
+    }
 
 
 def get_bounds(model_name: str) -> Tuple[float, float, float, float]:
-    """Returns the geospatial extents for the model."""
-    main_cat = mc.setup()
-    return main_cat[model_name].metadata["bounding_box"]
+    """Returns the geospatial extents for the model.
+
+    The bounds of every model are read once from the already-loaded catalog
+    registry and kept for the life of the process.
+    """
+    try:
+        return _BOUNDS_CACHE[model_name]
+    except KeyError:
+        pass
+    # imported here as libgoods.catalog imports this module (through libgoods.model)
+    from libgoods.catalog import registry
+
+    with _BOUNDS_LOCK:
+        if not _BOUNDS_CACHE:
+            _BOUNDS_CACHE.update(
+                {
+                    name: tuple(metadata["bounding_box"])
+                    for name, metadata in registry.model_metadata.items()
+                }
+            )
+    return _BOUNDS_CACHE[model_name]
+
+
+def clear_bounds_cache():
+    """Empty the model bounds cache, e.g. after the catalog is refreshed."""
+    with _BOUNDS_LOCK:
+        _BOUNDS_CACHE.clear()
+        _ROTATION_CACHE.clear()
+
+
+def uses_360_longitude(model_name: str) -> bool:
+    """Return True if the model longitudes are in [0, 360] rather than [-180, 180]."""
+    return get_bounds(model_name)[2] > 180
+
+
+def _lon_lat_variables(ds: xr.Dataset) -> List[xr.Variable]:
+    """Return the longitude and latitude variables of ds."""
+    return [
+        var
+        for var in ds.variables.values()
+        if var.attrs.get("standard_name") in ("longitude", "latitude")
+    ]
+
+
+def horizontal_dims(ds: xr.Dataset) -> List[str]:
+    """Return the dimensions of the longitude and latitude variables of ds."""
+    dims = []
+    for var in _lon_lat_variables(ds):
+        dims += [dim for dim in var.dims if dim not in dims]
+    return dims
+
+
+def grid_spacing(ds: xr.Dataset, dim: str) -> float:
+    """Return the median spacing of the grid along dim, in degrees."""
+    steps = [
+        np.abs(np.diff(np.asarray(var.values, dtype=float), axis=var.dims.index(dim))).ravel()
+        for var in _lon_lat_variables(ds)
+        if dim in var.dims and var.sizes[dim] > 1
+    ]
+    if not steps:
+        return np.nan
+    if len(steps) == 2 and steps[0].shape == steps[1].shape:
+        # lon and lat both vary along dim on rotated (curvilinear) grids
+        return float(np.nanmedian(np.hypot(steps[0], steps[1])))
+    return float(np.nanmedian(np.concatenate(steps)))
+
+
+def lon_lat_grids(ds: xr.Dataset) -> List[Tuple[str, str]]:
+    """Return the (longitude, latitude) variable names of each horizontal grid of ds.
+
+    Staggered grids (e.g. ROMS rho, u and v points) have one pair each.
+    """
+    lons = [var for var in ds.variables if ds[var].attrs.get("standard_name") == "longitude"]
+    lats = [var for var in ds.variables if ds[var].attrs.get("standard_name") == "latitude"]
+    grids = []
+    for lon in lons:
+        if ds[lon].ndim == 2:
+            grids += [(lon, lat) for lat in lats if ds[lat].dims == ds[lon].dims][:1]
+        elif ds[lon].ndim == 1:
+            grids += [
+                (lon, lat) for lat in lats if ds[lat].ndim == 1 and ds[lat].dims != ds[lon].dims
+            ][:1]
+    return grids
+
+
+def polygon_mask(ds: xr.Dataset, polygon, lon: str, lat: str) -> xr.DataArray:
+    """Return the mask of the points of the (lon, lat) grid of ds in polygon.
+
+    Points on the boundary of the polygon are in. The masks are cached per
+    grid (its coordinate values) and polygon, so repeated requests for the
+    same area skip the point-in-polygon test.
+    """
+    lon_da = xr.DataArray(ds[lon].values, dims=ds[lon].dims)
+    lat_da = xr.DataArray(ds[lat].values, dims=ds[lat].dims)
+    lon_da, lat_da = xr.broadcast(lon_da, lat_da)
+    digest = hashlib.sha256()
+    for da in (lon_da, lat_da):
+        digest.update(str(da.dims).encode("utf-8"))
+        digest.update(np.ascontiguousarray(da.values, dtype=np.float64).tobytes())
+    key = (digest.hexdigest(), shapely.to_wkb(polygon, hex=True))
+    mask = _MASK_CACHE.pop(key, None)
+    if mask is None:
+        mask = shapely.intersects_xy(polygon, lon_da.values, lat_da.values)
+    _MASK_CACHE[key] = mask
+    while len(_MASK_CACHE) > MASK_CACHE_SIZE:
+        # the least recently used
+        del _MASK_CACHE[next(iter(_MASK_CACHE))]
+    return xr.DataArray(mask, dims=lon_da.dims)
+
+
+def subset_polygon(ds: xr.Dataset, polygon, trim: bool = True, mask: bool = True) -> xr.Dataset:
+    """Return the (lazily loaded) subset of ds in a shapely polygon.
+
+    Parameters
+    ----------
+    trim : bool
+        Cut the rows and columns that are all outside the polygon off the
+        edges of the grid, leaving the smallest window around it. Only done
+        for datasets with a single horizontal grid, so staggered grids stay
+        aligned.
+    mask : bool
+        Replace the values of the cells outside the polygon with NaN, which
+        is written as the fill value and compresses well.
+    """
+    if em_utils.guess_model_type(ds) in ("FVCOM", "SELFE"):
+        raise ValueError("Polygon subsetting is not supported for unstructured grids")
+    grids = lon_lat_grids(ds)
+    masks = [polygon_mask(ds, polygon, lon, lat) for lon, lat in grids]
+    if not any(inside.any() for inside in masks):
+        raise ValueError("There are no grid points in the polygon.")
+
+    if trim and len(masks) == 1:
+        inside = masks[0]
+        window = {}
+        for dim in inside.dims:
+            others = [other for other in inside.dims if other != dim]
+            kept = np.flatnonzero(inside.any(others).values)
+            window[dim] = slice(int(kept[0]), int(kept[-1]) + 1)
+        ds = ds.isel(window)
+        masks = [inside.isel(window)]
+
+    if mask:
+        masked = {}
+        for name, var in ds.data_vars.items():
+            if var.dtype.kind != "f":
+                continue
+            for inside in masks:
+                if set(inside.dims) <= set(var.dims):
+                    masked[name] = var.where(inside)
+                    masked[name].attrs = var.attrs
+                    masked[name].encoding = var.encoding
+                    break
+        ds = ds.assign(masked)
+    return ds
 
 
 def is_monotonic(data: np.array) -> bool:
@@ -110,26 +595,53 @@ def is_coordinate_variable(ds: xr.Dataset, varname: str) -> bool:
     return ds[varname].dims == (varname,)
 
 
-def rotate_longitude(ds: xr.Dataset) -> xr.Dataset:
-    """Returns a dataset in which the longitude coordinate is rotated to [-180, 180] values."""
+def needs_rotation(model_name: str) -> bool:
+    """Return True if the longitudes of the model must be rotated to [-180, 180].
+
+    The flag is worked out once per model and kept for the life of the process.
+    """
+    try:
+        return _ROTATION_CACHE[model_name]
+    except KeyError:
+        pass
+    flag = _ROTATION_CACHE[model_name] = uses_360_longitude(model_name)
+    return flag
+
+
+def rotate_longitude(ds: xr.Dataset, model_name: Optional[str] = None) -> xr.Dataset:
+    """Returns a dataset in which the longitude coordinate is rotated to [-180, 180] values.
+
+    The rotation is lazy: longitude variables that are not in memory (e.g. the
+    2D longitudes of a curvilinear grid) are rotated chunk by chunk by dask
+    when the data are written. Only 1D coordinate variables, which are always
+    in memory, are checked for monotonicity.
+
+    If model_name is given, the dataset is returned as is when the model
+    doesn't need rotating (see `needs_rotation`).
+    """
+    if model_name is not None and not needs_rotation(model_name):
+        return ds
     new_vars = {}
-    for varname in ds.filter_by_attrs(standard_name="longitude").variables:
-        if "standard_name" not in ds[varname].attrs:
-            continue
-        if ds[varname].attrs["standard_name"] != "longitude":
+    for varname, var in ds.variables.items():
+        if var.attrs.get("standard_name") != "longitude":
             continue
-        lon_data = ds[varname][:].to_numpy()
-        rotated_data = np.copy(lon_data)
-        rotated_data[rotated_data > 180] -= 360
-        if is_coordinate_variable(ds, varname) and not is_monotonic(rotated_data):
-            warnings.warn(
-                "Longitude can not be rotated because the rotated data are not monotonic."
-            )
+        lon = ds[varname]
+        if is_coordinate_variable(ds, varname):
+            rotated_data = lon.to_numpy().copy()
+            rotated_data[rotated_data > 180] -= 360
+            if not is_monotonic(rotated_data):
+                warnings.warn(
+                    "Longitude can not be rotated because the rotated data are not monotonic."
+                )
+                continue
+            rotated = xr.DataArray(rotated_data, dims=lon.dims, attrs=lon.attrs)
         else:
-            xvar = xr.DataArray(
-                rotated_data, dims=ds[varname].dims, attrs=ds[varname].attrs
-            )
-            new_vars[varname] = xvar
+            if lon.chunks is None:
+                # wrap the lazily indexed backend array rather than loading it
+                lon = lon.chunk()
+            rotated = lon.where(lon <= 180, lon - 360)
+            rotated = xr.DataArray(rotated.data, dims=lon.dims, attrs=lon.attrs)
+        new_vars[varname] = rotated
     if len(new_vars) > 0:
         ds = ds.assign(new_vars)
     return ds
@@ -153,6 +665,163 @@ def rotate_bbox(model_name: str, bbox: em_utils.BBoxType) -> em_utils.BBoxType:
     return bbox
 
 
+def dateline_bbox(
+    model_name: str, bbox: em_utils.BBoxType
+) -> Optional[em_utils.BBoxType]:
+    """Return bbox in the model longitudes if it crosses their seam, else None.
+
+    The seam is the antimeridian for models in [-180, 180] and the prime
+    meridian for models in [0, 360]. A bbox crosses the antimeridian if its
+    west edge is east of its east edge (e.g. 170 to -170), or if its east
+    edge is past 180. The returned bbox has west > east: the subset is made of
+    the model longitudes >= west and <= east (see `sub_grid_dateline`).
+    """
+    west, south, east, north = bbox
+    if west > east:
+        east += 360
+    if east - west >= 360:
+        return None
+    lon0 = 0.0 if uses_360_longitude(model_name) else -180.0
+    model_west = (west - lon0) % 360 + lon0
+    model_east = model_west + (east - west)
+    if model_east <= lon0 + 360:
+        # contiguous in the model longitudes
+        return None
+    return (model_west, south, model_east - 360, north)
+
+
+def sub_grid_dateline(ds: xr.Dataset, bbox: em_utils.BBoxType) -> xr.Dataset:
+    """Return the (lazily loaded) subset of ds in a bbox that wraps around its longitudes.
+
+    The parts of the grid west of the seam (longitudes >= bbox[0]) and east
+    of it (longitudes <= bbox[2]) are two minimal slices of the source, which
+    are stitched into one contiguous longitude axis: from bbox[0] to
+    bbox[2] + 360, or shifted by -360 into [-180, 180] when that is possible.
+
+    Only rectilinear grids (1D longitude and latitude) are supported.
+    """
+    west, south, east, north = bbox
+    grids = lon_lat_grids(ds)
+    if len(grids) != 1 or ds[grids[0][0]].ndim != 1:
+        raise ValueError("Dateline-crossing subsets need a rectilinear grid.")
+    lon_name, lat_name = grids[0]
+    lon = ds[lon_name].to_numpy()
+    lat = ds[lat_name].to_numpy()
+    x_dim, y_dim = ds[lon_name].dims[0], ds[lat_name].dims[0]
+    west_cols = np.flatnonzero(lon >= west)
+    east_cols = np.flatnonzero(lon <= east)
+    rows = np.flatnonzero((lat >= south) & (lat <= north))
+    if len(rows) == 0 or len(west_cols) + len(east_cols) == 0:
+        raise ValueError("Subsetting produced no valid data to write to disk.")
+
+    rows = slice(int(rows[0]), int(rows[-1]) + 1)
+    parts = []
+    for cols, shift in ((west_cols, 0), (east_cols, 360)):
+        if len(cols) == 0:
+            continue
+        part = ds.isel({x_dim: slice(int(cols[0]), int(cols[-1]) + 1), y_dim: rows})
+        parts.append(part.assign_coords({lon_name: part[lon_name] + shift}))
+    ds_ss = xr.concat(parts, dim=x_dim, data_vars="minimal", coords="minimal", compat="override")
+    if ds_ss[lon_name].min() >= 180:
+        ds_ss = ds_ss.assign_coords({lon_name: ds_ss[lon_name] - 360})
+    ds_ss[lon_name].attrs = ds[lon_name].attrs
+    return ds_ss
+
+
+def dateline_polygon(polygon, bbox: em_utils.BBoxType):
+    """Return a shapely polygon with the longitudes of the subset of a wrapped bbox.
+
+    bbox is as returned by `dateline_bbox`. The vertices are moved by
+    multiples of 360 to within 180 degrees of the middle of the stitched
+    longitudes of `sub_grid_dateline`, so e.g. a polygon from 170 to -170
+    becomes one from 170 to 190, on the same side of the dateline.
+    """
+    west, _, east, _ = bbox
+    east += 360
+    if west >= 180:
+        west, east = west - 360, east - 360
+    lon0 = (west + east) / 2 - 180
+    coords = shapely.get_coordinates(polygon)
+    coords[:, 0] = (coords[:, 0] - lon0) % 360 + lon0
+    return shapely.Polygon(coords)
+
+
+def rotate_bboxes(
+    model_names: Union[str, Sequence[str]], bboxes: Sequence[em_utils.BBoxType]
+) -> np.ndarray:
+    """Vectorized form of `rotate_bbox` for many bounding boxes.
+
+    Parameters
+    ----------
+    model_names : str or sequence of str
+        The model name(s). A single name applies to all the bounding boxes,
+        otherwise there must be one name per bounding box.
+    bboxes : sequence of bounding boxes
+        (lon_min, lat_min, lon_max, lat_max) for each request. A single
+        bounding box is checked against each model.
+
+    Returns
+    -------
+    np.ndarray
+        (N, 4) array of the bounding boxes, shifted into each model's domain
+        where required.
+    """
+    if isinstance(model_names, str):
+        model_names = [model_names]
+    model_west = np.array([get_bounds(name)[0] for name in model_names], dtype=float)
+    bboxes = np.asarray(bboxes, dtype=float).reshape(-1, 4)
+    model_west, bboxes = np.broadcast_arrays(model_west[:, np.newaxis], bboxes)
+    bboxes = bboxes.copy()
+    shift = bboxes[:, 2] < model_west[:, 0]
+    for col in (0, 2):
+        rows = shift & (bboxes[:, col] < 0)
+        bboxes[rows, col] += 360
+    return bboxes
+
+
+def subset_info(
+    ds: xr.Dataset, compression_ratio: float = ESTIMATED_COMPRESSION_RATIO
+) -> SubsetInfo:
+    """Return the size and shape of a lazily loaded subset.
+
+    Only the shapes and dtypes of the variables are used, so no data are read.
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        The subset, before it is written to disk.
+    compression_ratio : float
+        Estimated ratio of the compressed to the uncompressed size.
+    """
+    variables = [
+        VariableInfo(
+            name=str(name),
+            dims=tuple(str(d) for d in var.dims),
+            shape=tuple(int(n) for n in var.shape),
+            dtype=str(var.dtype),
+            nbytes=int(var.nbytes),
+        )
+        for name, var in ds.variables.items()
+    ]
+    nbytes = sum(v.nbytes for v in variables)
+    time_dim = get_time_dim(ds)
+    return SubsetInfo(
+        variables=variables,
+        n_times=int(ds.sizes[time_dim]) if time_dim is not None else 0,
+        nbytes=nbytes,
+        estimated_compressed_nbytes=int(nbytes * compression_ratio),
+    )
+
+
+def check_subset_size(info: SubsetInfo, max_filesize: Optional[int]):
+    """Raise a FileTooBigError if the subset is larger than max_filesize bytes."""
+    if max_filesize is not None and info.nbytes > max_filesize:
+        raise FileTooBigError(
+            f"Subset would be {info.nbytes / 1024 / 1024:.2f} MiB, "
+            f"larger than the maximum of {max_filesize / 1024 / 1024:.2f} MiB"
+        )
+
+
 def _check_axis(ds: xr.Dataset, axis: str) -> bool:
     """Return true if the axis has a size greater than 1."""
     if axis not in ds.cf.axes:
@@ -173,54 +842,289 @@ def has_horizontal_data(ds: xr.Dataset) -> bool:
     return False
 
 
-def fetch(fetch_config: FetchConfig):
-    """Downloads and subsets the model data.
+def fetch_request_key(fetch_config: FetchConfig) -> str:
+    """Return the subset cache key of a fetch request."""
+    return subset_cache.request_key(
+        model_name=fetch_config.model_name,
+        timing=fetch_config.timing,
+        start=pd.Timestamp(fetch_config.start),
+        end=pd.Timestamp(fetch_config.end),
+        bbox=fetch_config.bbox,
+        standard_names=set(fetch_config.standard_names),
+        surface_only=fetch_config.surface_only,
+        encoding=None if fetch_config.encoding is None else asdict(fetch_config.encoding),
+        decimation=None if fetch_config.decimation is None else asdict(fetch_config.decimation),
+        depth=fetch_config.depth,
+        polygon=fetch_config.polygon,
+    )
+
+
+def _report(report: Optional[Callable[[str], None]], text: str):
+    """Call report with a line of text, unless it is None."""
+    if report is not None:
+        report(text)
+
+
+def _timer(msg: str, report: Optional[Callable[[str], None]]) -> Timer:
+    """A Timer that reports msg with the elapsed time, unless report is None."""
+    return Timer(msg if report is not None else None, output=report)
+
+
+def open_source(
+    model_name: str,
+    timing: str,
+    start: pd.Timestamp,
+    end: pd.Timestamp,
+    main_cat=None,
+    report: Optional[Callable[[str], None]] = print,
+) -> xr.Dataset:
+    """Return the lazily loaded dataset of a model source for a time window.
 
     Parameters
     ----------
-    fetch_config : FetchConfig
-        The configuration object which contains the model name, timing, start/end dates of the
-        request, etc.
+    main_cat : intake catalog, optional
+        The main catalog, from ``mc.setup()``. It is set up if not given.
+    report : callable, optional
+        Called with a line of text for each step. None for silence.
     """
-    print("Setting up source catalog")
-    with Timer("\tSource catalog generated in {}"):
-        main_cat = mc.setup()
+    if main_cat is None:
+        _report(report, "Setting up source catalog")
+        with _timer("\tSource catalog generated in {}", report):
+            main_cat = mc.setup()
 
-    print(
-        f"Generating catalog specific for {fetch_config.model_name} {fetch_config.timing}"
-    )
-    with Timer("\tSpecific catalog generated in {}"):
+    _report(report, f"Generating catalog specific for {model_name} {timing}")
+    with _timer("\tSpecific catalog generated in {}", report):
         source = mc.select_date_range(
-            main_cat[fetch_config.model_name],
-            start_date=fetch_config.start,
-            end_date=fetch_config.end,
-            timing=fetch_config.timing,
+            main_cat[model_name],
+            start_date=start,
+            end_date=end,
+            timing=timing,
         )
 
-    print("Getting xarray dataset for model data")
-    with Timer("\tCreated dask-based xarray dataset in {}"):
-        ds = source.to_dask()
+    _report(report, "Getting xarray dataset for model data")
+    with _timer("\tCreated dask-based xarray dataset in {}", report):
+        return source.to_dask()
+
 
+def subset_dataset(
+    ds: xr.Dataset, fetch_config: FetchConfig, report: Optional[Callable[[str], None]] = print
+) -> xr.Dataset:
+    """Return the lazily loaded subset of an opened source described by fetch_config.
+
+    Only coordinates are read, so the size of the subset can be checked
+    before any of its data are. report, if not None, is called with a line
+    of text for each step.
+    """
     if fetch_config.surface_only:
-        print("Selecting only surface data.")
-        with Timer("\tIndexed surface data in {}"):
-            ds = select_surface(ds)
+        _report(report, "Selecting only surface data.")
+        with _timer("\tIndexed surface data in {}", report):
+            ds = select_surface(ds, fetch_config.model_name)
+    elif fetch_config.depth is not None:
+        _report(report, "Selecting depth levels.")
+        with _timer("\tIndexed depth levels in {}", report):
+            ds = select_depth(ds, fetch_config.depth, fetch_config.model_name)
 
-    print("Subsetting data")
-    with Timer("\tSubsetted dataset in {}"):
+    _report(report, "Subsetting data")
+    with _timer("\tSubsetted dataset in {}", report):
         ds_ss = ds.em.filter(fetch_config.standard_names)
+        wrapped = None
         if fetch_config.bbox is not None:
-            ds_ss = ds_ss.em.sub_grid(bbox=fetch_config.bbox, naive=True, preload=True)
-        print(
-            f"Estimated size of uncompressed dataset: {ds_ss.nbytes / 1024 / 1024:.2f} MiB"
-        )
+            wrapped = dateline_bbox(fetch_config.model_name, fetch_config.bbox)
+        if wrapped is not None:
+            ds_ss = sub_grid_dateline(ds_ss, wrapped)
+        elif fetch_config.bbox is not None:
+            # not preloaded: the subset stays lazy, to be size checked and
+            # then written one block of time steps at a time
+            ds_ss = ds_ss.em.sub_grid(bbox=fetch_config.bbox, naive=True, preload=False)
 
-        if main_cat[fetch_config.model_name].metadata["bounding_box"][2] > 180:
-            ds_ss = rotate_longitude(ds_ss)
+        if fetch_config.decimation is not None:
+            ds_ss = fetch_config.decimation.apply(ds_ss)
+
+        if wrapped is None:
+            # the stitched longitudes are already contiguous
+            ds_ss = rotate_longitude(ds_ss, fetch_config.model_name)
+
+        if fetch_config.polygon is not None:
+            polygon = shapely.Polygon(fetch_config.polygon)
+            if wrapped is not None:
+                polygon = dateline_polygon(polygon, wrapped)
+            ds_ss = subset_polygon(ds_ss, polygon)
 
         if not has_horizontal_data(ds_ss):
             raise ValueError("Subsetting produced no valid data to write to disk.")
-    print(f"Writing netCDF data to {fetch_config.output_pth}.")
-    with Timer("\tWrote output to disk in {}"):
-        ds_ss.to_netcdf(fetch_config.output_pth)
-    print("Complete")
+    return ds_ss
+
+
+def open_subset(
+    fetch_config: FetchConfig,
+    source: Optional[xr.Dataset] = None,
+    report: Optional[Callable[[str], None]] = print,
+) -> xr.Dataset:
+    """Return the lazily loaded subset described by fetch_config.
+
+    The subset is cut from source, an already opened dataset of the model
+    (e.g. for a longer time window), if given, rather than opening it.
+    """
+    if source is None:
+        ds = open_source(
+            fetch_config.model_name,
+            fetch_config.timing,
+            fetch_config.start,
+            fetch_config.end,
+            report=report,
+        )
+    else:
+        ds = source
+        time_dim = get_time_dim(ds)
+        if time_dim is not None:
+            ds = ds.sel({time_dim: slice(fetch_config.start, fetch_config.end)})
+    return subset_dataset(ds, fetch_config, report)
+
+
+def write_subset(
+    ds_ss: xr.Dataset,
+    fetch_config: FetchConfig,
+    output_pth: Path,
+    output_format: Optional[str] = None,
+    report: Optional[Callable[[str], None]] = print,
+) -> SubsetInfo:
+    """Check the size of a subset and, unless it is a dry run, write it to output_pth.
+
+    The output format defaults to the one of fetch_config. report, if not
+    None, is called with the summary of the subset and the progress.
+    """
+    output_format = output_format or fetch_config.output_format
+    info = subset_info(ds_ss)
+    _report(report, info.summary())
+    check_subset_size(info, fetch_config.max_filesize)
+    if fetch_config.dry_run:
+        return info
+
+    _report(report, f"Writing {output_format} data to {output_pth}.")
+    with _timer("\tWrote output to disk in {}", report):
+        write_output(
+            ds_ss,
+            output_pth,
+            output_format,
+            fetch_config.memory_budget,
+            report=report,
+            encoding=fetch_config.encoding,
+            consolidated=fetch_config.consolidated,
+        )
+    return info
+
+
+def fetch_append(
+    fetch_config: FetchConfig,
+    source: Optional[xr.Dataset] = None,
+    report: Optional[Callable[[str], None]] = print,
+) -> SubsetInfo:
+    """Fetch only the time steps after the last one in output_pth, and append them.
+
+    With ``replace_overlap``, the whole window is requested again and the time
+    steps that output_pth already has are replaced by the newer data. source
+    and report are as for `fetch`.
+
+    Returns
+    -------
+    SubsetInfo
+        The size and shape of the time steps appended.
+    """
+    time_dim, file_times = read_times(fetch_config.output_pth)
+    if time_dim is None or len(file_times) == 0:
+        raise ValueError(f"{fetch_config.output_pth} has no time steps to append to")
+    last_time = file_times[-1]
+    _report(report, f"Last time step in {fetch_config.output_pth}: {last_time}")
+
+    start = pd.Timestamp(fetch_config.start)
+    if not fetch_config.replace_overlap:
+        start = max(start, last_time)
+    if start >= pd.Timestamp(fetch_config.end):
+        _report(report, "Output is up to date")
+        return SubsetInfo(variables=[], n_times=0, nbytes=0, estimated_compressed_nbytes=0)
+
+    ds_ss = open_subset(replace(fetch_config, start=start), source, report)
+    if not fetch_config.replace_overlap:
+        ds_ss = ds_ss.isel({time_dim: ds_ss[time_dim].values > last_time.to_datetime64()})
+
+    info = subset_info(ds_ss)
+    _report(report, info.summary())
+    check_subset_size(info, fetch_config.max_filesize)
+    if fetch_config.dry_run:
+        return info
+    if info.n_times == 0:
+        _report(report, "No newer time steps to append")
+        return info
+
+    _report(report, f"Appending {info.n_times} time steps to {fetch_config.output_pth}.")
+    with _timer("\tAppended output in {}", report):
+        append_dataset(ds_ss, fetch_config.output_pth, fetch_config.memory_budget, report)
+    return info
+
+
+def fetch(
+    fetch_config: FetchConfig,
+    source: Optional[xr.Dataset] = None,
+    report: Optional[Callable[[str], None]] = print,
+) -> SubsetInfo:
+    """Downloads and subsets the model data.
+
+    The size of the subset is checked, using only the coordinates and
+    metadata, before any bulk data are requested. If a previous fetch of the
+    same subset to the same output path was interrupted, it is resumed. With
+    ``use_cache``, a subset already in the local subset cache is copied from
+    there rather than downloaded again. The output is written as netCDF or,
+    with ``output_format="zarr"``, as a Zarr store. With ``append``, an existing output
+    file is extended with the newer time steps only (see `fetch_append`).
+
+    Parameters
+    ----------
+    fetch_config : FetchConfig
+        The configuration object which contains the model name, timing, start/end dates of the
+        request, etc.
+    source : xr.Dataset, optional
+        The already opened dataset of the model and timing, covering the time
+        window, e.g. shared by the fetches of a batch. It is opened if not
+        given.
+    report : callable, optional
+        Called with a line of text for each step. None for silence.
+
+    Returns
+    -------
+    SubsetInfo
+        The size and shape of the subset.
+    """
+    if fetch_config.append and Path(fetch_config.output_pth).exists():
+        if fetch_config.output_format != NETCDF:
+            raise ValueError("Appending is only supported for netCDF output")
+        info = fetch_append(fetch_config, source, report)
+    elif fetch_config.use_cache and not fetch_config.dry_run:
+        produced = []
+
+        def produce(pth):
+            # the cache holds netCDF files, exported in the output format
+            ds_ss = open_subset(fetch_config, source, report)
+            produced.append(write_subset(ds_ss, fetch_config, pth, NETCDF, report))
+
+        subset_cache.cache.fetch_to(
+            fetch_request_key(fetch_config),
+            produce,
+            fetch_config.output_pth,
+            export=export_cached(
+                fetch_config.output_format, fetch_config.encoding, fetch_config.consolidated
+            ),
+        )
+        if produced:
+            info = produced[0]
+        else:
+            # served from the cache: the cached file may be evicted by now,
+            # so describe the exported output
+            engine = "zarr" if fetch_config.output_format == ZARR else None
+            with xr.open_dataset(fetch_config.output_pth, engine=engine) as ds:
+                info = subset_info(ds)
+    else:
+        ds_ss = open_subset(fetch_config, source, report)
+        info = write_subset(ds_ss, fetch_config, fetch_config.output_pth, report=report)
+    if not fetch_config.dry_run:
+        _report(report, "Complete")
+    return info
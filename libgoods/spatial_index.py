@@ -0,0 +1,107 @@
+"""
+Spatial index of the model domains
+
+Answers "which models intersect these map bounds" without building
+geometries per query. The model bounding boxes and bounding polygons are
+normalized to the (-180, 180) longitude range once, when the index is
+built, and held in shapely STRtrees.
+"""
+
+import numpy as np
+import shapely
+from shapely import STRtree
+from shapely.affinity import translate
+from shapely.geometry import MultiPoint, Polygon, box
+from shapely.geometry.base import BaseGeometry
+from shapely.ops import unary_union
+
+
+def normalize_longitude(geom):
+    """
+    Return the geometry in the (-180, 180) longitude range
+
+    Any part east of 180 is shifted by -360. A geometry that straddles 180
+    (e.g. a 0 -- 360 global model) is split at 180, so the result covers
+    the same area of the globe.
+    """
+    minx, miny, maxx, maxy = geom.bounds
+    if maxx <= 180:
+        return geom
+    west = geom.intersection(box(minx, miny, 180, maxy))
+    east = translate(geom.intersection(box(180, miny, maxx, maxy)), xoff=-360)
+    return unary_union([g for g in (west, east) if not g.is_empty])
+
+
+def as_polygon(map_bounds):
+    """
+    map bounds as a shapely geometry
+
+    :param map_bounds: list of (lon, lat) tuples, or shapely geometry
+    """
+    if isinstance(map_bounds, BaseGeometry):
+        return map_bounds
+    return Polygon(map_bounds)
+
+
+class ModelSpatialIndex:
+    """
+    STRtree index of the bounding boxes and bounding polygons of models
+
+    :param metadatas: iterable of model Metadata objects
+    """
+
+    def __init__(self, metadatas):
+        self.identifiers = []
+        boxes = []
+        polys = []
+        for meta in metadatas:
+            bb = meta.bounding_box
+            self.identifiers.append(meta.identifier)
+            boxes.append(
+                normalize_longitude(MultiPoint([(bb[0], bb[1]), (bb[2], bb[3])]).envelope)
+            )
+            if len(meta.bounding_poly) > 2:
+                polys.append(normalize_longitude(Polygon(meta.bounding_poly)))
+            else:
+                # no polygon -- fall back to the box
+                polys.append(boxes[-1])
+        self._positions = {name: i for i, name in enumerate(self.identifiers)}
+        self.identifiers = np.array(self.identifiers, dtype=object)
+        self.boxes = np.array(boxes, dtype=object)
+        self.polys = np.array(polys, dtype=object)
+        # prepared geometries make repeated predicates against one model fast
+        shapely.prepare(self.boxes)
+        shapely.prepare(self.polys)
+        self._box_tree = STRtree(self.boxes)
+        self._poly_tree = STRtree(self.polys)
+
+    def __len__(self):
+        return len(self.identifiers)
+
+    def query(self, map_bounds, exact=False):
+        """
+        Return the identifiers of the models that intersect map_bounds
+
+        :param map_bounds: list of (lon, lat) tuples, or shapely Polygon.
+               Coords must be in (-180, -90), (180, 90) range
+        :param exact=False: If True, intersect with the model bounding
+                            polygons, rather than the bounding boxes.
+
+        :returns: list of model identifiers, in index order
+        """
+        tree = self._poly_tree if exact else self._box_tree
+        hits = tree.query(as_polygon(map_bounds), predicate="intersects")
+        return list(self.identifiers[np.sort(hits)])
+
+    def intersects(self, identifier, map_bounds, exact=True):
+        """
+        Check whether a single model intersects map_bounds
+
+        :param identifier: the model identifier
+        :param map_bounds: list of (lon, lat) tuples, or shapely Polygon.
+               Coords must be in (-180, -90), (180, 90) range
+        :param exact=True: If True, use the model bounding polygon,
+                           otherwise the bounding box.
+        """
+        geoms = self.polys if exact else self.boxes
+        return geoms[self._positions[identifier]].intersects(as_polygon(map_bounds))
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Concurrent probing of whether model sources are online."""
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, Iterator, Optional, Tuple
+from urllib.parse import urlsplit
+
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+
+from libgoods.performance import Timer
+
+
+@dataclass
+class StatusTarget:
+    """A model source to probe."""
+
+    model_name: str
+    timing: str
+    urlpath: str
+
+
+@dataclass
+class StatusResult:
+    """The outcome of probing one model source."""
+
+    model_name: str
+    timing: str
+    online: bool
+    start: Optional[pd.Timestamp] = None
+    end: Optional[pd.Timestamp] = None
+    elapsed_ms: float = 0.0
+    error: Optional[str] = None
+
+
+# Looks up the (start, end) availability of an online source.
+AvailabilityLookup = Callable[[str, str], Tuple[pd.Timestamp, pd.Timestamp]]
+
+
+class StatusProber:
+    """Probes many model sources concurrently.
+
+    Each worker thread keeps its own pooled ``requests.Session``, so
+    connections to a server are reused across probes. The number of
+    simultaneous requests to any one host is limited, as most of the
+    sources are served by a handful of THREDDS servers.
+
+    Parameters
+    ----------
+    max_workers : int
+        Size of the thread pool.
+    per_host : int
+        Maximum number of simultaneous requests to one host.
+    timeout : float
+        Timeout, in seconds, for each request.
+    availability : callable, optional
+        Called as ``availability(model_name, timing)`` for each online source
+        to find its start and end times. Errors mark the source offline.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 16,
+        per_host: int = 4,
+        timeout: float = 10.0,
+        availability: Optional[AvailabilityLookup] = None,
+    ):
+        """Initializes the prober."""
+        self.max_workers = max_workers
+        self.per_host = per_host
+        self.timeout = timeout
+        self.availability = availability
+        self._local = threading.local()
+        self._host_limits: Dict[str, threading.BoundedSemaphore] = {}
+        self._lock = threading.Lock()
+
+    def _session(self) -> requests.Session:
+        """Return the session of the current thread."""
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.per_host, pool_maxsize=self.per_host)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self._local.session = session
+        return session
+
+    def _host_limit(self, urlpath: str) -> threading.BoundedSemaphore:
+        """Return the semaphore limiting requests to the host of urlpath."""
+        host = urlsplit(urlpath).netloc
+        with self._lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = threading.BoundedSemaphore(self.per_host)
+            return self._host_limits[host]
+
+    def probe(self, target: StatusTarget) -> StatusResult:
+        """Probe a single source."""
+        result = StatusResult(target.model_name, target.timing, online=False)
+        timer = Timer()
+        try:
+            with self._host_limit(target.urlpath):
+                resp = self._session().get(target.urlpath + ".das", timeout=self.timeout)
+            result.online = resp.status_code == 200
+            if not result.online:
+                result.error = f"HTTP {resp.status_code}"
+            elif self.availability is not None:
+                result.start, result.end = self.availability(
+                    target.model_name, target.timing
+                )
+        except Exception as err:
+            result.online = False
+            result.error = str(err) or type(err).__name__
+        result.elapsed_ms = timer.tock()
+        return result
+
+    def probe_all(self, targets: Iterable[StatusTarget]) -> Iterator[StatusResult]:
+        """Probe all the targets, yielding each result as it completes."""
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self.probe, target) for target in targets]
+            for future in as_completed(futures):
+                yield future.result()
@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""A content-addressed, size-bounded cache of fetched subsets.
+
+Subsets are stored as netCDF files named by a canonical hash of the request
+that produced them (model, source, time window, bounds, parameters...), so a
+repeated request is served from disk rather than downloaded again. The
+least recently used files are evicted when the cache grows beyond its size
+limit, and concurrent requests for the same subset share one download.
+
+The extent of each cached subset (source, bounding box, time range,
+variables and depth mode) is also recorded, so a request that falls within
+an already cached subset can be sliced from it locally.
+"""
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import Future
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Callable, Dict, FrozenSet, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from libgoods import cache_dir
+
+# Default size limit of the cache.
+DEFAULT_MAX_BYTES = 10 * 1024 ** 3
+# Bump to invalidate all the keys when the subsetting code changes.
+KEY_VERSION = 1
+# Digits floats are rounded to in keys, so e.g. -76.5 and -76.50000000001 match.
+KEY_FLOAT_DIGITS = 6
+
+
+def _canonical(value):
+    """Return a JSON compatible, canonical form of a request parameter."""
+    if isinstance(value, dict):
+        return {str(k): _canonical(v) for k, v in value.items()}
+    if isinstance(value, (set, frozenset)):
+        return sorted(_canonical(v) for v in value)
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_canonical(v) for v in value]
+    if value is None:
+        return None
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        return round(float(value), KEY_FLOAT_DIGITS)
+    if isinstance(value, (datetime.datetime, np.datetime64)):
+        time = pd.Timestamp(value)
+        if time.tzinfo is not None:
+            time = time.tz_convert("UTC").tz_localize(None)
+        return time.isoformat()
+    return str(value)
+
+
+def request_key(**request) -> str:
+    """Return the cache key of a subset request.
+
+    The parameters are put in a canonical form (sorted keys, rounded floats,
+    UTC ISO times) before they are hashed, so equivalent requests share a key.
+    Parameters that are sets of names, such as the standard names to
+    extract, should be passed as sets so their order doesn't matter.
+    """
+    payload = {"version": KEY_VERSION, "request": _canonical(request)}
+    text = json.dumps(payload, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class CacheStats:
+    """Hit/miss counts of a subset cache."""
+
+    hits: int = 0
+    misses: int = 0
+    # requests served by waiting on another caller's download
+    shared: int = 0
+    # misses served by slicing a cached superset
+    superset_hits: int = 0
+    evictions: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        """Fraction of the requests that did not need a download of their own."""
+        total = self.hits + self.misses + self.shared
+        return (self.hits + self.shared) / total if total else 0.0
+
+    def as_pyson(self) -> dict:
+        """Return a JSON compatible dict of the stats."""
+        pyson = asdict(self)
+        pyson["hit_rate"] = self.hit_rate
+        return pyson
+
+
+@dataclass(frozen=True)
+class SubsetExtent:
+    """What a cached subset covers."""
+
+    # what the subset was cut from, e.g. "CBOFS/forecast"
+    source: str
+    # (min_lon, min_lat, max_lon, max_lat)
+    bbox: Tuple[float, float, float, float]
+    start: pd.Timestamp
+    end: pd.Timestamp
+    variables: FrozenSet[str]
+    # "surface" or "3D"
+    depth: str = "surface"
+    # lossy encoding of the data (see `writers.OutputEncoding.precision`),
+    # empty if lossless
+    precision: str = ""
+    # decimation of the data (see `model_fetch.Decimation.label`), empty if
+    # at full resolution
+    decimation: str = ""
+    # WKT of the polygon the cells outside of are masked, empty if none
+    polygon: str = ""
+
+    def contains(self, other: "SubsetExtent") -> bool:
+        """Return True if everything requested by other is in this subset."""
+        west, south, east, north = self.bbox
+        o_west, o_south, o_east, o_north = other.bbox
+        return (
+            self.source == other.source
+            and self.depth == other.depth
+            and self.precision in ("", other.precision)
+            and self.decimation in ("", other.decimation)
+            and self.polygon in ("", other.polygon)
+            and other.variables <= self.variables
+            and west <= o_west <= o_east <= east
+            and south <= o_south <= o_north <= north
+            and self.start <= other.start <= other.end <= self.end
+        )
+
+    def as_pyson(self) -> dict:
+        """Return a JSON compatible dict of the extent."""
+        return {
+            "source": self.source,
+            "bbox": [float(v) for v in self.bbox],
+            "start": self.start.isoformat(),
+            "end": self.end.isoformat(),
+            "variables": sorted(self.variables),
+            "depth": self.depth,
+            "precision": self.precision,
+            "decimation": self.decimation,
+            "polygon": self.polygon,
+        }
+
+    @classmethod
+    def from_pyson(cls, pyson: dict) -> "SubsetExtent":
+        """Create an extent from the output of `as_pyson`."""
+        return cls(
+            source=pyson["source"],
+            bbox=tuple(pyson["bbox"]),
+            start=pd.Timestamp(pyson["start"]),
+            end=pd.Timestamp(pyson["end"]),
+            variables=frozenset(pyson["variables"]),
+            depth=pyson["depth"],
+            precision=pyson.get("precision", ""),
+            decimation=pyson.get("decimation", ""),
+            polygon=pyson.get("polygon", ""),
+        )
+
+
+class SubsetCache:
+    """On disk cache of subset files, with LRU eviction.
+
+    Parameters
+    ----------
+    root : Path, optional
+        Directory of the cache. Defaults to ``subsets`` in the libgoods cache
+        directory.
+    max_bytes : int
+        The least recently used files are removed when the files in the
+        cache add up to more than this.
+    """
+
+    def __init__(self, root=None, max_bytes: int = DEFAULT_MAX_BYTES):
+        """Initializes the cache -- the directory is created on first write."""
+        self.root = Path(root) if root is not None else cache_dir / "subsets"
+        self.max_bytes = max_bytes
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        self._in_flight: Dict[str, Future] = {}
+        self._extents: Optional[Dict[str, SubsetExtent]] = None
+
+    def path(self, key: str) -> Path:
+        """The file a subset is stored in."""
+        return self.root / f"{key}.nc"
+
+    def _touch(self, pth: Path) -> bool:
+        """Mark a file as just used; return False if it is gone."""
+        try:
+            os.utime(pth)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def lookup(self, key: str) -> Optional[Path]:
+        """Return the file of a cached subset, or None, counting the hit or miss."""
+        pth = self.path(key)
+        with self._lock:
+            if self._touch(pth):
+                self.stats.hits += 1
+                return pth
+            self.stats.misses += 1
+        return None
+
+    def get_or_create(
+        self,
+        key: str,
+        producer: Callable[[Path], object],
+        extent: Optional[SubsetExtent] = None,
+    ) -> Path:
+        """Return the file of a subset, calling producer to write it if not cached.
+
+        ``producer(pth)`` must write the subset to pth, and should only create
+        pth once it is complete (e.g. with `writers.write_checkpointed`). If the
+        same key is already being produced by another thread, this waits for
+        it rather than starting a second download. The extent, if given, is
+        recorded so later requests within it can use `find_superset`.
+        """
+        pth = self.path(key)
+        with self._lock:
+            if self._touch(pth):
+                self.stats.hits += 1
+                return pth
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self._in_flight[key] = Future()
+                self.stats.misses += 1
+            else:
+                self.stats.shared += 1
+        if not owner:
+            return future.result()
+
+        try:
+            self.root.mkdir(parents=True, exist_ok=True)
+            producer(pth)
+            if not pth.exists():
+                raise FileNotFoundError(f"subset was not written to {pth}")
+            if extent is not None:
+                self.record_extent(key, extent)
+            self.evict(keep=key)
+        except BaseException as err:
+            future.set_exception(err)
+            raise
+        else:
+            future.set_result(pth)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+        return pth
+
+    def fetch_to(
+        self,
+        key: str,
+        producer: Callable[[Path], object],
+        target_pth,
+        extent: Optional[SubsetExtent] = None,
+        export: Optional[Callable[[Path, Path], object]] = None,
+    ) -> Path:
+        """Like `get_or_create`, then copy the cached file to target_pth.
+
+        ``export(cached_pth, target_pth)``, if given, is used instead of a
+        copy, e.g. to write the subset in another format.
+        """
+        pth = self.get_or_create(key, producer, extent)
+        if export is not None:
+            export(pth, target_pth)
+        elif Path(target_pth).resolve() != pth.resolve():
+            shutil.copyfile(pth, target_pth)
+        return target_pth
+
+    @property
+    def _extents_path(self) -> Path:
+        """The file the extents are persisted in."""
+        return self.root / "extents.json"
+
+    @property
+    def extents(self) -> Dict[str, SubsetExtent]:
+        """The extents of the cached subsets, read from disk on first use."""
+        with self._lock:
+            if self._extents is None:
+                try:
+                    with open(self._extents_path, "r", encoding="utf-8") as infile:
+                        pyson = json.load(infile)
+                    self._extents = {
+                        key: SubsetExtent.from_pyson(value) for key, value in pyson.items()
+                    }
+                except (OSError, ValueError, KeyError, TypeError):
+                    self._extents = {}
+            return self._extents
+
+    def _save_extents(self):
+        """Write the extents to disk, atomically."""
+        extents = self.extents
+        with self._lock:
+            pyson = {key: extent.as_pyson() for key, extent in extents.items()}
+        self.root.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as outfile:
+                json.dump(pyson, outfile)
+            os.replace(tmp_name, self._extents_path)
+        except OSError:
+            if os.path.exists(tmp_name):
+                os.unlink(tmp_name)
+
+    def record_extent(self, key: str, extent: SubsetExtent):
+        """Record what the cached subset of key covers."""
+        extents = self.extents
+        with self._lock:
+            extents[key] = extent
+        self._save_extents()
+
+    def find_superset(self, extent: SubsetExtent) -> Optional[str]:
+        """Return the key of a cached subset that contains extent, or None.
+
+        If several do, the smallest file is picked, as the cheapest to slice.
+        Counts a superset hit when one is found.
+        """
+        extents = self.extents
+        with self._lock:
+            cached_extents = list(extents.items())
+        candidates = []
+        for key, cached in cached_extents:
+            if not cached.contains(extent):
+                continue
+            try:
+                candidates.append((self.path(key).stat().st_size, key))
+            except FileNotFoundError:
+                # evicted by another process
+                with self._lock:
+                    extents.pop(key, None)
+        if not candidates:
+            return None
+        key = min(candidates)[1]
+        with self._lock:
+            self._touch(self.path(key))
+            self.stats.superset_hits += 1
+        return key
+
+    def entries(self):
+        """Return (path, size, last used) of each file, least recently used first."""
+        entries = []
+        for pth in self.root.glob("*.nc"):
+            try:
+                st = pth.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((pth, st.st_size, st.st_mtime))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def total_bytes(self) -> int:
+        """Total size of the files in the cache."""
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep: Optional[str] = None):
+        """Remove least recently used files until the cache fits in max_bytes."""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        extents = self.extents
+        with self._lock:
+            protected = set(self._in_flight)
+        if keep is not None:
+            protected.add(keep)
+        evicted = False
+        for pth, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            if pth.stem in protected:
+                continue
+            try:
+                pth.unlink()
+            except FileNotFoundError:
+                continue
+            total -= size
+            with self._lock:
+                self.stats.evictions += 1
+                evicted = extents.pop(pth.stem, None) is not None or evicted
+        if evicted:
+            self._save_extents()
+
+    def clear(self):
+        """Remove all the files in the cache and reset the stats."""
+        for pth, _, _ in self.entries():
+            pth.unlink(missing_ok=True)
+        extents = self.extents
+        with self._lock:
+            extents.clear()
+            self.stats = CacheStats()
+        self._save_extents()
+
+
+cache = SubsetCache()
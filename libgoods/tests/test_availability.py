@@ -0,0 +1,91 @@
+"""
+tests of the availability cache
+"""
+
+import pandas as pd
+import pytest
+
+from libgoods.availability import AvailabilityCache, source_ttl
+
+try:
+    from libgoods.model import SourceMetadata
+except ImportError:
+    SourceMetadata = None
+
+START = pd.Timestamp("2022-06-01")
+END = pd.Timestamp("2022-06-08")
+
+
+class FakeLookup:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, model_name):
+        self.calls += 1
+        return {
+            "forecast": (START, END + pd.Timedelta(hours=self.calls)),
+            "hindcast": (START, pd.NaT),
+        }
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return AvailabilityCache(
+        path=tmp_path / "availability.json",
+        lookup=FakeLookup(),
+        ttl=lambda model_name, timing: pd.Timedelta(hours=6),
+        clock=FakeClock(),
+    )
+
+
+def test_cached_until_expired(cache):
+    first = cache.get("TBOFS", "forecast")
+    assert first == (START, END + pd.Timedelta(hours=1))
+    assert cache.get("TBOFS", "forecast") == first
+    assert cache.get_times("TBOFS")["forecast"] == first
+    assert cache.lookup.calls == 1
+
+    cache.clock.now += 6 * 3600
+    assert cache.peek("TBOFS", "forecast") is None
+    assert cache.get("TBOFS", "forecast")[1] == END + pd.Timedelta(hours=2)
+    assert cache.lookup.calls == 2
+
+
+def test_persisted(cache):
+    times = cache.get_times("TBOFS")
+
+    reloaded = AvailabilityCache(
+        path=cache.path, lookup=FakeLookup(), ttl=cache.ttl, clock=cache.clock
+    )
+    assert reloaded.get_times("TBOFS")["forecast"] == times["forecast"]
+    start, end = reloaded.get("TBOFS", "hindcast")
+    assert start == START and pd.isna(end)
+    assert reloaded.lookup.calls == 0
+
+
+def test_refresh_expiring(cache):
+    cache.get("TBOFS", "forecast")
+    cache.refresh_expiring(within=60)
+    assert cache.lookup.calls == 1
+
+    cache.clock.now += 6 * 3600 - 30
+    cache.refresh_expiring(within=60)
+    assert cache.lookup.calls == 2
+
+
+@pytest.mark.skipif(SourceMetadata is None, reason="needs model_catalogs")
+def test_source_ttl():
+    forecast = SourceMetadata(period=1, end="48 hours after present time")
+    assert source_ttl(forecast) == pd.Timedelta(hours=6)
+    daily = SourceMetadata(period=24, end="5 days after present day")
+    assert source_ttl(daily) == pd.Timedelta(hours=24)
+    hindcast = SourceMetadata(period=3, end="to 2019-11-27")
+    assert source_ttl(hindcast) == pd.Timedelta(days=7)
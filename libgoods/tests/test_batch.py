@@ -0,0 +1,181 @@
+"""
+tests of the batch fetch engine, with local datasets standing in for the
+remote sources
+"""
+
+import json
+import threading
+import time
+
+import dask
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+try:
+    from libgoods import batch, model_fetch, writers
+except ImportError:
+    pytest.skip(
+        "Can't run these tests without the model_catalogs package",
+        allow_module_level=True,
+    )
+
+from libgoods.tests.test_model_fetch import make_dataset
+
+
+class FakeOpener:
+    def __init__(self):
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def __call__(self, model_name, timing, start, end):
+        with self.lock:
+            self.calls.append((model_name, timing, start, end))
+        if model_name == "OFFLINE":
+            raise OSError("server unavailable")
+        return make_dataset()
+
+
+@pytest.fixture
+def bounds_cache(monkeypatch):
+    cache = {"CBOFS": (-77.5, 36.0, -75.0, 40.0), "OFFLINE": (-77.5, 36.0, -75.0, 40.0)}
+    monkeypatch.setattr(model_fetch, "_BOUNDS_CACHE", cache)
+
+
+def make_config(tmp_path, name, model_name="CBOFS", start="2022-06-20", end="2022-06-20T05:00",
+                **kwargs):
+    return model_fetch.FetchConfig(
+        model_name=model_name,
+        output_pth=tmp_path / f"{name}.nc",
+        start=pd.Timestamp(start),
+        end=pd.Timestamp(end),
+        bbox=kwargs.pop("bbox", None),
+        timing=kwargs.pop("timing", "forecast"),
+        standard_names=["eastward_sea_water_velocity"],
+        **kwargs,
+    )
+
+
+def test_load_manifest(tmp_path):
+    entries = [
+        {
+            "model_name": "CBOFS",
+            "output_pth": "a.nc",
+            "start": "2022-06-20",
+            "end": "2022-06-21",
+            "bbox": [-76.5, 36.75, -75.25, 37.75],
+            "timing": "forecast",
+            "surface_only": True,
+        }
+    ]
+    (tmp_path / "jobs.json").write_text(json.dumps(entries))
+    (tmp_path / "jobs.csv").write_text(
+        "model_name,output_pth,start,end,bbox,timing,surface_only,standard_names\n"
+        'CBOFS,a.nc,2022-06-20,2022-06-21,"-76.5,36.75,-75.25,37.75",forecast,true,\n'
+    )
+
+    [from_json] = batch.load_manifest(tmp_path / "jobs.json")
+    [from_csv] = batch.load_manifest(tmp_path / "jobs.csv")
+
+    assert from_json == from_csv
+    assert from_json.bbox == (-76.5, 36.75, -75.25, 37.75)
+    assert from_json.start == pd.Timestamp("2022-06-20")
+    assert from_json.surface_only
+    assert from_json.standard_names == model_fetch.DEFAULT_STANDARD_NAMES
+    with pytest.raises(ValueError):
+        batch.config_from_dict({"model": "CBOFS"})
+
+
+def test_run_batch(tmp_path, bounds_cache):
+    configs = [
+        make_config(tmp_path, "early"),
+        make_config(tmp_path, "late", start="2022-06-20T10:00", end="2022-06-20T20:00",
+                    bbox=(-76.0, 37.0, -75.5, 37.5)),
+        make_config(tmp_path, "nowcast", timing="nowcast"),
+        make_config(tmp_path, "offline", model_name="OFFLINE"),
+    ]
+    opener = FakeOpener()
+
+    results = batch.run_batch(configs, max_workers=3, opener=opener, report=None)
+
+    # each source is opened once, for the union of the time windows
+    assert sorted(opener.calls) == [
+        ("CBOFS", "forecast", pd.Timestamp("2022-06-20"), pd.Timestamp("2022-06-20T20:00")),
+        ("CBOFS", "nowcast", pd.Timestamp("2022-06-20"), pd.Timestamp("2022-06-20T05:00")),
+        ("OFFLINE", "forecast", pd.Timestamp("2022-06-20"), pd.Timestamp("2022-06-20T05:00")),
+    ]
+    assert [r.config for r in results] == configs
+    assert [r.ok for r in results] == [True, True, True, False]
+    assert "server unavailable" in results[3].error
+
+    assert results[0].info.n_times == 6
+    with xr.open_dataset(tmp_path / "late.nc") as late:
+        assert late.sizes["time"] == 11
+        assert list(late.data_vars) == ["u"]
+        assert late["lon"].min() >= -76.1 and late["lon"].max() <= -75.4
+    ds = make_dataset()
+    with xr.open_dataset(tmp_path / "early.nc") as early:
+        np.testing.assert_array_equal(early["u"], ds["u"][:6])
+
+
+def test_run_batch_append(tmp_path, bounds_cache, capsys):
+    ds = make_dataset()
+    writers.write_checkpointed(ds.isel(time=slice(0, 3)), tmp_path / "rolling.nc", report=None)
+    configs = [
+        make_config(tmp_path, "rolling", append=True),
+        make_config(tmp_path, "other"),
+    ]
+    opener = FakeOpener()
+
+    results = batch.run_batch(configs, opener=opener, report=None)
+
+    assert [r.ok for r in results] == [True, True]
+    # the append uses the dataset opened for its group
+    assert len(opener.calls) == 1
+    assert results[0].info.n_times == 3
+    with xr.open_dataset(tmp_path / "rolling.nc") as rolling:
+        np.testing.assert_array_equal(rolling["u"], ds["u"][:6])
+    assert capsys.readouterr().out == ""
+
+
+def test_run_batch_many_jobs(tmp_path, bounds_cache):
+    configs = [
+        make_config(tmp_path, f"job{i}", timing=("forecast", "nowcast")[i % 2],
+                    bbox=(-76.0 - 0.05 * (i % 5), 37.0, -75.5, 37.5))
+        for i in range(24)
+    ]
+    reading = []
+    overlaps = []
+    lock = threading.Lock()
+
+    def read(block):
+        with lock:
+            reading.append(1)
+            overlaps.append(len(reading))
+        time.sleep(0.005)
+        with lock:
+            reading.pop()
+        return block
+
+    class SlowOpener(FakeOpener):
+        def __call__(self, *args):
+            ds = super().__call__(*args)
+            ds["u"] = ds["u"].copy(data=ds["u"].data.map_blocks(read, meta=ds["u"].data._meta))
+            return ds
+
+    # each job reads its blocks in its own thread
+    with dask.config.set(scheduler="synchronous"):
+        results = batch.run_batch(configs, max_workers=8, opener=SlowOpener(), report=None)
+
+    assert all(r.ok for r in results), [r.error for r in results if not r.ok]
+    # the jobs download their data in parallel
+    assert max(overlaps) > 1
+    ds = make_dataset()
+    for config in configs:
+        with xr.open_dataset(config.output_pth) as out:
+            assert out.sizes["time"] == 6
+            np.testing.assert_array_equal(
+                out["u"], ds["u"][:6].sel(lon=out["lon"], lat=out["lat"])
+            )
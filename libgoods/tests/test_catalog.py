@@ -0,0 +1,181 @@
+"""
+tests of the catalog snapshot
+"""
+
+import pytest
+
+import json
+
+import pandas as pd
+
+try:
+    from libgoods import NonIntersectingSubsetError, api, catalog
+    from libgoods.model import Metadata, SourceMetadata
+except ImportError:
+    pytest.skip(
+        "Can't run these tests without the model_catalogs package",
+        allow_module_level=True,
+    )
+
+
+def make_snapshot():
+    meta = Metadata(
+        identifier="TEST",
+        name="Test Model",
+        bounding_box=[-80.0, 30.0, -70.0, 40.0],
+        sources=[SourceMetadata(name="forecast", env_params={"surface currents"})],
+    )
+    return {
+        "signature": catalog.catalog_signature(),
+        "model_metadata": {"TEST": {"bounding_box": [-80.0, 30.0, -70.0, 40.0]}},
+        "all_metas": {"TEST": meta},
+    }
+
+
+def test_snapshot_round_trip(tmp_path):
+    pth = tmp_path / "snapshot.pickle"
+    snapshot = make_snapshot()
+    catalog.save_snapshot(snapshot, pth)
+
+    loaded = catalog.load_snapshot(pth)
+
+    assert loaded["all_metas"]["TEST"] == snapshot["all_metas"]["TEST"]
+    assert loaded["model_metadata"] == snapshot["model_metadata"]
+    assert list(tmp_path.iterdir()) == [pth]
+
+
+def test_snapshot_stale_signature(tmp_path):
+    pth = tmp_path / "snapshot.pickle"
+    catalog.save_snapshot(make_snapshot(), pth)
+
+    signature = catalog.catalog_signature()
+    signature["packages"] = {"model_catalogs": "0.0.0"}
+
+    assert catalog.load_snapshot(pth, signature=signature) is None
+
+
+def test_snapshot_missing_or_corrupt(tmp_path):
+    pth = tmp_path / "snapshot.pickle"
+    assert catalog.load_snapshot(pth) is None
+
+    pth.write_bytes(b"not a pickle")
+    assert catalog.load_snapshot(pth) is None
+
+
+def test_registry_is_lazy(tmp_path, monkeypatch):
+    pth = tmp_path / "snapshot.pickle"
+    catalog.save_snapshot(make_snapshot(), pth)
+
+    def no_setup():
+        raise AssertionError("the main catalog should not be set up")
+
+    monkeypatch.setattr(catalog.mc, "setup", no_setup)
+    registry = catalog.CatalogRegistry(snapshot_path=pth)
+    assert registry._snapshot is None
+
+    registry.warm()
+
+    assert list(registry.all_metas) == ["TEST"]
+    assert registry._main_cat is None
+
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    pth = tmp_path / "snapshot.pickle"
+    catalog.save_snapshot(make_snapshot(), pth)
+    registry = catalog.CatalogRegistry(snapshot_path=pth)
+    monkeypatch.setattr(catalog, "registry", registry)
+    return registry
+
+
+def test_api_warm(registry, monkeypatch):
+    monkeypatch.setattr(catalog.mc, "setup", lambda: {"TEST": None})
+    api.warm()
+    assert registry._main_cat == {"TEST": None}
+    assert list(api.all_metas) == ["TEST"]
+    assert api.env_models is registry.main_cat
+
+
+def test_model_info_payload(registry):
+    info = api.get_model_info("TEST")
+    assert info["identifier"] == "TEST"
+    assert info["sources"][0]["env_params"] == ["surface currents"]
+    # cached, not rebuilt
+    assert api.get_model_info("TEST") is info
+
+    payload, etag = api.get_model_info_json("TEST")
+    assert json.loads(payload) == json.loads(json.dumps(info))
+    assert api.get_model_info_json("TEST", if_none_match=etag) == (None, etag)
+
+
+def test_list_models_json(registry):
+    payload, etag = api.list_models_json(map_bounds=[(-75, 35), (-75, 36), (-74, 36)])
+    assert [m["identifier"] for m in json.loads(payload)] == ["TEST"]
+    assert api.list_models_json(if_none_match=etag) == (None, etag)
+
+    payload, empty_etag = api.list_models_json(name_list=["OTHER"])
+    assert payload == b"[]"
+    assert empty_etag != etag
+
+
+@pytest.fixture
+def overlap_registry(tmp_path, monkeypatch):
+    snapshot = make_snapshot()
+    snapshot["all_metas"]["TEST"].sources = [
+        SourceMetadata(
+            name="forecast",
+            start="7 days before present time",
+            end="48 hours after present time",
+        ),
+        SourceMetadata(name="hindcast", start="starting 2015-08-01", end="to 2019-11-27"),
+    ]
+    pth = tmp_path / "snapshot.pickle"
+    catalog.save_snapshot(snapshot, pth)
+    registry = catalog.CatalogRegistry(snapshot_path=pth)
+    monkeypatch.setattr(catalog, "registry", registry)
+    return registry
+
+
+def test_check_subset_overlap_time(overlap_registry):
+    now = pd.Timestamp.now()
+    recent = [now - pd.Timedelta("2 days"), now - pd.Timedelta("1 day")]
+    assert api.check_subset_overlap("TEST", recent)
+    assert api.check_subset_overlap("TEST", recent, model_source="forecast")
+    assert not api.check_subset_overlap("TEST", recent, model_source="hindcast")
+    assert api.check_subset_overlap("TEST", ["2017-01-01", "2017-01-05"])
+    assert not api.check_subset_overlap("TEST", ["2021-01-01", "2021-01-05"])
+
+
+def test_check_subset_overlap_xy(overlap_registry):
+    inside = [(-76, 36), (-74, 36), (-74, 35), (-76, 35)]
+    outside = [(-66, 36), (-64, 36), (-64, 35), (-66, 35)]
+    assert api.check_subset_overlap("TEST", xy_bounds=inside)
+    assert not api.check_subset_overlap("TEST", xy_bounds=outside)
+
+
+def test_get_model_file_rejects_before_setup(overlap_registry, monkeypatch):
+    def no_setup():
+        raise AssertionError("the main catalog should not be set up")
+
+    monkeypatch.setattr(catalog.mc, "setup", no_setup)
+    with pytest.raises(NonIntersectingSubsetError):
+        api.get_model_file(
+            "TEST",
+            "hindcast",
+            "2021-01-01",
+            "2021-01-05",
+            ((-76, 35), (-74, 36)),
+        )
+
+
+def test_get_model_file_environmental_parameters(overlap_registry, monkeypatch):
+    monkeypatch.setattr(catalog.mc, "setup", None)
+    with pytest.raises(ValueError):
+        api.get_model_file(
+            "TEST",
+            "hindcast",
+            "2017-01-01",
+            "2017-01-05",
+            ((-76, 35), (-74, 36)),
+            environmental_parameters="salinity",
+        )
@@ -0,0 +1,82 @@
+"""
+tests of the environmental parameter bitmasks
+"""
+
+import pytest
+
+try:
+    from libgoods import api
+    from libgoods.model import (
+        Metadata,
+        SourceMetadata,
+        env_params_from_mask,
+        env_params_mask,
+        match_env_params_mask,
+    )
+except ImportError:
+    pytest.skip(
+        "Can't run these tests without the model_catalogs package",
+        allow_module_level=True,
+    )
+
+NYOFS_STANDARD_NAMES = {
+    "eastward_sea_water_velocity": "u",
+    "eastward_wind": "air_u",
+    "northward_sea_water_velocity": "v",
+    "northward_wind": "air_v",
+    "upward_sea_water_velocity": "w",
+}
+
+
+def make_meta(identifier, *source_standard_names):
+    meta = Metadata(identifier=identifier)
+    for std_names in source_standard_names:
+        mask = SourceMetadata.get_env_mask({"standard_names": std_names})
+        meta.sources.append(SourceMetadata(env_mask=mask))
+    meta.compute_env_params()
+    return meta
+
+
+def test_source_env_params():
+    params = SourceMetadata.get_env_params({"standard_names": NYOFS_STANDARD_NAMES})
+    assert params == {"surface winds", "surface currents", "3D currents"}
+
+
+def test_mask_round_trip():
+    mask = env_params_mask(["surface winds", "ice"])
+    assert env_params_from_mask(mask) == {"surface winds", "ice"}
+    assert env_params_mask("surface winds") == env_params_mask(("surface winds",))
+
+
+def test_invalid_env_param():
+    with pytest.raises(KeyError):
+        env_params_mask(["surface winds", "surface wind"])
+
+
+def test_model_mask_needs_all_sources():
+    no_winds = dict(NYOFS_STANDARD_NAMES)
+    del no_winds["eastward_wind"]
+    meta = make_meta("NYOFS", NYOFS_STANDARD_NAMES, no_winds)
+    assert meta.env_params == {"surface currents", "3D currents"}
+
+
+def test_match_masks():
+    masks = [
+        env_params_mask(["surface currents", "surface winds"]),
+        env_params_mask(["surface currents"]),
+        0,
+    ]
+    query = env_params_mask(["surface currents", "surface winds"])
+    assert list(match_env_params_mask(masks, query)) == [True, False, False]
+    assert list(match_env_params_mask(masks, 0)) == [True, True, True]
+
+
+def test_filter_models_env_params():
+    metas = [
+        make_meta("WINDS", {"eastward_wind": "u", "northward_wind": "v"}),
+        make_meta("CURRENTS", NYOFS_STANDARD_NAMES),
+    ]
+    result = api.filter_models(metas, env_params="3D currents")
+    assert [m.identifier for m in result] == ["CURRENTS"]
+    result = api.filter_models(metas, env_params=["surface winds"])
+    assert [m.identifier for m in result] == ["WINDS", "CURRENTS"]
@@ -0,0 +1,162 @@
+"""
+tests of the netCDF4 based file processing classes
+"""
+
+import datetime
+
+import numpy as np
+import pytest
+import shapely
+from netCDF4 import Dataset
+
+from libgoods.file_processing import grid_cache
+from libgoods.file_processing.base import nc
+from libgoods.file_processing.curv_model import curv
+
+
+def make_model(times, units="hours since 2020-01-01 00:00:00"):
+    model = nc()
+    model.time = np.ma.masked_array(times)
+    model.time_units = units
+    return model
+
+
+def test_timeslice_indices():
+    model = make_model(np.arange(0, 48, 3, dtype="float32"))
+
+    # 2020-01-01T03 to 2020-01-01T12, both included
+    assert model.get_timeslice_indices("2020-01-01T03:00:00", "2020-01-01T12:00:00") == (1, 5)
+    # between time steps
+    start = datetime.datetime(2020, 1, 1, 4)
+    end = datetime.datetime(2020, 1, 1, 11)
+    assert model.get_timeslice_indices(start, end) == (2, 4)
+    assert model.get_timeslice_indices(start, end, nearest=True) == (1, 5)
+    # beyond the ends of the time axis
+    assert model.get_timeslice_indices("2019-12-01T00:00:00", "2021-01-01T00:00:00") == (0, 16)
+
+    with pytest.raises(ValueError):
+        model.get_timeslice_indices("2021-01-01T00:00:00", "2021-01-02T00:00:00")
+
+
+def test_time_index():
+    model = make_model(np.arange(0, 86400 * 10, 3600.0), units="seconds since 2020-01-01")
+
+    t_index = model.get_time_index("2020-01-02T00:00:00", "2020-01-03T00:00:00", stride=6)
+    assert t_index == [24, 49, 6]
+    assert list(range(*t_index)) == [24, 30, 36, 42, 48]
+
+    with pytest.raises(ValueError):
+        model.get_time_index("2020-01-02T00:00:00", "2020-01-03T00:00:00", stride=0)
+
+
+def make_grid(ny=40, nx=60, angle=0.3):
+    """a rotated curvilinear grid, with a few missing points"""
+    j, i = np.mgrid[0:ny, 0:nx] * 0.05
+    lon = -76.0 + i * np.cos(angle) - j * np.sin(angle)
+    lat = 37.0 + i * np.sin(angle) + j * np.cos(angle)
+    lon[0, :3] = np.nan
+    return lon, lat
+
+
+def test_grid_index_bbox():
+    lon, lat = make_grid()
+    index = grid_cache.GridIndex.build(lon, lat)
+
+    for bbox in [(-75.5, 37.5, -74.5, 38.0), (-80, 30, -70, 40), (-76.1, 37.0, -75.9, 37.1), (0, 0, 1, 1)]:
+        wl, sl, el, nl = bbox
+        expected = np.flatnonzero((lon >= wl) & (lon <= el) & (lat >= sl) & (lat <= nl))
+        np.testing.assert_array_equal(index.query_bbox(bbox), expected)
+
+
+def test_grid_index_polygon():
+    lon, lat = make_grid()
+    index = grid_cache.GridIndex.build(lon, lat)
+    polygon = shapely.Polygon([(-75.8, 37.2), (-75.0, 37.4), (-75.4, 38.2)])
+
+    expected = np.flatnonzero(shapely.intersects_xy(polygon, lon.ravel(), lat.ravel()))
+    assert len(expected) > 0
+    np.testing.assert_array_equal(index.query_polygon(polygon), expected)
+
+
+def test_grid_cache(tmp_path):
+    lon, lat = make_grid()
+    lon[lon < -76] += 360
+    with Dataset(tmp_path / "grid.nc", "w") as ds:
+        ds.createDimension("y", lon.shape[0])
+        ds.createDimension("x", lon.shape[1])
+        ds.createVariable("lon", "f8", ("y", "x"))[:] = lon
+        ds.createVariable("lat", "f8", ("y", "x"))[:] = lat
+
+    cache = grid_cache.GridCache(tmp_path / "grids")
+    with Dataset(tmp_path / "grid.nc") as ds:
+        index = cache.get(ds["lon"], ds["lat"], wrap_longitude=True)
+        assert np.nanmax(index.lon) < 180
+        assert len(list(cache.root.iterdir())) == 1
+        again = cache.get(ds["lon"], ds["lat"], wrap_longitude=True)
+
+    assert isinstance(again.lon, np.memmap)
+    bbox = (-75.5, 37.5, -74.5, 38.0)
+    np.testing.assert_array_equal(again.query_bbox(bbox), index.query_bbox(bbox))
+
+
+def test_grid_key_reads_one_slice(tmp_path):
+    lon, lat = make_grid()
+    with Dataset(tmp_path / "grid.nc", "w") as ds:
+        ds.createDimension("y", lon.shape[0])
+        ds.createDimension("x", lon.shape[1])
+        ds.createVariable("lon", "f8", ("y", "x"))[:] = lon
+        ds.createVariable("lat", "f8", ("y", "x"))[:] = lat
+
+    class Recorder:
+        """A netCDF variable that records the indices it is read with"""
+
+        def __init__(self, var):
+            self.var = var
+            self.name = var.name
+            self.shape = var.shape
+            self.reads = []
+
+        def ncattrs(self):
+            return self.var.ncattrs()
+
+        def getncattr(self, name):
+            return self.var.getncattr(name)
+
+        def __getitem__(self, index):
+            self.reads.append(index)
+            return self.var[index]
+
+    with Dataset(tmp_path / "grid.nc") as ds:
+        lon_var, lat_var = Recorder(ds["lon"]), Recorder(ds["lat"])
+        key = grid_cache.grid_key(lon_var, lat_var)
+        assert key == grid_cache.grid_key(ds["lon"], ds["lat"])
+
+    for var in (lon_var, lat_var):
+        [index] = var.reads
+        assert all(isinstance(part, slice) for part in index)
+
+
+def test_curv_subset():
+    lon, lat = make_grid()
+    model = curv()
+    model.lon, model.lat = lon, lat
+
+    model.subset((-75.5, 37.5, -74.5, 38.0), stride=2)
+
+    yvec, xvec = np.nonzero((lon >= -75.5) & (lon <= -74.5) & (lat >= 37.5) & (lat <= 38.0))
+    assert model.y == [yvec.min(), yvec.max() + 1, 2]
+    assert model.x == [xvec.min(), xvec.max() + 1, 2]
+
+
+def test_curv_subset_polygon():
+    lon, lat = make_grid()
+    model = curv()
+    model.lon, model.lat = lon, lat
+    points = [(-75.8, 37.2), (-75.0, 37.4), (-75.4, 38.2)]
+
+    model.subset_polygon(points)
+
+    inside = shapely.intersects_xy(shapely.Polygon(points), lon, lat)
+    yvec, xvec = np.nonzero(inside)
+    assert model.y == [yvec.min(), yvec.max() + 1, 1]
+    assert model.x == [xvec.min(), xvec.max() + 1, 1]
@@ -0,0 +1,454 @@
+"""
+tests of the model_fetch helpers that don't need remote data
+"""
+
+from dataclasses import replace
+
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+import xarray as xr
+
+try:
+    from libgoods import FileTooBigError, model_fetch, writers
+except ImportError:
+    pytest.skip(
+        "Can't run these tests without the model_catalogs package",
+        allow_module_level=True,
+    )
+
+
+@pytest.fixture
+def bounds_cache(monkeypatch):
+    cache = {
+        "GFS": (0.0, -90.0, 360.0, 90.0),
+        "NYOFS": (-74.3, 40.4, -73.8, 40.9),
+        "HYCOM": (-180.0, -80.0, 180.0, 90.0),
+    }
+    monkeypatch.setattr(model_fetch, "_BOUNDS_CACHE", cache)
+    monkeypatch.setattr(model_fetch, "_ROTATION_CACHE", {})
+    return cache
+
+
+def test_rotate_bbox(bounds_cache):
+    assert model_fetch.rotate_bbox("GFS", (-85.0, 25.0, -60.0, 48.0)) == (
+        275.0,
+        25.0,
+        300.0,
+        48.0,
+    )
+    bbox = (-74.2, 40.5, -74.0, 40.7)
+    assert model_fetch.rotate_bbox("NYOFS", bbox) is bbox
+    assert model_fetch.uses_360_longitude("GFS")
+    assert not model_fetch.uses_360_longitude("NYOFS")
+
+
+def test_rotate_bboxes(bounds_cache):
+    bboxes = [(-85.0, 25.0, -60.0, 48.0), (-74.2, 40.5, -74.0, 40.7)]
+    result = model_fetch.rotate_bboxes(["GFS", "NYOFS"], bboxes)
+    np.testing.assert_array_equal(
+        result, [(275.0, 25.0, 300.0, 48.0), (-74.2, 40.5, -74.0, 40.7)]
+    )
+
+    # one bbox against several models
+    result = model_fetch.rotate_bboxes(["GFS", "NYOFS"], bboxes[0])
+    np.testing.assert_array_equal(
+        result, [(275.0, 25.0, 300.0, 48.0), (-85.0, 25.0, -60.0, 48.0)]
+    )
+
+    # several bboxes against one model
+    result = model_fetch.rotate_bboxes("GFS", bboxes)
+    assert result[:, 0].tolist() == [275.0, 285.8]
+
+
+def make_dataset(n_times=24, ny=20, nx=30):
+    """A small regular grid dataset, with dask arrays like an opened remote dataset"""
+    time = pd.date_range("2022-06-20", periods=n_times, freq="h")
+    lon = np.linspace(-76.5, -75.25, nx)
+    lat = np.linspace(36.75, 37.75, ny)
+    data = np.random.default_rng(0).random((n_times, ny, nx)).astype("float32")
+    dims = ("time", "lat", "lon")
+    ds = xr.Dataset(
+        {
+            "u": (dims, data, {"standard_name": "eastward_sea_water_velocity"}),
+            "v": (dims, data, {"standard_name": "northward_sea_water_velocity"}),
+        },
+        coords={
+            "time": ("time", time, {"standard_name": "time", "axis": "T"}),
+            "lat": ("lat", lat, {"standard_name": "latitude", "units": "degrees_north"}),
+            "lon": ("lon", lon, {"standard_name": "longitude", "units": "degrees_east"}),
+        },
+    )
+    return ds.chunk({"time": 1})
+
+
+def test_subset_info():
+    ds = make_dataset()
+    info = model_fetch.subset_info(ds)
+
+    assert info.n_times == 24
+    u = [v for v in info.variables if v.name == "u"][0]
+    assert u.dims == ("time", "lat", "lon")
+    assert u.shape == (24, 20, 30)
+    assert u.dtype == "float32"
+    assert u.nbytes == 24 * 20 * 30 * 4
+    assert info.nbytes == ds.nbytes
+    assert info.estimated_compressed_nbytes < info.nbytes
+    assert info.as_pyson()["variables"][0]["dims"]
+
+
+def test_check_subset_size():
+    info = model_fetch.subset_info(make_dataset())
+    model_fetch.check_subset_size(info, None)
+    model_fetch.check_subset_size(info, info.nbytes)
+    with pytest.raises(FileTooBigError):
+        model_fetch.check_subset_size(info, info.nbytes - 1)
+
+
+def test_fetch_append(tmp_path, monkeypatch):
+    ds = make_dataset()
+    requested = []
+
+    def open_subset(fetch_config, source=None, report=print):
+        requested.append(fetch_config.start)
+        return ds.sel(time=slice(fetch_config.start, fetch_config.end))
+
+    monkeypatch.setattr(model_fetch, "open_subset", open_subset)
+    pth = tmp_path / "rolling.nc"
+    writers.write_checkpointed(ds.isel(time=slice(0, 12)), pth, report=None)
+    config = model_fetch.FetchConfig(
+        model_name="CBOFS",
+        output_pth=pth,
+        start=pd.Timestamp("2022-06-20"),
+        end=pd.Timestamp("2022-06-20T23:00"),
+        bbox=None,
+        timing="forecast",
+        append=True,
+    )
+
+    info = model_fetch.fetch(config)
+
+    assert requested == [pd.Timestamp("2022-06-20T11:00")]
+    assert info.n_times == 12
+    with xr.open_dataset(pth) as result:
+        assert result.sizes["time"] == 24
+        np.testing.assert_array_equal(result["u"], ds["u"])
+
+    # up to date: nothing is requested
+    assert model_fetch.fetch(config).n_times == 0
+    assert len(requested) == 1
+
+
+def test_dry_run_reads_no_data(tmp_path, monkeypatch, bounds_cache):
+    bounds_cache["CBOFS"] = (-77.5, 36.0, -75.0, 40.0)
+    reads = []
+
+    def read(block):
+        reads.append(block.shape)
+        return block
+
+    ds = make_dataset()
+    ds["u"] = ds["u"].copy(data=ds["u"].data.map_blocks(read, meta=ds["u"].data._meta))
+    monkeypatch.setattr(model_fetch, "open_source", lambda *args, **kwargs: ds)
+    config = model_fetch.FetchConfig(
+        model_name="CBOFS",
+        output_pth=tmp_path / "dry.nc",
+        start=pd.Timestamp("2022-06-20"),
+        end=pd.Timestamp("2022-06-20T23:00"),
+        bbox=(-76.0, 37.0, -75.5, 37.5),
+        timing="forecast",
+        dry_run=True,
+    )
+
+    info = model_fetch.fetch(config)
+    assert info.n_times == 24
+    with pytest.raises(FileTooBigError):
+        model_fetch.fetch(replace(config, dry_run=False, max_filesize=info.nbytes - 1))
+
+    assert reads == []
+    assert not config.output_pth.exists()
+
+
+def test_fetch_use_cache(tmp_path, monkeypatch, bounds_cache):
+    from libgoods import subset_cache
+
+    bounds_cache["CBOFS"] = (-77.5, 36.0, -75.0, 40.0)
+    opened = []
+
+    def open_source(*args, **kwargs):
+        opened.append(args)
+        return make_dataset()
+
+    monkeypatch.setattr(model_fetch, "open_source", open_source)
+    monkeypatch.setattr(subset_cache, "cache", subset_cache.SubsetCache(tmp_path / "cache"))
+    config = model_fetch.FetchConfig(
+        model_name="CBOFS",
+        output_pth=tmp_path / "first.nc",
+        start=pd.Timestamp("2022-06-20"),
+        end=pd.Timestamp("2022-06-20T23:00"),
+        bbox=(-76.0, 37.0, -75.5, 37.5),
+        timing="forecast",
+        use_cache=True,
+    )
+
+    info = model_fetch.fetch(config)
+    cached = model_fetch.fetch(replace(config, output_pth=tmp_path / "second.nc"))
+
+    assert len(opened) == 1
+    assert cached.n_times == info.n_times == 24
+    assert cached.nbytes == info.nbytes
+def test_fetch_writes_lazy_subset(tmp_path, monkeypatch, bounds_cache):
+    bounds_cache["CBOFS"] = (-77.5, 36.0, -75.0, 40.0)
+    monkeypatch.setattr(model_fetch, "open_source", lambda *args, **kwargs: make_dataset())
+    written = []
+
+    def write_checkpointed(ds, *args, **kwargs):
+        written.append(ds)
+
+    monkeypatch.setattr(writers, "write_checkpointed", write_checkpointed)
+    config = model_fetch.FetchConfig(
+        model_name="CBOFS",
+        output_pth=tmp_path / "lazy.nc",
+        start=pd.Timestamp("2022-06-20"),
+        end=pd.Timestamp("2022-06-20T23:00"),
+        bbox=(-76.0, 37.0, -75.5, 37.5),
+        timing="forecast",
+    )
+
+    model_fetch.fetch(config)
+
+    [subset] = written
+    assert subset["u"].chunks is not None
+    assert subset.sizes["lon"] < 30 and subset.sizes["lat"] < 20
+
+
+def test_decimation_strides():
+    ds = make_dataset()
+    assert not model_fetch.Decimation().active
+    assert model_fetch.Decimation().apply(ds) is ds
+
+    strides = model_fetch.Decimation(xy_stride=2, time_stride=3).strides(ds)
+    assert strides == {"lon": 2, "lat": 2, "time": 3}
+
+    # the grid spacing is ~0.043 degrees in lon and ~0.053 in lat
+    decimation = model_fetch.Decimation(xy_resolution=0.15, time_resolution="6h")
+    assert decimation.time_resolution == pd.Timedelta(hours=6)
+    assert decimation.strides(ds) == {"lon": 3, "lat": 3, "time": 6}
+
+    with pytest.raises(ValueError):
+        model_fetch.Decimation(xy_stride=0)
+
+
+def test_decimation_apply_is_lazy():
+    ds = make_dataset()
+    decimated = model_fetch.Decimation(xy_stride=2, time_stride=4).apply(ds)
+
+    assert decimated["u"].chunks is not None
+    assert dict(decimated.sizes) == {"time": 6, "lat": 10, "lon": 15}
+    np.testing.assert_array_equal(decimated["u"], ds["u"].values[::4, ::2, ::2])
+
+
+def test_rotate_longitude_is_lazy(bounds_cache, tmp_path):
+    lon, lat = np.meshgrid(np.linspace(280.0, 290.0, 6), np.linspace(30.0, 35.0, 4))
+    ds = xr.Dataset(
+        {"u": (("y", "x"), np.ones(lon.shape), {"standard_name": "eastward_sea_water_velocity"})},
+        coords={
+            "lon": (("y", "x"), lon, {"standard_name": "longitude"}),
+            "lat": (("y", "x"), lat, {"standard_name": "latitude"}),
+        },
+    )
+    ds.to_netcdf(tmp_path / "grid.nc")
+
+    with xr.open_dataset(tmp_path / "grid.nc") as opened:
+        rotated = model_fetch.rotate_longitude(opened, "GFS")
+        assert rotated["lon"].chunks is not None
+        assert rotated["lon"].attrs["standard_name"] == "longitude"
+        np.testing.assert_allclose(rotated["lon"], lon - 360)
+        assert model_fetch.rotate_longitude(opened, "NYOFS") is opened
+    assert model_fetch._ROTATION_CACHE == {"GFS": True, "NYOFS": False}
+
+
+def test_rotate_longitude_coordinate():
+    ds = make_dataset()
+    ds = ds.assign_coords(lon=("lon", np.linspace(170.0, 190.0, 30), ds["lon"].attrs))
+    with pytest.warns(UserWarning, match="not monotonic"):
+        assert model_fetch.rotate_longitude(ds)["lon"].max() == 190.0
+
+    ds = ds.assign_coords(lon=("lon", np.linspace(200.0, 210.0, 30), ds["lon"].attrs))
+    np.testing.assert_allclose(model_fetch.rotate_longitude(ds)["lon"], np.linspace(-160.0, -150.0, 30))
+
+
+def make_3d_dataset(z_name="depth", z_values=(0.0, 5.0, 10.0, 20.0, 50.0), z_attrs=None):
+    ds = make_dataset(n_times=4, ny=3, nx=4)
+    z_attrs = z_attrs or {"axis": "Z", "positive": "down", "units": "m"}
+    u = ds["u"].expand_dims({z_name: len(z_values)}, axis=1)
+    return ds.assign(u=u).assign_coords({z_name: (z_name, list(z_values), z_attrs)})
+
+
+def test_vertical_layout_cached(monkeypatch):
+    monkeypatch.setattr(model_fetch, "_LAYOUT_CACHE", {})
+    ds = make_3d_dataset()
+
+    layout = model_fetch.vertical_layout(ds, "CBOFS")
+    assert layout.surface == {"depth": 0}
+    assert layout.levels == {"depth": (0.0, 5.0, 10.0, 20.0, 50.0)}
+    assert layout.upward == {"depth": False}
+
+    # other time windows of the same grid reuse the layout
+    calls = []
+    monkeypatch.setattr(model_fetch, "decode_vertical_layout", calls.append)
+    assert model_fetch.vertical_layout(ds.isel(time=slice(0, 2)), "CBOFS") is layout
+    assert calls == []
+
+    surface = model_fetch.select_surface(ds, "CBOFS")
+    assert "depth" not in surface["u"].dims
+    np.testing.assert_array_equal(surface["u"], ds["u"].isel(depth=0))
+
+
+def test_sigma_layout(monkeypatch):
+    monkeypatch.setattr(model_fetch, "_LAYOUT_CACHE", {})
+    attrs = {"axis": "Z", "positive": "up", "standard_name": "ocean_s_coordinate_g2"}
+    ds = make_3d_dataset("s_rho", (-0.875, -0.625, -0.375, -0.125), attrs)
+
+    layout = model_fetch.vertical_layout(ds)
+    assert layout.surface == {"s_rho": 3}
+    assert layout.upward == {"s_rho": True}
+    assert layout.levels == {}
+    with pytest.raises(ValueError):
+        model_fetch.select_depth(ds, 10.0)
+
+
+def test_select_depth(monkeypatch):
+    monkeypatch.setattr(model_fetch, "_LAYOUT_CACHE", {})
+    ds = make_3d_dataset()
+
+    assert model_fetch.select_depth(ds, 12.0)["depth"].item() == 10.0
+    assert model_fetch.select_depth(ds, (5.0, 20.0))["depth"].values.tolist() == [5.0, 10.0, 20.0]
+    assert model_fetch.parse_depth("0,50") == (0.0, 50.0)
+    assert model_fetch.parse_depth("10") == 10.0
+    with pytest.raises(ValueError):
+        model_fetch.select_depth(ds, (100.0, 200.0))
+
+
+def test_subset_polygon(monkeypatch):
+    monkeypatch.setattr(model_fetch, "_MASK_CACHE", {})
+    ds = make_dataset()
+    # a thin diagonal strip
+    polygon = shapely.Polygon([(-76.4, 36.8), (-76.3, 36.8), (-75.4, 37.7), (-75.5, 37.7)])
+
+    subset = model_fetch.subset_polygon(ds, polygon)
+
+    lon, lat = np.meshgrid(ds["lon"], ds["lat"])
+    inside = shapely.intersects_xy(polygon, lon, lat)
+    rows, cols = np.flatnonzero(inside.any(axis=1)), np.flatnonzero(inside.any(axis=0))
+    assert subset.sizes["lat"] == rows[-1] - rows[0] + 1
+    assert subset.sizes["lon"] == cols[-1] - cols[0] + 1
+    window = (slice(None), slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+    expected = np.where(inside[window[1:]], ds["u"].values[window], np.nan)
+    np.testing.assert_array_equal(subset["u"], expected)
+    assert subset["u"].attrs == ds["u"].attrs
+    assert subset["u"].chunks is not None
+    with pytest.raises(ValueError):
+        model_fetch.subset_polygon(ds, shapely.box(0, 0, 1, 1))
+
+    # the mask is reused for the same grid and polygon
+    assert len(model_fetch._MASK_CACHE) == 2
+    monkeypatch.setattr(shapely, "intersects_xy", None)
+    model_fetch.subset_polygon(ds, polygon, trim=False)
+
+
+def test_fetch_config_polygon():
+    points = model_fetch.parse_polygon("-76,37;-75.5,37.5;-76,37.8")
+    config = model_fetch.FetchConfig(
+        model_name="CBOFS",
+        output_pth="out.nc",
+        start=pd.Timestamp("2022-06-20"),
+        end=pd.Timestamp("2022-06-21"),
+        bbox=None,
+        timing="forecast",
+        polygon=points,
+    )
+    assert config.bbox == (-76.0, 37.0, -75.5, 37.8)
+
+
+def make_global_dataset(lon):
+    lat = np.arange(-10.0, 11.0)
+    data = np.add.outer(lat, lon)[np.newaxis].repeat(3, axis=0)
+    ds = xr.Dataset(
+        {"u": (("time", "lat", "lon"), data, {"standard_name": "eastward_sea_water_velocity"})},
+        coords={
+            "time": ("time", pd.date_range("2022-06-20", periods=3, freq="h")),
+            "lat": ("lat", lat, {"standard_name": "latitude"}),
+            "lon": ("lon", lon, {"standard_name": "longitude", "units": "degrees_east"}),
+        },
+    )
+    return ds.chunk({"time": 1})
+
+
+def test_dateline_bbox(bounds_cache):
+    # across the antimeridian, for a model in [-180, 180]
+    assert model_fetch.dateline_bbox("HYCOM", (170, -5, -170, 5)) == (170, -5, -170, 5)
+    assert model_fetch.dateline_bbox("HYCOM", (170, -5, 190, 5)) == (170, -5, -170, 5)
+    assert model_fetch.dateline_bbox("HYCOM", (-10, -5, 10, 5)) is None
+    # across the prime meridian, for a model in [0, 360]
+    assert model_fetch.dateline_bbox("GFS", (-10, -5, 10, 5)) == (350, -5, 10, 5)
+    assert model_fetch.dateline_bbox("GFS", (170, -5, -170, 5)) is None
+    assert model_fetch.dateline_bbox("GFS", (-180, -5, 180, 5)) is None
+
+
+def test_sub_grid_dateline():
+    ds = make_global_dataset(np.arange(-180.0, 180.0))
+
+    subset = model_fetch.sub_grid_dateline(ds, (170, -5, -170, 5))
+
+    assert subset["lon"].values.tolist() == list(range(170, 191))
+    assert subset["lon"].attrs["standard_name"] == "longitude"
+    assert subset["lat"].values.tolist() == list(range(-5, 6))
+    assert subset["u"].chunks is not None
+    expected = ds["u"].isel(lon=list(range(350, 360)) + list(range(0, 11)), lat=slice(5, 16))
+    np.testing.assert_array_equal(subset["u"], expected)
+    assert subset.sizes["time"] == 3
+
+
+def test_sub_grid_prime_meridian():
+    ds = make_global_dataset(np.arange(0.0, 360.0))
+
+    subset = model_fetch.sub_grid_dateline(ds, (350, -5, 10, 5))
+
+    assert subset["lon"].values.tolist() == list(range(-10, 11))
+    # the data are lat + the original longitude
+    original_lon = list(range(350, 360)) + list(range(0, 11))
+    np.testing.assert_array_equal(subset["u"].isel(time=0, lat=0), np.array(original_lon) - 5.0)
+
+
+def test_dateline_polygon(bounds_cache, monkeypatch):
+    monkeypatch.setattr(model_fetch, "_MASK_CACHE", {})
+    ds = make_global_dataset(np.arange(-180.0, 180.0))
+    # a triangle across the dateline, from 172 to -172
+    config = model_fetch.FetchConfig(
+        model_name="HYCOM",
+        output_pth=None,
+        start=pd.Timestamp("2022-06-20"),
+        end=pd.Timestamp("2022-06-20T02:00"),
+        bbox=(170.0, -5.0, -170.0, 5.0),
+        timing="hindcast",
+        standard_names=["eastward_sea_water_velocity"],
+        polygon=[(172.0, -4.0), (-172.0, -4.0), (180.0, 4.0)],
+    )
+
+    subset = model_fetch.subset_dataset(ds, config)
+
+    # both halves of the polygon are kept
+    assert subset["lon"].values.tolist() == list(range(172, 189))
+    inside = subset["u"].isel(time=0).notnull()
+    assert inside.sel(lat=-4).all()
+    assert inside.sel(lon=180).sum() == 9
+    assert not inside.sel(lat=4, lon=[179, 181]).any()
+
+    # across the prime meridian, for a model in [0, 360]
+    polygon = model_fetch.dateline_polygon(
+        shapely.Polygon([(355.0, -4.0), (5.0, -4.0), (0.0, 4.0)]),
+        model_fetch.dateline_bbox("GFS", (-10, -5, 10, 5)),
+    )
+    assert polygon.bounds == (-5.0, -4.0, 5.0, 4.0)
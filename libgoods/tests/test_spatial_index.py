@@ -0,0 +1,57 @@
+"""
+tests of the model spatial index
+"""
+
+import pytest
+from shapely.geometry import Polygon
+
+from libgoods.spatial_index import ModelSpatialIndex, normalize_longitude
+
+
+class FakeMeta:
+    def __init__(self, identifier, bounding_box, bounding_poly=()):
+        self.identifier = identifier
+        self.bounding_box = bounding_box
+        self.bounding_poly = bounding_poly
+
+
+METAS = [
+    # global, in 0 -- 360
+    FakeMeta("GFS", [0.0, -90.0, 360.0, 90.0]),
+    FakeMeta(
+        "NYOFS",
+        [-74.3, 40.4, -73.8, 40.9],
+        # thin diagonal domain
+        [(-74.3, 40.4), (-74.2, 40.4), (-73.8, 40.9), (-73.9, 40.9), (-74.3, 40.4)],
+    ),
+    # entirely east of 180
+    FakeMeta("ALASKA", [185.0, 50.0, 200.0, 60.0]),
+]
+
+
+@pytest.fixture
+def index():
+    return ModelSpatialIndex(METAS)
+
+
+def test_normalize_longitude_split():
+    geom = normalize_longitude(Polygon([(0, -10), (360, -10), (360, 10), (0, 10)]))
+    assert geom.bounds == (-180, -10, 180, 10)
+    assert geom.area == pytest.approx(360 * 20)
+
+
+def test_query_western_hemisphere(index):
+    bounds = [(-180, 0), (-180, 10), (-150, 10), (-150, 0)]
+    assert index.query(bounds) == ["GFS"]
+
+
+def test_query_east_of_dateline(index):
+    bounds = [(-170, 52), (-170, 55), (-165, 55), (-165, 52)]
+    assert index.query(bounds) == ["GFS", "ALASKA"]
+
+
+def test_query_exact(index):
+    # inside the NYOFS bounding box, but outside its domain polygon
+    bounds = [(-74.29, 40.85), (-74.29, 40.89), (-74.2, 40.89), (-74.2, 40.85)]
+    assert index.query(bounds) == ["GFS", "NYOFS"]
+    assert index.query(bounds, exact=True) == ["GFS"]
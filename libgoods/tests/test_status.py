@@ -0,0 +1,96 @@
+"""
+tests of the concurrent source status prober, against a local HTTP server
+"""
+
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+import pytest
+
+from libgoods.status import StatusProber, StatusTarget
+
+LATENCY = 0.2
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Answers like an OPeNDAP server, after a delay"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            time.sleep(server.latency)
+            status = 404 if "offline" in self.path else 200
+            body = b"Attributes {}"
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.lock = threading.Lock()
+    server.active = 0
+    server.max_active = 0
+    server.latency = LATENCY
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_targets(server, n, path="dataset"):
+    url = f"http://127.0.0.1:{server.server_port}/{path}"
+    return [StatusTarget(f"MODEL{i}", "forecast", url) for i in range(n)]
+
+
+def test_probe_concurrently_with_host_limit(server):
+    prober = StatusProber(max_workers=8, per_host=4, timeout=5)
+    targets = make_targets(server, 8)
+
+    t0 = time.monotonic()
+    results = list(prober.probe_all(targets))
+    elapsed = time.monotonic() - t0
+
+    assert sorted(r.model_name for r in results) == [t.model_name for t in targets]
+    assert all(r.online for r in results)
+    assert server.max_active == 4
+    # two rounds of four, rather than eight in sequence
+    assert elapsed < 6 * LATENCY
+
+
+def test_probe_offline_and_availability(server):
+    start, end = pd.Timestamp("2022-06-01"), pd.Timestamp("2022-06-08")
+    prober = StatusProber(availability=lambda model_name, timing: (start, end))
+
+    [online] = prober.probe_all(make_targets(server, 1))
+    [offline] = prober.probe_all(make_targets(server, 1, path="offline"))
+
+    assert online.online and (online.start, online.end) == (start, end)
+    assert not offline.online and offline.start is None
+    assert offline.error == "HTTP 404"
+
+
+def test_probe_timeout(server):
+    server.latency = 1.0
+    prober = StatusProber(timeout=0.1)
+
+    [result] = prober.probe_all(make_targets(server, 1))
+
+    assert not result.online
+    assert result.error
@@ -0,0 +1,177 @@
+"""
+tests of the local subset cache
+"""
+
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from libgoods import writers
+
+from libgoods.subset_cache import SubsetCache, SubsetExtent, request_key
+
+try:
+    from libgoods import model
+    from libgoods.tests.test_model_fetch import make_dataset
+except ImportError:
+    model = None
+
+VARIABLES = frozenset(["eastward_sea_water_velocity", "northward_sea_water_velocity"])
+
+
+def make_extent(bbox=(-76.5, 36.75, -75.25, 37.75), start="2022-06-20", end="2022-06-21",
+                variables=VARIABLES, source="CBOFS/forecast"):
+    return SubsetExtent(source, bbox, pd.Timestamp(start), pd.Timestamp(end), variables)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return SubsetCache(root=tmp_path / "subsets", max_bytes=250)
+
+
+class Producer:
+    def __init__(self, nbytes=100, delay=0.0):
+        self.nbytes = nbytes
+        self.delay = delay
+        self.calls = 0
+
+    def __call__(self, pth):
+        self.calls += 1
+        time.sleep(self.delay)
+        pth.write_bytes(b"x" * self.nbytes)
+
+
+def test_request_key_is_canonical():
+    key = request_key(
+        model="CBOFS",
+        start=pd.Timestamp("2022-06-20T12:00"),
+        bounds=(-76.5, 36.75, -75.25, 37.75),
+        params={"surface currents", "surface winds"},
+    )
+    assert key == request_key(
+        params={"surface winds", "surface currents"},
+        bounds=[-76.5000000001, 36.75, -75.25, 37.75],
+        start=pd.Timestamp("2022-06-20T08:00-04:00"),
+        model="CBOFS",
+    )
+    assert key != request_key(
+        model="CBOFS",
+        start=pd.Timestamp("2022-06-20T13:00"),
+        bounds=(-76.5, 36.75, -75.25, 37.75),
+        params={"surface currents", "surface winds"},
+    )
+
+
+def test_hit_and_miss(cache, tmp_path):
+    producer = Producer()
+
+    first = cache.fetch_to("a", producer, tmp_path / "first.nc")
+    second = cache.fetch_to("a", producer, tmp_path / "second.nc")
+
+    assert producer.calls == 1
+    assert first.read_bytes() == second.read_bytes()
+    assert (cache.stats.hits, cache.stats.misses) == (1, 1)
+    assert cache.stats.hit_rate == 0.5
+
+
+def test_lru_eviction(cache):
+    producer = Producer()
+    cache.get_or_create("a", producer)
+    time.sleep(0.01)
+    cache.get_or_create("b", producer)
+    time.sleep(0.01)
+    cache.get_or_create("a", producer)  # "b" is now the least recently used
+    time.sleep(0.01)
+    cache.get_or_create("c", producer)
+
+    assert sorted(pth.stem for pth, _, _ in cache.entries()) == ["a", "c"]
+    assert cache.stats.evictions == 1
+    assert cache.total_bytes() == 200
+
+
+def test_in_flight_download_is_shared(cache):
+    producer = Producer(delay=0.2)
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(cache.get_or_create("a", producer)))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert producer.calls == 1
+    assert len(set(results)) == 1
+    assert (cache.stats.misses, cache.stats.shared) == (1, 3)
+
+
+def test_failed_download_is_not_cached(cache):
+    def fail(pth):
+        raise RuntimeError("timed out")
+
+    with pytest.raises(RuntimeError):
+        cache.get_or_create("a", fail)
+    assert not cache.path("a").exists()
+
+    producer = Producer()
+    cache.get_or_create("a", producer)
+    assert producer.calls == 1
+
+
+def test_extent_contains():
+    extent = make_extent()
+    assert extent.contains(extent)
+    assert extent.contains(
+        make_extent(bbox=(-76.0, 37.0, -75.5, 37.5), start="2022-06-20T06:00",
+                    variables=frozenset(["eastward_sea_water_velocity"]))
+    )
+    assert not extent.contains(make_extent(bbox=(-77.0, 37.0, -75.5, 37.5)))
+    assert not extent.contains(make_extent(end="2022-06-22"))
+    assert not extent.contains(make_extent(source="CBOFS/nowcast"))
+    assert not extent.contains(make_extent(variables=VARIABLES | {"eastward_wind"}))
+    assert SubsetExtent.from_pyson(extent.as_pyson()) == extent
+
+
+def test_find_superset(cache):
+    cache.get_or_create("big", Producer(200), make_extent())
+    cache.get_or_create("small", Producer(50), make_extent(bbox=(-76.0, 37.0, -75.5, 37.5)))
+    time.sleep(0.01)
+
+    assert cache.find_superset(make_extent(bbox=(-76.4, 37.1, -75.6, 37.4))) == "big"
+    time.sleep(0.01)
+    # the smallest file containing the request
+    assert cache.find_superset(make_extent(bbox=(-75.9, 37.1, -75.6, 37.4))) == "small"
+    assert cache.find_superset(make_extent(end="2022-06-22")) is None
+    assert cache.stats.superset_hits == 2
+
+    # persisted, and dropped on eviction of the least recently used
+    time.sleep(0.01)
+    reloaded = SubsetCache(root=cache.root, max_bytes=cache.max_bytes)
+    assert set(reloaded.extents) == {"big", "small"}
+    reloaded.get_or_create("other", Producer(100), make_extent(source="TBOFS/forecast"))
+    assert set(reloaded.extents) == {"small", "other"}
+
+
+@pytest.mark.skipif(model is None, reason="needs model_catalogs")
+def test_slice_from_superset(cache):
+    ds = make_dataset()
+    superset = cache.get_or_create(
+        "big", lambda pth: writers.write_checkpointed(ds, pth, report=None), make_extent()
+    )
+    request = make_extent(bbox=(-76.0, 37.0, -75.5, 37.5),
+                          start="2022-06-20T03:00", end="2022-06-20T10:00")
+
+    assert cache.find_superset(request) == "big"
+    with xr.open_dataset(superset, chunks={}) as cached:
+        result = model.slice_subset(cached, request.bbox, request.start, request.end).load()
+
+    expected = ds.sel(
+        time=slice(request.start, request.end), lon=slice(-76.0, -75.5), lat=slice(37.0, 37.5)
+    )
+    assert result.sizes == expected.sizes
+    np.testing.assert_array_equal(result["u"].values, expected["u"].values)
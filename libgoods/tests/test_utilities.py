@@ -78,3 +78,12 @@ def test_flatten_bbox():
     fbbox = utilities.flatten_bbox(bbox)
 
     assert fbbox == (23, -88, 24, -87)
+
+
+def test_polygon_points():
+    assert utilities.polygon_points(((-88, 23), (-87, 24))) is None
+    rectangle = [(-130, 45), (-130, 50), (-125, 50), (-125, 45), (-130, 45)]
+    assert utilities.polygon_points(rectangle) is None
+
+    triangle = [(-130, 45), (-125, 50), (-125, 45)]
+    assert utilities.polygon_points(triangle) == [(-130.0, 45.0), (-125.0, 50.0), (-125.0, 45.0)]
@@ -0,0 +1,272 @@
+"""
+tests of writing subsets to disk
+"""
+
+import json
+
+import netCDF4
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from libgoods import writers
+
+
+def make_dataset(n_times=10, ny=4, nx=5):
+    """A small dataset with a 2D (curvilinear style) grid"""
+    time = pd.date_range("2022-06-20", periods=n_times, freq="30min")
+    lon, lat = np.meshgrid(np.linspace(-76.5, -75.25, nx), np.linspace(36.75, 37.75, ny))
+    data = np.arange(n_times * ny * nx, dtype="float32").reshape(n_times, ny, nx)
+    data[:, 0, 0] = np.nan
+    ds = xr.Dataset(
+        {"u": (("time", "y", "x"), data, {"standard_name": "eastward_sea_water_velocity"})},
+        coords={
+            "time": ("time", time, {"standard_name": "time", "axis": "T"}),
+            "lon": (("y", "x"), lon, {"standard_name": "longitude"}),
+            "lat": (("y", "x"), lat, {"standard_name": "latitude"}),
+        },
+    )
+    return ds.chunk({"time": 1})
+
+
+def test_time_blocks():
+    ds = make_dataset()
+    step_nbytes = 4 * 5 * 4 + 8
+    blocks = writers.time_blocks(ds, "time", 3 * step_nbytes)
+    assert blocks == [slice(0, 3), slice(3, 6), slice(6, 9), slice(9, 10)]
+    assert writers.time_blocks(ds, "time", 1) == [slice(i, i + 1) for i in range(10)]
+
+
+def test_write_streaming(tmp_path):
+    ds = make_dataset()
+    pth = tmp_path / "streamed.nc"
+    lines = []
+
+    stats = writers.write_streaming(ds, pth, memory_budget=300, report=lines.append)
+
+    assert len(stats) == len(lines) == 4
+    assert [(s.start, s.stop) for s in stats] == [(0, 3), (3, 6), (6, 9), (9, 10)]
+    with xr.open_dataset(pth) as result:
+        xr.testing.assert_identical(result.load(), ds.load())
+        assert result.encoding["unlimited_dims"] == {"time"}
+
+
+class Interrupt(Exception):
+    pass
+
+
+def test_write_checkpointed_resumes(tmp_path, monkeypatch):
+    ds = make_dataset()
+    pth = tmp_path / "checkpointed.nc"
+    append_block = writers.append_block
+    calls = []
+
+    def flaky_append(block, output_pth, time_dim, offset):
+        calls.append(offset)
+        if offset == 6 and calls.count(6) == 1:
+            raise Interrupt()
+        append_block(block, output_pth, time_dim, offset)
+
+    monkeypatch.setattr(writers, "append_block", flaky_append)
+
+    with pytest.raises(Interrupt):
+        writers.write_checkpointed(ds, pth, memory_budget=300, report=None)
+    assert not pth.exists()
+    assert writers.partial_path(pth).exists()
+    manifest = json.loads(writers.manifest_path(pth).read_text())
+    assert manifest["completed"] == [0, 1]
+
+    # a different budget is ignored: the blocks of the first attempt are used
+    stats = writers.write_checkpointed(ds, pth, memory_budget=1, report=None)
+
+    assert [(s.start, s.stop) for s in stats] == [(6, 9), (9, 10)]
+    assert calls == [3, 6, 6, 9]
+    assert not writers.partial_path(pth).exists()
+    assert not writers.manifest_path(pth).exists()
+    with xr.open_dataset(pth) as result:
+        xr.testing.assert_identical(result.load(), ds.load())
+
+
+def test_write_checkpointed_restarts_for_other_area(tmp_path, monkeypatch):
+    ds = make_dataset()
+    pth = tmp_path / "checkpointed.nc"
+
+    def interrupted_append(block, output_pth, time_dim, offset):
+        raise Interrupt()
+
+    with monkeypatch.context() as patched:
+        patched.setattr(writers, "append_block", interrupted_append)
+        with pytest.raises(Interrupt):
+            writers.write_checkpointed(ds, pth, memory_budget=300, report=None)
+    assert writers.partial_path(pth).exists()
+
+    # same shape and times, another area
+    other = ds.assign_coords(lon=ds["lon"] + 1.0).assign(u=ds["u"] + 1.0)
+    stats = writers.write_checkpointed(other, pth, memory_budget=300, report=None)
+
+    assert len(stats) == 4
+    with xr.open_dataset(pth) as result:
+        xr.testing.assert_identical(result.load(), other.load())
+
+
+def test_write_checkpointed_restarts_for_other_subset(tmp_path):
+    pth = tmp_path / "checkpointed.nc"
+    writers.partial_path(pth).write_bytes(b"not netCDF")
+    writers.manifest_path(pth).write_text(
+        json.dumps(
+            {
+                "version": writers.MANIFEST_VERSION,
+                "signature": "another subset",
+                "blocks": [[0, 10]],
+                "completed": [0],
+            }
+        )
+    )
+    ds = make_dataset()
+
+    stats = writers.write_checkpointed(ds, pth, memory_budget=300, report=None)
+
+    assert len(stats) == 4
+    with xr.open_dataset(pth) as result:
+        xr.testing.assert_identical(result.load(), ds.load())
+
+
+def test_append_dataset(tmp_path):
+    ds = make_dataset()
+    pth = tmp_path / "rolling.nc"
+    writers.write_streaming(ds.isel(time=slice(0, 6)), pth, report=None)
+
+    writers.append_dataset(ds.isel(time=slice(6, 10)), pth, memory_budget=300, report=None)
+
+    time_dim, times = writers.read_times(pth)
+    assert time_dim == "time"
+    assert times.equals(pd.DatetimeIndex(ds["time"].values))
+    with xr.open_dataset(pth) as result:
+        xr.testing.assert_identical(result.load(), ds.load())
+
+
+def test_append_dataset_replaces_overlap(tmp_path):
+    ds = make_dataset()
+    pth = tmp_path / "rolling.nc"
+    writers.write_streaming(ds.isel(time=slice(0, 6)), pth, report=None)
+    newer = ds.isel(time=slice(4, 10)) + 1000
+
+    writers.append_dataset(newer, pth, report=None)
+
+    with xr.open_dataset(pth) as result:
+        assert result.sizes["time"] == 10
+        np.testing.assert_array_equal(result["u"][:4], ds["u"][:4])
+        np.testing.assert_array_equal(result["u"][4:], newer["u"])
+
+
+def test_append_dataset_checks_grid(tmp_path):
+    ds = make_dataset()
+    pth = tmp_path / "rolling.nc"
+    writers.write_streaming(ds.isel(time=slice(0, 6)), pth, report=None)
+
+    with pytest.raises(ValueError):
+        writers.append_dataset(ds.isel(time=slice(6, 10), x=slice(0, 3)), pth, report=None)
+    ds.isel(time=slice(0, 6)).to_netcdf(tmp_path / "fixed.nc")
+    with pytest.raises(ValueError):
+        writers.append_dataset(ds.isel(time=slice(6, 10)), tmp_path / "fixed.nc", report=None)
+
+
+def test_read_times_ignores_unwritten_steps(tmp_path):
+    ds = make_dataset()
+    pth = tmp_path / "rolling.nc"
+    writers.write_streaming(ds.isel(time=slice(0, 6)), pth, report=None)
+    # as if a write was interrupted after the data, before the times
+    writers.append_block(ds.isel(time=slice(6, 8)).drop_vars("time").load(), pth, "time", 6)
+
+    _, times = writers.read_times(pth)
+
+    assert len(times) == 6
+
+
+def test_output_encoding(tmp_path):
+    ds = make_dataset(n_times=10, ny=40, nx=50)
+    ds["u"] = ds["u"].astype("float64")
+    plain = tmp_path / "plain.nc"
+    compressed = tmp_path / "compressed.nc"
+    encoding = writers.OutputEncoding(significant_digits=3, float32=True, time_chunk=2)
+
+    writers.write_checkpointed(ds, plain, report=None)
+    writers.write_checkpointed(ds, compressed, report=None, encoding=encoding)
+
+    assert compressed.stat().st_size < plain.stat().st_size
+    with netCDF4.Dataset(compressed) as nc:
+        u = nc.variables["u"]
+        assert u.dtype == np.float32
+        assert u.filters()["zlib"] and u.filters()["shuffle"]
+        assert u.chunking() == [2, 40, 50]
+        assert nc.variables["time"].dtype == np.float64
+    with xr.open_dataset(compressed) as result:
+        np.testing.assert_allclose(result["u"], ds["u"], rtol=1e-3)
+        assert result.encoding["unlimited_dims"] == {"time"}
+
+
+def test_output_encoding_options():
+    assert writers.OutputEncoding().precision == ""
+    assert writers.OutputEncoding.create({"float32": True}).precision == "float32"
+    assert writers.OutputEncoding.create(None) is None
+    with pytest.raises(ValueError):
+        writers.OutputEncoding(compression="lzma")
+    with pytest.raises(ValueError):
+        writers.OutputEncoding(time_chunk=0)
+
+
+def test_bitround():
+    values = np.array([1.2345678, -98765.4321, np.nan, np.inf, 0.0])
+    rounded = writers.bitround(values, 3)
+
+    np.testing.assert_allclose(rounded, values, rtol=1e-3)
+    assert np.isnan(rounded[2]) and np.isinf(rounded[3])
+    # the dropped mantissa bits are zero
+    assert np.all(rounded[:2].view(np.uint64) & np.uint64(2 ** 40 - 1) == 0)
+    assert writers.bitround(np.arange(3), 3).dtype == np.int64
+
+
+def test_write_zarr(tmp_path):
+    pytest.importorskip("zarr")
+    ds = make_dataset()
+    pth = tmp_path / "subset.zarr"
+    encoding = writers.OutputEncoding(compression="zstd", significant_digits=4, time_chunk=2)
+
+    writers.write_output(ds, pth, writers.ZARR, encoding=encoding)
+
+    # zarr 3 or zarr 2 metadata
+    assert (pth / "zarr.json").exists() or (pth / ".zgroup").exists()
+    assert not writers.partial_path(pth).exists()
+    with xr.open_zarr(pth, consolidated=True) as result:
+        assert result["u"].encoding["chunks"] == (2, 4, 5)
+        part = result.sel(time=slice("2022-06-20T01:00", "2022-06-20T02:00")).load()
+    np.testing.assert_allclose(part["u"], ds["u"][2:5], rtol=1e-4)
+    assert np.isnan(part["u"][0, 0, 0])
+
+
+def test_zarr_compression():
+    numcodecs = pytest.importorskip("numcodecs")
+    assert writers._zarr_compression("zlib", 5, zarr_major=2) == {
+        "compressor": numcodecs.Zlib(level=5)
+    }
+    assert writers._zarr_compression(None, 5, zarr_major=2) == {"compressor": None}
+    zarr = pytest.importorskip("zarr")
+    if int(zarr.__version__.split(".")[0]) >= 3:
+        [codec] = writers._zarr_compression("zstd", 3, zarr_major=3)["compressors"]
+        assert codec.level == 3
+
+
+def test_export_cached(tmp_path):
+    pytest.importorskip("zarr")
+    ds = make_dataset()
+    cached = tmp_path / "cached.nc"
+    writers.write_checkpointed(ds, cached, report=None)
+
+    writers.export_cached()(cached, tmp_path / "copy.nc")
+    writers.export_cached(writers.ZARR)(cached, tmp_path / "copy.zarr")
+
+    with xr.open_dataset(tmp_path / "copy.nc") as copy:
+        xr.testing.assert_identical(copy.load(), ds.load())
+    with xr.open_zarr(tmp_path / "copy.zarr") as store:
+        xr.testing.assert_equal(store.load(), ds.load())
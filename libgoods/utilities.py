@@ -82,6 +82,25 @@ def polygon2bbox(bounds):
     return ((min_lon, min_lat), (max_lon, max_lat))
 
 
+def polygon_points(bounds):
+    """
+    Returns the (lon, lat) points of bounds if they are a non-rectangular
+    polygon, or None if a bounding box describes them exactly: a
+    (lower-left, upper-right) pair, or the corners of an axis aligned
+    rectangle.
+    """
+    points = np.asarray(bounds, dtype=np.float64).reshape(-1, 2)
+    if len(points) <= 2:
+        return None
+    (min_lon, min_lat), (max_lon, max_lat) = polygon2bbox(points)
+    on_corners = np.isin(points[:, 0], (min_lon, max_lon)) & np.isin(
+        points[:, 1], (min_lat, max_lat)
+    )
+    if on_corners.all() and len(np.unique(points, axis=0)) == 4:
+        return None
+    return [tuple(point) for point in points.tolist()]
+
+
 def bbox2polygon(bbox):
     """
     Converts (W, S, E, N) bounding box to a four point polygon:
@@ -0,0 +1,715 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Writing model subsets to disk.
+
+`write_streaming` writes a lazily loaded subset one block of time steps at
+a time, so the memory used is bounded by the block size rather than the
+size of the whole subset. The first block creates the file, with an
+unlimited time dimension, and the following blocks are appended to it.
+
+`write_checkpointed` does the same, but writes to a temporary file and
+records each completed block in a sidecar manifest, so an interrupted
+download can be resumed from the first missing block. Once every block is
+written the file is verified and renamed into place.
+
+`append_dataset` appends newer time steps to a file written this way, e.g.
+the latest hours of a forecast.
+
+`write_zarr` writes a Zarr store instead, with one chunk object per block
+of time steps, so the chunks are written in parallel and readers can load
+a partial time range without opening one monolithic file.
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple
+
+import cf_xarray  # noqa: F401 -- registers the .cf accessor
+import netCDF4
+import numpy as np
+import pandas as pd
+import xarray as xr
+from xarray.backends.locks import HDF5_LOCK
+
+from libgoods.performance import Timer
+
+# Output formats.
+NETCDF = "netcdf"
+ZARR = "zarr"
+OUTPUT_FORMATS = (NETCDF, ZARR)
+
+# Default memory budget for streaming writes.
+DEFAULT_MEMORY_BUDGET = 512 * 1024 * 1024
+# Version of the checkpoint manifest format.
+MANIFEST_VERSION = 1
+# Encodings of the source data that are kept when the output is written.
+_KEPT_ENCODINGS = ("dtype", "scale_factor", "add_offset", "_FillValue", "units", "calendar")
+# Held while writing a netCDF file. xarray's to_netcdf doesn't hold its HDF5
+# lock for every call into the (not thread safe) HDF5 library, so the writes
+# of concurrent fetches are serialized here. The data are loaded beforehand,
+# so downloads still run in parallel.
+_WRITE_LOCK = threading.Lock()
+
+
+def get_time_dim(ds: xr.Dataset) -> Optional[str]:
+    """Return the name of the time dimension of the dataset, if it has one."""
+    for varname in ds.cf.axes.get("T", []):
+        if varname in ds.variables and ds[varname].ndim == 1:
+            return ds[varname].dims[0]
+    for dim in ds.dims:
+        if "time" in str(dim).lower():
+            return dim
+    return None
+
+
+@dataclass
+class BlockStats:
+    """Timing of one block of a streaming write."""
+
+    index: int
+    start: int  # first time index of the block
+    stop: int  # one past the last time index of the block
+    nbytes: int
+    elapsed_ms: float
+
+    @property
+    def throughput(self) -> float:
+        """Throughput in MiB/s."""
+        if self.elapsed_ms <= 0:
+            return float("inf")
+        return self.nbytes / 1024 / 1024 / (self.elapsed_ms / 1000.0)
+
+
+@dataclass(frozen=True)
+class OutputEncoding:
+    """How the variables of the output file are compressed and chunked.
+
+    The defaults give lossless zlib compression, chunked one time step at a
+    time, which suits GNOME's reads of one time step at a time.
+    """
+
+    # "zlib", "zstd" or None for no compression
+    compression: Optional[str] = "zlib"
+    complevel: int = 4
+    shuffle: bool = True
+    # Lossy: keep only this many significant digits of floating point data.
+    significant_digits: Optional[int] = None
+    # Lossy: write float64 data variables as float32.
+    float32: bool = False
+    # Time steps per chunk; None for netCDF's default chunking.
+    time_chunk: Optional[int] = 1
+
+    def __post_init__(self):
+        """Check the options."""
+        if self.compression not in (None, "zlib", "zstd"):
+            raise ValueError(f"Unknown compression {self.compression!r}")
+        if self.compression == "zstd" and not netCDF4.__has_zstandard_support__:
+            raise ValueError("This netCDF4 library was built without zstd support")
+        if self.significant_digits is not None and self.significant_digits < 1:
+            raise ValueError("significant_digits must be at least 1")
+        if self.time_chunk is not None and self.time_chunk < 1:
+            raise ValueError("time_chunk must be at least 1")
+
+    @classmethod
+    def create(cls, value) -> Optional["OutputEncoding"]:
+        """Return an OutputEncoding from an OutputEncoding, a dict of its fields, or None."""
+        if value is None or isinstance(value, cls):
+            return value
+        return cls(**value)
+
+    @property
+    def precision(self) -> str:
+        """Description of the lossy options, empty if the encoding is lossless."""
+        lossy = []
+        if self.float32:
+            lossy.append("float32")
+        if self.significant_digits is not None:
+            lossy.append(f"significant_digits={self.significant_digits}")
+        return ",".join(lossy)
+
+    def variable_encodings(self, ds: xr.Dataset, time_dim: Optional[str]) -> dict:
+        """Return the ``to_netcdf`` encoding of each variable of ds."""
+        encodings = {}
+        for name, var in ds.variables.items():
+            enc = {k: v for k, v in var.encoding.items() if k in _KEPT_ENCODINGS}
+            if not np.issubdtype(var.dtype, np.number) or var.ndim == 0:
+                encodings[name] = enc
+                continue
+            is_data = name in ds.data_vars
+            is_float = np.issubdtype(var.dtype, np.floating)
+            if is_data and is_float and (self.float32 or self.significant_digits):
+                # the packing of the source would undo the lossy options
+                for key in ("dtype", "scale_factor", "add_offset"):
+                    enc.pop(key, None)
+                if self.float32 and var.dtype == np.float64:
+                    enc["dtype"] = "float32"
+                if self.significant_digits is not None:
+                    enc["significant_digits"] = self.significant_digits
+            if self.compression is not None:
+                enc["compression"] = self.compression
+                enc["complevel"] = self.complevel
+                enc["shuffle"] = self.shuffle
+            if self.time_chunk is not None and time_dim in var.dims:
+                enc["chunksizes"] = tuple(
+                    min(self.time_chunk, max(size, 1)) if dim == time_dim else max(size, 1)
+                    for dim, size in var.sizes.items()
+                )
+            encodings[name] = enc
+        return encodings
+
+
+def time_blocks(ds: xr.Dataset, time_dim: str, memory_budget: int) -> List[slice]:
+    """Split the time dimension into blocks that each fit in memory_budget bytes."""
+    n_times = ds.sizes[time_dim]
+    step_nbytes = sum(
+        var.nbytes // max(n_times, 1)
+        for var in ds.variables.values()
+        if time_dim in var.dims
+    )
+    steps = max(1, int(memory_budget // max(step_nbytes, 1)))
+    return [slice(i, min(i + steps, n_times)) for i in range(0, n_times, steps)]
+
+
+def _encode_values(var: xr.Variable, nc_var) -> np.ndarray:
+    """Encode the values of a (loaded) variable for writing with netCDF4."""
+    values = var.values
+    if np.issubdtype(values.dtype, np.datetime64):
+        calendar = getattr(nc_var, "calendar", "standard")
+        values, _, _ = xr.coding.times.encode_cf_datetime(values, nc_var.units, calendar)
+    elif np.issubdtype(values.dtype, np.floating):
+        # netCDF4 writes the masked values as the variable's _FillValue
+        values = np.ma.masked_invalid(values)
+    return values
+
+
+def append_block(block: xr.Dataset, output_pth, time_dim: str, offset: int):
+    """Write a block of time steps into an existing file, starting at offset.
+
+    Only the variables with the time dimension are written. The values are
+    packed and masked by netCDF4 according to the attributes in the file.
+    The time variable is written last, so if the write is interrupted the
+    time steps of the file are only those with all their data.
+
+    The file is written under the write lock and xarray's HDF5 lock, like
+    xarray's own netCDF4 I/O, since the HDF5 library is not thread safe.
+    block must already be loaded: reading a lazy source while holding the
+    locks would deadlock, and would serialize the downloads.
+    """
+    names = sorted(
+        (name for name, var in block.variables.items() if time_dim in var.dims),
+        key=lambda name: name == time_dim,
+    )
+    with _WRITE_LOCK, HDF5_LOCK, netCDF4.Dataset(output_pth, "a") as nc:
+        for name in names:
+            if name not in nc.variables:
+                continue
+            var = block.variables[name]
+            nc_var = nc.variables[name]
+            index = tuple(
+                slice(offset, offset + var.sizes[time_dim]) if dim == time_dim else slice(None)
+                for dim in var.dims
+            )
+            nc_var[index] = _encode_values(var, nc_var)
+
+
+def _to_netcdf(ds: xr.Dataset, output_pth, **kwargs):
+    """Write a loaded dataset with ``to_netcdf``, holding the write lock."""
+    with _WRITE_LOCK:
+        ds.to_netcdf(output_pth, **kwargs)
+
+
+def read_times(output_pth) -> Tuple[Optional[str], pd.DatetimeIndex]:
+    """Return the time dimension of a file and its (written) time steps."""
+    with xr.open_dataset(output_pth, decode_times=False) as ds:
+        time_dim = get_time_dim(ds)
+    if time_dim is None:
+        return None, pd.DatetimeIndex([])
+    with HDF5_LOCK, netCDF4.Dataset(output_pth, "r") as nc:
+        nc_var = nc.variables[time_dim]
+        # steps not (yet) written are masked as fill values
+        values = np.ma.masked_invalid(nc_var[:]).compressed()
+        times = xr.coding.times.decode_cf_datetime(
+            values, nc_var.units, getattr(nc_var, "calendar", "standard")
+        )
+    return time_dim, pd.DatetimeIndex(times)
+
+
+def _check_appendable(ds: xr.Dataset, output_pth, time_dim: str):
+    """Raise a ValueError if ds can't be appended to the file along time_dim."""
+    with HDF5_LOCK, netCDF4.Dataset(output_pth, "r") as nc:
+        if time_dim not in nc.dimensions or not nc.dimensions[time_dim].isunlimited():
+            raise ValueError(f"{output_pth} has no unlimited {time_dim} dimension to append to")
+        for name, var in ds.variables.items():
+            if time_dim not in var.dims or name not in nc.variables:
+                continue
+            nc_var = nc.variables[name]
+            shape = {dim: size for dim, size in zip(nc_var.dimensions, nc_var.shape)}
+            shape.pop(time_dim, None)
+            new_shape = dict(var.sizes)
+            new_shape.pop(time_dim)
+            if tuple(nc_var.dimensions) != var.dims or shape != new_shape:
+                raise ValueError(
+                    f"The grid of {name} does not match the grid in {output_pth}"
+                )
+
+
+def append_dataset(
+    ds: xr.Dataset,
+    output_pth,
+    memory_budget: int = DEFAULT_MEMORY_BUDGET,
+    report: Optional[Callable[[str], None]] = print,
+) -> List[BlockStats]:
+    """Append the time steps of a dataset to a file written by `write_streaming`.
+
+    The time steps are written starting at the first time step of the file
+    that is not before the first time of ds, so any time steps of the file
+    that ds also has are replaced, along with everything after them.
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        The (lazily loaded) dataset to append, on the same grid as the file.
+    output_pth : Path
+        The file to append to. It must have an unlimited time dimension.
+    memory_budget : int
+        Maximum number of bytes of data to hold in memory at once.
+    report : callable, optional
+        Called with a line of text for each block written. None for silence.
+
+    Returns
+    -------
+    list of BlockStats
+        The blocks written, with indices relative to the start of ds.
+    """
+    time_dim = get_time_dim(ds)
+    if time_dim is None:
+        raise ValueError("The dataset has no time dimension to append along")
+    _check_appendable(ds, output_pth, time_dim)
+    if ds.sizes[time_dim] == 0:
+        return []
+    _, file_times = read_times(output_pth)
+    offset = int(file_times.searchsorted(pd.Timestamp(ds[time_dim].values[0])))
+
+    blocks = time_blocks(ds, time_dim, memory_budget)
+    stats = []
+    for i, blk in enumerate(blocks):
+        timer = Timer()
+        block = ds.isel({time_dim: blk}).load()
+        append_block(block, output_pth, time_dim, offset + blk.start)
+        stats.append(BlockStats(i, blk.start, blk.stop, block.nbytes, timer.tock()))
+        _report_block(report, stats[-1], len(blocks))
+    return stats
+
+
+def write_streaming(
+    ds: xr.Dataset,
+    output_pth,
+    memory_budget: int = DEFAULT_MEMORY_BUDGET,
+    report: Optional[Callable[[str], None]] = print,
+    encoding: Optional[OutputEncoding] = None,
+) -> List[BlockStats]:
+    """Write a dataset to netCDF one block of time steps at a time.
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        The (lazily loaded) dataset to write.
+    output_pth : Path
+        The file to write.
+    memory_budget : int
+        Maximum number of bytes of data to hold in memory at once.
+    report : callable, optional
+        Called with a line of text for each block written. None for silence.
+    encoding : OutputEncoding, optional
+        Compression and chunking of the variables. None for xarray's defaults.
+
+    Returns
+    -------
+    list of BlockStats
+    """
+    time_dim = get_time_dim(ds)
+    if time_dim is None:
+        _to_netcdf(ds.compute(), output_pth, encoding=_encodings(ds, None, encoding))
+        return []
+
+    blocks = time_blocks(ds, time_dim, memory_budget)
+    encodings = _encodings(ds, time_dim, encoding)
+    stats = []
+    for i, blk in enumerate(blocks):
+        stats.append(_write_block(ds, output_pth, time_dim, i, blk, encodings))
+        _report_block(report, stats[-1], len(blocks))
+    return stats
+
+
+def _encodings(
+    ds: xr.Dataset, time_dim: Optional[str], encoding: Optional[OutputEncoding]
+) -> dict:
+    """The ``to_netcdf`` encoding of the variables of ds."""
+    encodings = {} if encoding is None else encoding.variable_encodings(ds, time_dim)
+    if time_dim is not None:
+        for name, var in ds.variables.items():
+            if var.dims == (time_dim,) and np.issubdtype(var.dtype, np.datetime64):
+                # float, so that appended times can be encoded with the same units
+                encodings.setdefault(name, {})["dtype"] = "float64"
+    return encodings
+
+
+def _write_block(
+    ds: xr.Dataset, output_pth, time_dim: str, i: int, blk: slice, encodings: dict
+) -> BlockStats:
+    """Load one block of time steps and write it; the first block creates the file."""
+    timer = Timer()
+    block = ds.isel({time_dim: blk}).load()
+    if i == 0:
+        _to_netcdf(block, output_pth, unlimited_dims=[time_dim], encoding=encodings)
+    else:
+        append_block(block, output_pth, time_dim, blk.start)
+    return BlockStats(i, blk.start, blk.stop, block.nbytes, timer.tock())
+
+
+def _report_block(report: Optional[Callable[[str], None]], stats: BlockStats, n_blocks: int):
+    """Report the timing of a block written."""
+    if report is not None:
+        report(
+            f"\tBlock {stats.index + 1}/{n_blocks} "
+            f"(time steps {stats.start}-{stats.stop - 1}): "
+            f"{stats.nbytes / 1024 / 1024:.2f} MiB in {stats.elapsed_ms:.1f} ms "
+            f"({stats.throughput:.2f} MiB/s)"
+        )
+
+
+def partial_path(output_pth) -> Path:
+    """The temporary file a checkpointed write goes to."""
+    output_pth = Path(output_pth)
+    return output_pth.with_name(output_pth.name + ".part")
+
+
+def manifest_path(output_pth) -> Path:
+    """The sidecar manifest recording the blocks of a checkpointed write."""
+    output_pth = Path(output_pth)
+    return output_pth.with_name(output_pth.name + ".manifest.json")
+
+
+def dataset_signature(
+    ds: xr.Dataset, time_dim: str, encoding: Optional[OutputEncoding] = None
+) -> str:
+    """Hash of the layout of a dataset, used to check a resume is for the same subset.
+
+    The variable names, dims, shapes, dtypes, the values of the coordinates
+    (so a same-shaped subset of another area differs) and the output
+    encoding are used. No bulk data are read.
+    """
+    digest = hashlib.sha1()
+    digest.update(repr(encoding).encode())
+    for name in sorted(str(n) for n in ds.variables):
+        var = ds.variables[name]
+        digest.update(repr((name, var.dims, var.shape, str(var.dtype))).encode())
+    for name in sorted(str(n) for n in ds.coords):
+        values = np.asarray(ds.variables[name].values)
+        if values.dtype.kind in "biufcmM":
+            digest.update(np.ascontiguousarray(values).tobytes())
+        else:
+            digest.update(repr(values.tolist()).encode())
+    return digest.hexdigest()
+
+
+def _load_manifest(pth: Path) -> Optional[dict]:
+    """Read a manifest, or None if it is missing or unreadable."""
+    try:
+        with open(pth, "r", encoding="utf-8") as infile:
+            manifest = json.load(infile)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(manifest, dict) or manifest.get("version") != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def _save_manifest(pth: Path, manifest: dict):
+    """Write a manifest atomically, so it always matches a consistent file."""
+    tmp_pth = pth.with_name(pth.name + ".tmp")
+    with open(tmp_pth, "w", encoding="utf-8") as outfile:
+        json.dump(manifest, outfile)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(tmp_pth, pth)
+
+
+def _is_readable(pth: Path) -> bool:
+    """Return True if pth is a netCDF file that can be opened for appending."""
+    try:
+        with HDF5_LOCK, netCDF4.Dataset(pth, "a"):
+            return True
+    except OSError:
+        return False
+
+
+def verify_output(pth, time_dim: str, n_times: int):
+    """Raise a ValueError if the written file does not have every time step."""
+    with HDF5_LOCK, netCDF4.Dataset(pth, "r") as nc:
+        if time_dim not in nc.dimensions:
+            raise ValueError(f"{pth} has no {time_dim} dimension")
+        size = len(nc.dimensions[time_dim])
+    if size != n_times:
+        raise ValueError(f"{pth} has {size} of {n_times} time steps")
+
+
+def write_checkpointed(
+    ds: xr.Dataset,
+    output_pth,
+    memory_budget: int = DEFAULT_MEMORY_BUDGET,
+    report: Optional[Callable[[str], None]] = print,
+    encoding: Optional[OutputEncoding] = None,
+) -> List[BlockStats]:
+    """Write a dataset to netCDF in blocks of time steps, resumably.
+
+    The blocks are written to ``<output_pth>.part`` and each completed block
+    is recorded in ``<output_pth>.manifest.json``. If a previous write of the
+    same subset was interrupted, the write resumes from the first block not
+    recorded. When all the blocks are written the file is checked and renamed
+    to output_pth, and the manifest removed, so output_pth only ever exists
+    complete.
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        The (lazily loaded) dataset to write.
+    output_pth : Path
+        The file to write.
+    memory_budget : int
+        Maximum number of bytes of data to hold in memory at once. Ignored on
+        resume, where the blocks of the interrupted write are used.
+    report : callable, optional
+        Called with a line of text for each block written. None for silence.
+    encoding : OutputEncoding, optional
+        Compression and chunking of the variables. None for xarray's defaults.
+
+    Returns
+    -------
+    list of BlockStats
+        The blocks written by this call.
+    """
+    output_pth = Path(output_pth)
+    part_pth = partial_path(output_pth)
+    manifest_pth = manifest_path(output_pth)
+
+    time_dim = get_time_dim(ds)
+    if time_dim is None:
+        _to_netcdf(ds.compute(), part_pth, encoding=_encodings(ds, None, encoding))
+        os.replace(part_pth, output_pth)
+        return []
+
+    signature = dataset_signature(ds, time_dim, encoding)
+    manifest = _load_manifest(manifest_pth)
+    if (
+        manifest is not None
+        and manifest["signature"] == signature
+        and manifest["completed"]
+        and _is_readable(part_pth)
+    ):
+        blocks = [slice(start, stop) for start, stop in manifest["blocks"]]
+        if report is not None:
+            report(
+                f"\tResuming {output_pth}: {len(manifest['completed'])}/{len(blocks)} "
+                "blocks already written"
+            )
+    else:
+        blocks = time_blocks(ds, time_dim, memory_budget)
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "signature": signature,
+            "time_dim": time_dim,
+            "n_times": int(ds.sizes[time_dim]),
+            "blocks": [[blk.start, blk.stop] for blk in blocks],
+            "completed": [],
+        }
+        if part_pth.exists():
+            part_pth.unlink()
+        _save_manifest(manifest_pth, manifest)
+
+    completed = set(manifest["completed"])
+    encodings = _encodings(ds, time_dim, encoding)
+    stats = []
+    for i, blk in enumerate(blocks):
+        if i in completed:
+            continue
+        stats.append(_write_block(ds, part_pth, time_dim, i, blk, encodings))
+        completed.add(i)
+        manifest["completed"] = sorted(completed)
+        _save_manifest(manifest_pth, manifest)
+        _report_block(report, stats[-1], len(blocks))
+
+    verify_output(part_pth, time_dim, manifest["n_times"])
+    os.replace(part_pth, output_pth)
+    manifest_pth.unlink()
+    return stats
+
+
+def bitround(values: np.ndarray, significant_digits: int) -> np.ndarray:
+    """Round floats to keep the mantissa bits needed for significant_digits.
+
+    The dropped bits are zeroed, so the data compress much better. This is
+    the "BitRound" quantization netCDF applies for ``significant_digits``.
+    """
+    values = np.asarray(values)
+    if values.dtype == np.float32:
+        uint, mantissa_bits = np.uint32, 23
+    elif values.dtype == np.float64:
+        uint, mantissa_bits = np.uint64, 52
+    else:
+        return values
+    keep_bits = int(np.ceil(significant_digits * np.log2(10)))
+    if keep_bits >= mantissa_bits:
+        return values
+    drop_bits = mantissa_bits - keep_bits
+    bits = values.view(uint)
+    half = uint(1 << (drop_bits - 1))
+    mask = ~uint((1 << drop_bits) - 1)
+    rounded = ((bits + half) & mask).view(values.dtype)
+    return np.where(np.isfinite(values), rounded, values)
+
+
+def _zarr_compression(
+    compression: Optional[str], complevel: int, zarr_major: Optional[int] = None
+) -> dict:
+    """The Zarr encoding of a compression, for the installed zarr version.
+
+    zarr 3 takes a list of ``zarr.codecs`` compressors; zarr 2 (which is the
+    only one on Python < 3.11) a single numcodecs compressor.
+    """
+    if zarr_major is None:
+        import zarr
+
+        zarr_major = int(zarr.__version__.split(".")[0])
+    if zarr_major >= 3:
+        import zarr.codecs
+
+        codecs = {"zlib": zarr.codecs.GzipCodec, "zstd": zarr.codecs.ZstdCodec}
+        if compression is None:
+            return {"compressors": None}
+        return {"compressors": [codecs[compression](level=complevel)]}
+
+    import numcodecs
+
+    codecs = {"zlib": numcodecs.Zlib, "zstd": numcodecs.Zstd}
+    if compression is None:
+        return {"compressor": None}
+    return {"compressor": codecs[compression](level=complevel)}
+
+
+def _prepare_zarr(
+    ds: xr.Dataset, time_dim: Optional[str], encoding: Optional[OutputEncoding]
+) -> Tuple[xr.Dataset, dict]:
+    """Return the dataset, rechunked and quantized, and the encoding to write it as Zarr."""
+    ds = ds.copy()
+    encodings = {}
+    if time_dim is not None and encoding is not None and encoding.time_chunk is not None:
+        ds = ds.chunk({time_dim: encoding.time_chunk})
+    for name, var in ds.variables.items():
+        enc = {k: v for k, v in var.encoding.items() if k in _KEPT_ENCODINGS}
+        var.encoding = {}
+        if encoding is not None and np.issubdtype(var.dtype, np.number) and var.ndim > 0:
+            is_float = np.issubdtype(var.dtype, np.floating)
+            if name in ds.data_vars and is_float:
+                if encoding.float32 or encoding.significant_digits:
+                    for key in ("dtype", "scale_factor", "add_offset"):
+                        enc.pop(key, None)
+                if encoding.float32 and var.dtype == np.float64:
+                    ds[name] = ds[name].astype("float32")
+                if encoding.significant_digits is not None:
+                    ds[name] = xr.apply_ufunc(
+                        bitround,
+                        ds[name],
+                        kwargs={"significant_digits": encoding.significant_digits},
+                        dask="parallelized",
+                        output_dtypes=[ds[name].dtype],
+                        keep_attrs=True,
+                    )
+            enc.update(_zarr_compression(encoding.compression, encoding.complevel))
+        encodings[name] = enc
+    return ds, encodings
+
+
+def write_zarr(
+    ds: xr.Dataset,
+    output_pth,
+    encoding: Optional[OutputEncoding] = None,
+    consolidated: bool = True,
+):
+    """Write a dataset to a Zarr store.
+
+    The chunks of the store follow the dask chunks of ds (one block of
+    ``encoding.time_chunk`` time steps by the whole grid, if an encoding is
+    given), and they are written in parallel by dask. The store is written to
+    ``<output_pth>.part`` and renamed into place when complete.
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        The (lazily loaded) dataset to write.
+    output_pth : Path
+        The directory of the store.
+    encoding : OutputEncoding, optional
+        Compression, quantization and chunking. None for the Zarr defaults.
+    consolidated : bool
+        Write consolidated metadata, so the store is opened with one read.
+    """
+    try:
+        import zarr  # noqa: F401
+    except ImportError as err:
+        raise ImportError("Writing Zarr output needs the zarr package") from err
+
+    output_pth = Path(output_pth)
+    part_pth = partial_path(output_pth)
+    if part_pth.exists():
+        shutil.rmtree(part_pth)
+    ds, encodings = _prepare_zarr(ds, get_time_dim(ds), encoding)
+    ds.to_zarr(part_pth, mode="w", encoding=encodings, consolidated=consolidated)
+    if output_pth.is_dir():
+        shutil.rmtree(output_pth)
+    elif output_pth.exists():
+        output_pth.unlink()
+    os.replace(part_pth, output_pth)
+
+
+def write_output(
+    ds: xr.Dataset,
+    output_pth,
+    output_format: str = NETCDF,
+    memory_budget: int = DEFAULT_MEMORY_BUDGET,
+    report: Optional[Callable[[str], None]] = print,
+    encoding: Optional[OutputEncoding] = None,
+    consolidated: bool = True,
+):
+    """Write a dataset as netCDF (with `write_checkpointed`) or Zarr (with `write_zarr`)."""
+    if output_format == NETCDF:
+        write_checkpointed(ds, output_pth, memory_budget, report, encoding)
+    elif output_format == ZARR:
+        write_zarr(ds, output_pth, encoding, consolidated)
+    else:
+        raise ValueError(
+            f"Unknown output format {output_format!r}, should be one of {OUTPUT_FORMATS}"
+        )
+
+
+def export_cached(
+    output_format: str = NETCDF,
+    encoding: Optional[OutputEncoding] = None,
+    consolidated: bool = True,
+) -> Callable[[Path, Path], None]:
+    """Return a function that exports a cached netCDF subset in the output format."""
+
+    def export(cached_pth, output_pth):
+        if output_format == NETCDF:
+            shutil.copyfile(cached_pth, output_pth)
+            return
+        with xr.open_dataset(cached_pth, chunks={}) as ds:
+            write_output(
+                ds, output_pth, output_format, encoding=encoding, consolidated=consolidated
+            )
+
+    return export
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+"""
+benchmark_timeslice.py
+
+micro-benchmark of the time slice lookup of the netCDF4 based models
+
+Compares nc.get_timeslice_indices (searchsorted on the numeric time axis)
+with the datetime conversion it replaces, on a synthetic multi-year hourly
+time axis like that of a long MFDataset aggregation.
+"""
+
+import datetime
+
+import numpy as np
+from netCDF4 import num2date
+
+from libgoods.file_processing.base import nc
+from libgoods.performance import Timer
+
+YEARS = 10
+UNITS = "hours since 2010-01-01 00:00:00"
+START = datetime.datetime(2015, 6, 1)
+END = datetime.datetime(2015, 6, 8)
+
+
+def datetime_indices(times, units, start, end):
+    """what get_timeslice_indices used to do"""
+    dts = num2date(times, units)
+    t1 = [i for i, dt in enumerate(dts) if dt >= start][0]
+    t2 = [i for i, dt in enumerate(dts) if dt <= end][-1] + 1
+    return t1, t2
+
+
+model = nc()
+model.time = np.arange(0, YEARS * 365 * 24, dtype="float64")
+model.time_units = UNITS
+print(f"{len(model.time)} time steps")
+
+with Timer("datetime conversion: {}"):
+    expected = datetime_indices(model.time, UNITS, START, END)
+
+with Timer("searchsorted: {}"):
+    indices = model.get_timeslice_indices(START, END)
+
+assert indices == expected, (indices, expected)